@@ -1,10 +1,29 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 import os
+import sys
 import random
 import string
 import json
-from datetime import datetime, timedelta
+import hashlib
+import functools
+import csv
+import io
+import base64
+import sqlite3
+import threading
+import heapq
+import bisect
+import time
+import re
+import math
+import urllib.parse
+import urllib.request
+import atexit
+import abc
+from datetime import date, datetime, timedelta
 import logging
+from collections import OrderedDict, deque
+import click
 from werkzeug.exceptions import BadRequest
 import mysql.connector
 from mysql.connector import Error as MySQLError
@@ -29,17 +48,473 @@ class Config:
     MYSQL_PORT = os.environ.get('MYSQL_PORT', 3306)
     # DATABASE_FILE = 'transport_orders.json' # Removed
 
+    # Connection pool (per worker process)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5)) # Connections kept open
+    DB_POOL_MAX_OVERFLOW = int(os.environ.get('DB_POOL_MAX_OVERFLOW', 0)) # Extra connections opened during bursts
+    DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 2.0)) # Seconds a request waits for a free connection
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 3600)) # Reconnect connections older than this (below MySQL's wait_timeout)
+    DB_POOL_PRE_PING_IDLE = float(os.environ.get('DB_POOL_PRE_PING_IDLE', 30)) # Ping connections idle this long before reuse
+
+    # Seconds the crops/locations lists used by the USSD menus are kept in memory
+    CATALOG_CACHE_TTL = int(os.environ.get('CATALOG_CACHE_TTL', 300))
+
+    # USSD session store: 'memory' (per process) or 'sqlite' (local file shared by all workers on the host)
+    USSD_SESSION_BACKEND = os.environ.get('USSD_SESSION_BACKEND', 'memory')
+    USSD_SESSION_TTL = int(os.environ.get('USSD_SESSION_TTL', 300)) # Gateways end idle sessions well before this
+    USSD_SESSION_MAX_ENTRIES = int(os.environ.get('USSD_SESSION_MAX_ENTRIES', 50000))
+    USSD_SESSION_DB_PATH = os.environ.get('USSD_SESSION_DB_PATH', 'ussd_sessions.sqlite3')
+    USSD_LANGUAGE = os.environ.get('USSD_LANGUAGE', 'sw') # Key into USSD_TEXT
+    USSD_RECENT_ORDERS = int(os.environ.get('USSD_RECENT_ORDERS', 4)) # Orders listed under "Maombi Yangu" (screens are ~180 chars)
+
+    # Transporter assignment: 'least_active', 'round_robin' (per pickup location) or 'rating_weighted'
+    TRANSPORTER_ASSIGNMENT_STRATEGY = os.environ.get('TRANSPORTER_ASSIGNMENT_STRATEGY', 'least_active')
+    TRANSPORTER_INDEX_REFRESH = int(os.environ.get('TRANSPORTER_INDEX_REFRESH', 30)) # Seconds between incremental refreshes
+    TRANSPORTER_INDEX_FULL_RELOAD = int(os.environ.get('TRANSPORTER_INDEX_FULL_RELOAD', 600)) # Seconds between full reloads
+    # Orders in these statuses no longer count towards a transporter's open orders
+    CLOSED_ORDER_STATUSES = [s.strip() for s in os.environ.get(
+        'CLOSED_ORDER_STATUSES', 'Mizigo imefika mahali pa utoaji,Imekamilika,Imeghairiwa').split(',') if s.strip()]
+
+    # Order writes: 'sync' (inserted during the USSD request) or 'write_behind' (journaled locally, flushed in the background)
+    ORDER_WRITE_MODE = os.environ.get('ORDER_WRITE_MODE', 'sync')
+    ORDER_JOURNAL_PATH = os.environ.get('ORDER_JOURNAL_PATH', 'order_journal.sqlite3')
+    ORDER_JOURNAL_FLUSH_INTERVAL = float(os.environ.get('ORDER_JOURNAL_FLUSH_INTERVAL', 1.0)) # Seconds between flushes when idle
+    ORDER_JOURNAL_BATCH_SIZE = int(os.environ.get('ORDER_JOURNAL_BATCH_SIZE', 500)) # Orders per multi-row INSERT
+    # Legacy name columns of orders: 'auto' (used while the table has them) or 'ignore' (never read or
+    # written, set on every worker before `flask drop-legacy-order-columns`)
+    ORDER_LEGACY_COLUMNS = os.environ.get('ORDER_LEGACY_COLUMNS', 'auto')
+
+    # Order status history (order_status_events), written from an in-process buffer
+    ORDER_EVENT_FLUSH_INTERVAL = float(os.environ.get('ORDER_EVENT_FLUSH_INTERVAL', 1.0)) # Seconds between writes
+    ORDER_EVENT_BATCH_SIZE = int(os.environ.get('ORDER_EVENT_BATCH_SIZE', 500)) # Events per multi-row INSERT
+    ORDER_EVENT_MAX_PENDING = int(os.environ.get('ORDER_EVENT_MAX_PENDING', 100000)) # Oldest are dropped beyond this
+    ORDER_STATUS_SLA_HOURS = float(os.environ.get('ORDER_STATUS_SLA_HOURS', 48)) # Default for the SLA reports
+
+    # Tracking numbers reserved from MySQL in one round trip (per worker)
+    TRACK_NUMBER_BLOCK_SIZE = int(os.environ.get('TRACK_NUMBER_BLOCK_SIZE', 1000))
+
+    # Rendered USSD tracking results, keyed by track number
+    TRACKING_CACHE_TTL = int(os.environ.get('TRACKING_CACHE_TTL', 60))
+    TRACKING_CACHE_MAX_ENTRIES = int(os.environ.get('TRACKING_CACHE_MAX_ENTRIES', 100000))
+
+    # Report responses, keyed by endpoint and query string; order writes invalidate them
+    REPORT_CACHE_TTL = int(os.environ.get('REPORT_CACHE_TTL', 30))
+    REPORT_CACHE_MAX_ENTRIES = int(os.environ.get('REPORT_CACHE_MAX_ENTRIES', 256))
+    REPORT_DEFAULT_DAYS = int(os.environ.get('REPORT_DEFAULT_DAYS', 30)) # Window of the orders-over-time report without start/end
+    REPORT_MAX_BUCKETS = int(os.environ.get('REPORT_MAX_BUCKETS', 1000))
+
+    # Admin order list pagination (GET /api/orders?limit=...)
+    ORDERS_PAGE_SIZE = int(os.environ.get('ORDERS_PAGE_SIZE', 50))
+    ORDERS_MAX_PAGE_SIZE = int(os.environ.get('ORDERS_MAX_PAGE_SIZE', 500))
+    ORDER_STATUS_BATCH_MAX_SIZE = int(os.environ.get('ORDER_STATUS_BATCH_MAX_SIZE', 500)) # Orders per POST /api/orders/status:batch
+
+    # Bulk import of transporters, locations and crops (POST /api/import/<entity>, flask import-data)
+    IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000)) # Rows per multi-row upsert and transaction
+    IMPORT_MAX_BATCH_SIZE = int(os.environ.get('IMPORT_MAX_BATCH_SIZE', 10000))
+    ORDER_EXPORT_CHUNK_SIZE = int(os.environ.get('ORDER_EXPORT_CHUNK_SIZE', 1000)) # Rows read from MySQL per fetch during exports
+
 
 # Initialize app config
 app.config.from_object(Config)
 
+# --- Metrics ---
+# In-process counters and histograms exposed at /metrics in the Prometheus text format.
+# Each metric has its own lock and an update is a dict lookup plus a bisect, cheap enough
+# for every request and every query. Values are per worker process, like /api/cache-stats.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS = []
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonically increasing count per label combination."""
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self._values = {(): 0} if not labelnames else {} # Unlabelled counters start out at 0
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for labels, value in values:
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label combination."""
+
+    def __init__(self, name, description, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values = {} # labels -> [count per bucket (+Inf last), sum]
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def collect(self):
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge or counter whose value is read from `callback` at scrape time (skipped while it returns None)."""
+
+    def __init__(self, name, description, kind, callback):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.callback = callback
+        METRICS.append(self)
+
+    def collect(self):
+        value = self.callback()
+        if value is None:
+            return []
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}", f"{self.name} {value}"]
+
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds', 'HTTP request latency by route.', ('endpoint', 'method', 'status'))
+USSD_LATENCY = Histogram('ussd_request_duration_seconds', 'USSD callback latency by main-menu option and menu depth.', ('menu', 'depth'))
+USSD_ERRORS = Counter('ussd_errors_total', 'USSD requests answered with the system error screen.')
+DB_QUERY_LATENCY = Histogram('db_query_duration_seconds', 'Database statement latency by the function that checked out the connection.', ('call_site',))
+DB_QUERY_ERRORS = Counter('db_query_errors_total', 'Failed database statements by call site.', ('call_site',))
+DB_CHECKOUT_WAIT = Histogram('db_pool_checkout_seconds', 'Time spent getting a connection from the pool.')
+DB_CHECKOUT_ERRORS = Counter('db_pool_checkout_errors_total', 'Failed attempts to get a connection from the pool.')
+
+def db_pool_stat(key):
+    pool = db_pool
+    return pool.stats()[key] if isinstance(pool, ConnectionPool) else None
+
+CallbackMetric('db_pool_connections_in_use', 'Connections checked out of the pool.', 'gauge', lambda: db_pool_stat('in_use'))
+CallbackMetric('db_pool_connections_idle', 'Open connections waiting in the pool.', 'gauge', lambda: db_pool_stat('idle'))
+CallbackMetric('db_pool_waiters', 'Requests waiting for a free connection.', 'gauge', lambda: db_pool_stat('waiters'))
+CallbackMetric('db_pool_timeouts_total', 'Checkouts that gave up after DB_POOL_TIMEOUT.', 'counter', lambda: db_pool_stat('timeouts'))
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.collect())
+    return '\n'.join(lines) + '\n'
+
+
+class InstrumentedCursor:
+    """Cursor proxy that records the latency and failures of every statement."""
+
+    def __init__(self, cursor, call_site):
+        self._cursor = cursor
+        self._call_site = call_site
+
+    def _timed(self, method, args, kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except MySQLError:
+            DB_QUERY_ERRORS.inc(self._call_site)
+            raise
+        finally:
+            DB_QUERY_LATENCY.observe(time.perf_counter() - started, self._call_site)
+
+    def execute(self, *args, **kwargs):
+        return self._timed(self._cursor.execute, args, kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._timed(self._cursor.executemany, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    """Connection proxy handing out InstrumentedCursors labelled with the connection's call site."""
+
+    def __init__(self, conn, call_site):
+        self._conn = conn
+        self._call_site = call_site
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs), self._call_site)
+
+    def cached_cursor(self, key, **kwargs):
+        return InstrumentedCursor(self._conn.cached_cursor(key, **kwargs), self._call_site)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
 # Database connection pool
+# ConnectionPool replaces mysql.connector's fixed-size pool, which fails at once when every
+# connection is busy. Here a checkout waits up to DB_POOL_TIMEOUT for a connection to come
+# back, may open up to DB_POOL_MAX_OVERFLOW extra connections during bursts, and validates
+# idle connections on checkout (ping after DB_POOL_PRE_PING_IDLE seconds idle, reconnect
+# after DB_POOL_RECYCLE seconds). Returning a connection does not reset the session; an
+# open transaction is rolled back instead.
+
+class PooledCursor:
+    """Cursor proxy that marks its connection broken when the server connection fails."""
+
+    def __init__(self, cursor, connection):
+        self._cursor = cursor
+        self._connection = connection
+
+    def _call(self, method, args, kwargs):
+        try:
+            return method(*args, **kwargs)
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+            self._connection.broken = True
+            raise
+
+    def execute(self, *args, **kwargs):
+        return self._call(self._cursor.execute, args, kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._call(self._cursor.executemany, args, kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class PooledConnection:
+    """Connection proxy handed out by ConnectionPool; close() gives the connection back to the pool."""
+
+    def __init__(self, pool, conn, created_at, cursor_cache):
+        self._pool = pool
+        self._conn = conn
+        self._created_at = created_at
+        self._cursor_cache = cursor_cache
+        self.broken = False
+
+    def cursor(self, *args, **kwargs):
+        return PooledCursor(self._conn.cursor(*args, **kwargs), self)
+
+    def cached_cursor(self, key, **kwargs):
+        """Returns the cursor cached under `key` for this physical connection, creating it on first use."""
+        cursor = self._cursor_cache.get(key)
+        if cursor is None:
+            cursor = self._cursor_cache[key] = self._conn.cursor(**kwargs)
+        return PooledCursor(cursor, self)
+
+    def is_connected(self):
+        # No round trip: the pool validated the connection on checkout. Stays True for a broken
+        # connection too, since callers only close() connected ones and close() must still run
+        # so the pool can discard it.
+        return self._conn is not None
+
+    def discard(self):
+        """Have close() close the connection instead of returning it to the pool."""
+        self.broken = True
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn, self._created_at, self._cursor_cache, self.broken)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class ConnectionPool:
+    """Thread-safe MySQL connection pool with a bounded wait, overflow connections and health checks."""
+
+    def __init__(self, size, max_overflow, timeout, recycle, pre_ping_idle, **connect_args):
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.pre_ping_idle = pre_ping_idle
+        self.connect_args = connect_args
+        self._idle = [] # (conn, created_at, last_used, cursor_cache); used as a stack so busy connections stay warm
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+        self._open = 0
+        self._in_use = 0
+        self._waiters = 0
+        self._counters = {'checkouts': 0, 'timeouts': 0, 'wait_seconds_total': 0.0, 'max_wait_seconds': 0.0,
+                          'connects': 0, 'recycled': 0, 'failed_pings': 0, 'discarded': 0}
+
+    def fill(self):
+        """Opens connections until the pool holds `size` of them. Raises MySQLError if one can't be opened."""
+        with self._cond:
+            missing = self.size - self._open
+            self._open += missing
+        opened = []
+        try:
+            for _ in range(missing):
+                opened.append((self._connect(), time.monotonic(), time.monotonic(), {}))
+        finally:
+            with self._cond:
+                self._open -= missing - len(opened)
+                self._idle.extend(opened)
+                self._cond.notify(len(opened))
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self.connect_args)
+        with self._cond:
+            self._counters['connects'] += 1
+        return conn
+
+    def _check_fork(self):
+        # Sockets opened before a fork belong to the parent; forget them without closing
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._open = self._in_use = self._waiters = 0
+
+    def get_connection(self):
+        """
+        Checks out a connection, waiting up to `timeout` seconds for one to become free.
+        Raises PoolError on timeout and MySQLError if no working connection can be opened.
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+        entry = None
+        with self._cond:
+            self._check_fork()
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._open < self.size + self.max_overflow:
+                    self._open += 1 # Reserve the slot, the connection is opened outside the lock
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise mysql.connector.errors.PoolError(
+                        f"No database connection became free within {self.timeout}s ({self._in_use} in use)")
+                self._waiters += 1
+                self._cond.wait(remaining)
+                self._waiters -= 1
+            self._in_use += 1
+            waited = time.monotonic() - started
+            self._counters['checkouts'] += 1
+            self._counters['wait_seconds_total'] += waited
+            self._counters['max_wait_seconds'] = max(self._counters['max_wait_seconds'], waited)
+        try:
+            if entry:
+                conn, created_at, cursor_cache = self._validate(*entry)
+            else:
+                conn, created_at, cursor_cache = self._connect(), time.monotonic(), {}
+        except MySQLError:
+            with self._cond:
+                self._open -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, conn, created_at, cursor_cache)
+
+    def _validate(self, conn, created_at, last_used, cursor_cache):
+        """Returns (conn, created_at, cursor_cache) for a usable connection, replacing `conn` if it is too old or dead."""
+        now = time.monotonic()
+        if self.recycle and now - created_at > self.recycle:
+            with self._cond:
+                self._counters['recycled'] += 1
+        elif now - last_used >= self.pre_ping_idle:
+            try:
+                conn.ping(reconnect=False)
+                return conn, created_at, cursor_cache
+            except MySQLError:
+                with self._cond:
+                    self._counters['failed_pings'] += 1
+        else:
+            return conn, created_at, cursor_cache
+        self._close_quietly(conn)
+        return self._connect(), time.monotonic(), {} # Cached cursors belong to the old connection
+
+    def release(self, conn, created_at, cursor_cache, broken=False):
+        if not broken and conn.in_transaction:
+            try:
+                conn.rollback() # Left open by an error path
+            except MySQLError:
+                broken = True
+        with self._cond:
+            if self._pid != os.getpid():
+                return # Checked out before a fork; the new process never counted it
+            self._in_use -= 1
+            # Overflow connections are closed once the pool has `size` idle ones again
+            keep = not broken and len(self._idle) < self.size
+            if keep:
+                self._idle.append((conn, created_at, time.monotonic(), cursor_cache))
+            else:
+                self._open -= 1
+                self._counters['discarded'] += 1
+            self._cond.notify()
+        if not keep:
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except MySQLError:
+            pass
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update(size=self.size, max_overflow=self.max_overflow, open=self._open,
+                         in_use=self._in_use, idle=len(self._idle), waiters=self._waiters)
+        stats['avg_wait_seconds'] = stats['wait_seconds_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+
 db_pool = None
 
+# Secondary indexes on orders, by name. Created on startup when missing, so existing tables pick them up too.
+# OBSOLETE_ORDER_INDEXES are dropped when present.
+ORDER_INDEXES = {
+    'idx_orders_created_at': "(created_at, track_number)", # Admin order list, newest first (keyset pagination)
+    'idx_orders_status_created': "(status, created_at)", # Orders by status report, status filters
+    'idx_orders_phone_created': "(phone_number, created_at)", # A customer's orders, newest first
+    'idx_orders_transporter_status': "(transporter_id, status)", # Open orders per transporter (transporter index)
+    'idx_orders_status_updated': "(status, status_updated_at)", # Orders in a status for longer than its SLA
+}
+OBSOLETE_ORDER_INDEXES = (
+    'idx_orders_created_date', # Orders per day report, now read from orders_daily_stats
+)
+
 def create_tables_if_not_exist():
     """Creates database tables if they don't already exist."""
     conn = None
     cursor = None
+    order_stats_table_created = False
     try:
         conn = get_db_connection()
         if conn is None:
@@ -106,6 +581,17 @@ def create_tables_if_not_exist():
         cursor.execute(system_settings_table_sql)
         logger.info("`system_settings` table checked/created successfully.")
 
+        # Named counters handed out in blocks (see reserve_sequence_block)
+        sequences_table_sql = """
+        CREATE TABLE IF NOT EXISTS sequences (
+            name VARCHAR(50) PRIMARY KEY,
+            next_value BIGINT NOT NULL
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        cursor.execute(sequences_table_sql)
+        cursor.execute("INSERT IGNORE INTO sequences (name, next_value) VALUES ('track_number', 1)")
+        logger.info("`sequences` table checked/created successfully.")
+
         # Modify the orders table schema (
         # For simplicity, we'll add new columns first. Dropping/altering old ones
         # would require more careful data migration in a live system.
@@ -118,24 +604,18 @@ def create_tables_if_not_exist():
             "ALTER TABLE orders ADD COLUMN IF NOT EXISTS destination_location_id INT NULL AFTER pickup_location_id, ADD CONSTRAINT fk_destination_location FOREIGN KEY (destination_location_id) REFERENCES locations(id) ON DELETE SET NULL"
         ]
 
-        # Original orders table schema (if it needs to be created from scratch)
-        # This includes the old fields for now, and the new FK fields.
-        # In a real migration, you'd handle existing data carefully.
+        # Orders table schema (if it needs to be created from scratch). Tables created before the
+        # FK fields existed still have the old text fields (crop, pickup_location, transporter_name
+        # etc., see LEGACY_ORDER_COLUMNS) until `flask drop-legacy-order-columns` removes them.
         orders_table_sql = """
         CREATE TABLE IF NOT EXISTS orders (
             track_number VARCHAR(20) PRIMARY KEY,
             phone_number VARCHAR(20),
             crop_id INT NULL,
-            crop VARCHAR(100), -- Old field, to be deprecated
             quantity INT,
             pickup_location_id INT NULL,
             destination_location_id INT NULL,
-            pickup_location VARCHAR(255), -- Old field, to be deprecated
-            destination_location VARCHAR(255), -- Old field, to be deprecated
             transporter_id INT NULL,
-            transporter_name VARCHAR(255), -- Old field, to be deprecated
-            transporter_phone VARCHAR(20), -- Old field, to be deprecated
-            transporter_rating VARCHAR(10), -- Old field, to be deprecated
             status VARCHAR(255),
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
             status_updated_at DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
@@ -177,6 +657,55 @@ def create_tables_if_not_exist():
             cursor.execute("ALTER TABLE orders ADD COLUMN destination_location_id INT NULL AFTER pickup_location_id, ADD CONSTRAINT fk_destination_location FOREIGN KEY (destination_location_id) REFERENCES locations(id) ON DELETE SET NULL")
             logger.info("Added destination_location_id to orders table.")
 
+        # Daily order rollup read by the reports (see add_order_stats)
+        cursor.execute("SHOW TABLES LIKE 'orders_daily_stats'")
+        order_stats_table_created = not cursor.fetchall()
+        order_stats_table_sql = """
+        CREATE TABLE IF NOT EXISTS orders_daily_stats (
+            stat_date DATE NOT NULL,
+            status VARCHAR(255) NOT NULL, -- '' when the order has no status
+            crop_id INT NOT NULL, -- 0 when the order has no crop_id, likewise for the locations
+            pickup_location_id INT NOT NULL,
+            destination_location_id INT NOT NULL,
+            order_count INT NOT NULL DEFAULT 0,
+            quantity_total BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (stat_date, status, crop_id, pickup_location_id, destination_location_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        cursor.execute(order_stats_table_sql)
+        logger.info("`orders_daily_stats` table checked/created successfully.")
+
+        # Status history of every order (see StatusEventBuffer). No foreign key: rows are only appended.
+        order_status_events_table_sql = """
+        CREATE TABLE IF NOT EXISTS order_status_events (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            track_number VARCHAR(20) NOT NULL,
+            status VARCHAR(255),
+            changed_at DATETIME NOT NULL,
+            previous_status VARCHAR(255), -- NULL for the event of a new order
+            previous_changed_at DATETIME, -- When previous_status began
+            INDEX idx_status_events_order (track_number, changed_at), -- An order's history
+            INDEX idx_status_events_status (status, changed_at), -- Orders entering a status
+            INDEX idx_status_events_previous (previous_status, changed_at) -- Orders leaving a status (time in status)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+        """
+        cursor.execute(order_status_events_table_sql)
+        logger.info("`order_status_events` table checked/created successfully.")
+
+        cursor.execute("SHOW INDEX FROM orders")
+        existing_indexes = {index_info[2] for index_info in cursor.fetchall()} # index_info[2] is Key_name
+        for index_name, columns in ORDER_INDEXES.items():
+            if index_name not in existing_indexes:
+                try:
+                    cursor.execute(f"CREATE INDEX {index_name} ON orders {columns}")
+                    logger.info(f"Added index {index_name} to orders table.")
+                except MySQLError as e: # The app works without it, only slower
+                    logger.warning(f"Could not add index {index_name} to orders table: {e}")
+        for index_name in OBSOLETE_ORDER_INDEXES:
+            if index_name in existing_indexes:
+                cursor.execute(f"DROP INDEX {index_name} ON orders")
+                logger.info(f"Dropped index {index_name} from orders table.")
+
         conn.commit()
         logger.info("All tables checked/created/modified successfully.")
 
@@ -189,52 +718,311 @@ def create_tables_if_not_exist():
             conn.close()
             logger.debug("MySQL connection closed after table creation check.")
 
+    if order_stats_table_created:
+        # New rollup on an existing database: count the orders that are already there
+        try:
+            with db_transaction() as db:
+                rows = rebuild_order_stats(db)
+            logger.info(f"Filled orders_daily_stats from existing orders ({rows} rows).")
+        except MySQLError as e:
+            logger.error(f"Error filling orders_daily_stats, run `flask rebuild-order-stats`: {e}")
+
 
 def init_db_pool():
     """Initialize MySQL connection pool."""
     global db_pool
+    pool = ConnectionPool(
+        size=Config.DB_POOL_SIZE,
+        max_overflow=Config.DB_POOL_MAX_OVERFLOW,
+        timeout=Config.DB_POOL_TIMEOUT,
+        recycle=Config.DB_POOL_RECYCLE,
+        pre_ping_idle=Config.DB_POOL_PRE_PING_IDLE,
+        host=app.config['MYSQL_HOST'],
+        user=app.config['MYSQL_USER'],
+        password=app.config['MYSQL_PASSWORD'],
+        database=app.config['MYSQL_DB'],
+        port=app.config['MYSQL_PORT']
+    )
     try:
-        db_pool = mysql.connector.pooling.MySQLConnectionPool(
-            pool_name="transport_pool",
-            pool_size=5,
-            host=app.config['MYSQL_HOST'],
-            user=app.config['MYSQL_USER'],
-            password=app.config['MYSQL_PASSWORD'],
-            database=app.config['MYSQL_DB'],
-            port=app.config['MYSQL_PORT']
-        )
-        logger.info("MySQL connection pool initialized successfully.")
+        pool.fill()
+        db_pool = pool
+        logger.info(f"MySQL connection pool initialized successfully ({Config.DB_POOL_SIZE} connections, {Config.DB_POOL_MAX_OVERFLOW} overflow).")
     except MySQLError as e:
         logger.error(f"Error while connecting to MySQL using connection pool: {e}")
         db_pool = None # Ensure pool is None if initialization fails
+        return
+    detect_order_columns()
 
-def get_db_connection():
-    """Get a connection from the pool."""
+def get_db_connection(call_site=None):
+    """Get a connection from the pool. `call_site` labels its queries in /metrics (default: the caller's name)."""
     if not db_pool:
         logger.error("Connection pool is not initialized. Call init_db_pool() first.")
         # Attempt to re-initialize, could be a transient issue or first call
         init_db_pool()
         if not db_pool: # If still not initialized, raise error
              raise MySQLError("Failed to initialize database connection pool.")
+    started = time.perf_counter()
     try:
         conn = db_pool.get_connection()
+        DB_CHECKOUT_WAIT.observe(time.perf_counter() - started)
         if conn.is_connected():
             logger.debug("MySQL connection acquired from pool.")
-            return conn
+            # Queries on this connection are reported under the function that asked for it
+            return InstrumentedConnection(conn, call_site or sys._getframe(1).f_code.co_name)
         else:
             logger.error("Failed to get a valid connection from pool.")
+            DB_CHECKOUT_ERRORS.inc()
             return None
     except MySQLError as e:
         logger.error(f"Error getting connection from pool: {e}")
+        DB_CHECKOUT_ERRORS.inc()
         return None
 
+# --- Data access ---
+# Handlers use a DbSession instead of managing connections and cursors themselves:
+#
+#     with db_session() as db:            # reads
+#         rows = db.fetchall('crops.list', (), map_row)
+#     with db_transaction() as db:        # writes; commits on success, rolls back on any exception
+#         db.execute('crops.delete', (crop_id,))
+#
+# Statements registered with named_query() run on a server-side prepared statement that is
+# created once per pooled connection and reused, so MySQL parses them only once. Any other
+# SQL text (e.g. UPDATEs built from the fields a request sends) runs as a plain statement.
+# Row mappers turn result rows into JSON-ready dicts.
+
+QUERIES = {}
+
+def named_query(name, sql):
+    """Registers `sql` under `name` for DbSession and returns it unchanged."""
+    QUERIES[name] = sql
+    return sql
+
+
+class DatabaseUnavailable(MySQLError):
+    """No connection could be checked out of the pool."""
+
+
+class DbSession:
+    """A pooled connection for the duration of a `with` block; see db_session() and db_transaction()."""
+
+    # Client errors meaning the connection died (server gone away, lost connection, lost handshake)
+    RECONNECT_ERRNOS = (2006, 2013, 2055)
+
+    def __init__(self, transactional=False):
+        self.transactional = transactional
+        self.conn = None
+        self._call_site = None
+        self._cursors = [] # Plain cursors to close on exit; cached prepared cursors stay open
+        self._executed = False
+
+    def __enter__(self):
+        self._call_site = sys._getframe(1).f_code.co_name
+        self._connect()
+        return self
+
+    def _connect(self):
+        self.conn = get_db_connection(call_site=self._call_site)
+        if self.conn is None:
+            raise DatabaseUnavailable("Database connection failed")
+        if self.transactional:
+            self.conn.start_transaction()
+
+    def _release(self):
+        conn, self.conn = self.conn, None
+        for cursor in self._cursors:
+            try:
+                cursor.close()
+            except MySQLError:
+                pass
+        self._cursors = []
+        conn.close()
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self.transactional:
+                if exc_type is None:
+                    self.conn.commit()
+                else:
+                    try:
+                        self.conn.rollback()
+                    except MySQLError as e:
+                        logger.warning(f"Rollback failed in {self._call_site}: {e}")
+        finally:
+            self._release()
+        return False
+
+    def _cursor(self, query):
+        sql = QUERIES.get(query)
+        if sql is not None:
+            return self.conn.cached_cursor(query, prepared=True, dictionary=True), sql
+        cursor = self.conn.cursor(dictionary=True)
+        self._cursors.append(cursor)
+        return cursor, query
+
+    def execute(self, query, params=()):
+        """
+        Runs a named query or SQL text and returns the cursor (rowcount, lastrowid, fetch*).
+        If the connection turns out to be dead on the first statement, it is replaced and the
+        statement retried once; nothing can have happened on the lost connection yet.
+        """
+        cursor, sql = self._cursor(query)
+        try:
+            cursor.execute(sql, params)
+        except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError) as e:
+            if self._executed or e.errno not in self.RECONNECT_ERRNOS:
+                raise
+            logger.warning(f"Lost database connection in {self._call_site}, retrying on a new one: {e}")
+            self._release()
+            self._connect()
+            cursor, sql = self._cursor(query)
+            cursor.execute(sql, params)
+        self._executed = True
+        return cursor
+
+    def executemany(self, query, seq_params):
+        """executemany() on a named query or SQL text; plain INSERT ... VALUES text is sent as one multi-row INSERT."""
+        cursor, sql = self._cursor(query)
+        cursor.executemany(sql, seq_params)
+        self._executed = True
+        return cursor
+
+    def fetchall(self, query, params=(), mapper=None):
+        rows = self.execute(query, params).fetchall()
+        return [mapper(row) for row in rows] if mapper else rows
+
+    def fetchone(self, query, params=(), mapper=None):
+        # fetchall() so that no unread rows are left on a reused prepared cursor
+        rows = self.execute(query, params).fetchall()
+        if not rows:
+            return None
+        return mapper(rows[0]) if mapper else rows[0]
+
+    def stream(self, query, params=(), chunk_size=1000):
+        """
+        Yields the rows of a query in lists of up to `chunk_size`. Rows are read from an
+        unbuffered cursor as they are consumed, so only one chunk is held in memory. If the
+        caller stops early, the connection is discarded instead of going back to the pool
+        with unread rows on it.
+        """
+        cursor = self.conn.cursor(dictionary=True) # Unbuffered; not a cached prepared cursor
+        self._cursors.append(cursor)
+        cursor.execute(QUERIES.get(query, query), params)
+        self._executed = True
+        try:
+            rows = cursor.fetchmany(chunk_size)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(chunk_size)
+        except BaseException: # Including GeneratorExit when the consumer goes away
+            self.conn.discard()
+            raise
+
+
+def db_session():
+    """Connection for reads. Raises DatabaseUnavailable (a MySQLError) if none can be checked out."""
+    return DbSession()
+
+def db_transaction():
+    """Connection with an open transaction, committed when the block ends normally."""
+    return DbSession(transactional=True)
+
+# Row mappers
+
+def json_value(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+def map_row(row):
+    """Generic mapper: dates and datetimes become ISO 8601 strings."""
+    return {key: json_value(value) for key, value in row.items()}
+
 # JSON-based functions load_orders and save_orders are now removed.
 
+# --- Tracking numbers ---
+# Tracking numbers are TRK + an 8-digit sequence number + a Luhn check digit, e.g. TRK000012344.
+# Each worker reserves a block of TRACK_NUMBER_BLOCK_SIZE sequence numbers with one atomic
+# UPDATE on the `sequences` table and hands them out from memory, so numbers are unique
+# across processes without a query or insert-retry per order. Numbers left in a block when
+# a worker stops are simply skipped.
+# Orders created before this scheme use TRK + yymmdd + 4 random digits (13 characters);
+# those stay trackable, they just have no check digit.
+TRACK_NUMBER_PREFIX = 'TRK'
+TRACK_NUMBER_SEQUENCE = 'track_number'
+
+def luhn_check_digit(digits):
+    """Returns the Luhn check digit for a string of digits."""
+    total = 0
+    for i, ch in enumerate(reversed(digits)):
+        d = int(ch)
+        if i % 2 == 0: # Every second digit from the right, starting with the rightmost
+            d *= 2
+            if d > 9:
+                d -= 9
+        total += d
+    return str((10 - total % 10) % 10)
+
+def format_track_number(sequence_value):
+    digits = f"{sequence_value:08d}"
+    return f"{TRACK_NUMBER_PREFIX}{digits}{luhn_check_digit(digits)}"
+
+def is_plausible_track_number(code):
+    """Cheap offline check that rejects most typos before any database lookup."""
+    digits = code[len(TRACK_NUMBER_PREFIX):]
+    if not code.startswith(TRACK_NUMBER_PREFIX) or len(digits) < 6 or not digits.isdigit():
+        return False
+    if len(digits) == 10 and digits[:6].isdigit():
+        return True # Legacy TRK+yymmdd+4 digits format, no check digit
+    return luhn_check_digit(digits[:-1]) == digits[-1]
+
+# LAST_INSERT_ID(expr) hands the new value back on this connection only, and the row
+# lock serialises concurrent reservations from every process.
+named_query('sequences.reserve', "UPDATE sequences SET next_value = LAST_INSERT_ID(next_value + %s) WHERE name = %s")
+named_query('sequences.create', "INSERT IGNORE INTO sequences (name, next_value) VALUES (%s, 1)")
+named_query('sequences.reserved_end', "SELECT LAST_INSERT_ID() AS block_end")
+
+def reserve_sequence_block(name, size):
+    """Atomically reserves `size` values from the named sequence. Returns the first value or None."""
+    try:
+        with db_transaction() as db:
+            if db.execute('sequences.reserve', (size, name)).rowcount == 0:
+                db.execute('sequences.create', (name,))
+                db.execute('sequences.reserve', (size, name))
+            block_end = db.fetchone('sequences.reserved_end')['block_end']
+        logger.info(f"Reserved '{name}' sequence block {block_end - size}-{block_end - 1}.")
+        return block_end - size
+    except MySQLError as e:
+        logger.error(f"Error reserving '{name}' sequence block: {e}")
+        return None
+
+
+class TrackNumberAllocator:
+    """Hands out tracking numbers from sequence blocks reserved in MySQL."""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def allocate(self):
+        """Returns the next tracking number, or None if a new block could not be reserved."""
+        with self._lock:
+            # A block reserved before a fork would be shared by every child worker
+            if self._next >= self._end or self._pid != os.getpid():
+                start = reserve_sequence_block(TRACK_NUMBER_SEQUENCE, self.block_size)
+                if start is None:
+                    return None
+                self._next, self._end, self._pid = start, start + self.block_size, os.getpid()
+            value = self._next
+            self._next += 1
+        return format_track_number(value)
+
+track_number_allocator = TrackNumberAllocator(Config.TRACK_NUMBER_BLOCK_SIZE)
+
 def generate_track_number():
-    """Generate a unique tracking number"""
-    timestamp = datetime.now().strftime("%y%m%d")
-    random_part = ''.join(random.choices(string.digits, k=4))
-    return f'TRK{timestamp}{random_part}'
+    """Generate a unique tracking number (None if no sequence block is available)"""
+    return track_number_allocator.allocate()
 
 def generate_phone_number():
     """Generate a random Tanzanian phone number"""
@@ -244,106 +1032,257 @@ def generate_phone_number():
     remaining = ''.join(random.choices(string.digits, k=6))
     return prefix + remaining
 
-def get_transporter_details():
-    """Get random transporter details"""
-    transporters = [
-        {"name": "Juma Mwalimu", "phone": generate_phone_number(), "rating": "4.8/5"},
-        {"name": "Fatuma Hassan", "phone": generate_phone_number(), "rating": "4.9/5"},
-        {"name": "Mohamed Ally", "phone": generate_phone_number(), "rating": "4.7/5"},
-        {"name": "Grace Mapunda", "phone": generate_phone_number(), "rating": "4.6/5"},
-        {"name": "John Msigwa", "phone": generate_phone_number(), "rating": "4.8/5"},
-        {"name": "Amina Rashid", "phone": generate_phone_number(), "rating": "4.9/5"},
-        {"name": "Peter Kikwete", "phone": generate_phone_number(), "rating": "4.7/5"},
-        {"name": "Salma Juma", "phone": generate_phone_number(), "rating": "4.8/5"},
-        {"name": "Hassan Mwenda", "phone": generate_phone_number(), "rating": "4.6/5"},
-        {"name": "Neema Shayo", "phone": generate_phone_number(), "rating": "4.9/5"}
-    ]
-    return random.choice(transporters)
-
 # --- Helper functions for dynamic USSD choices ---
-def get_active_crops_for_ussd():
-    """Fetches active crops from the database for USSD menu display."""
-    conn = None
-    cursor = None
+
+# Crops and locations change rarely but are read on almost every USSD step, so they
+# are kept in memory and reloaded when CATALOG_CACHE_TTL expires or when an admin
+# handler changes them. Every reload gets a new version number, so anything derived
+# from a snapshot can tell whether it is still current.
+# Invalidation only reaches the current process; with several workers the TTL
+# bounds how long another worker can serve an outdated list.
+catalog_lock = threading.Lock()
+catalog_snapshot = None # Replaced as a whole, never mutated in place
+catalog_version = 0
+
+named_query('catalog.crops', "SELECT id, name FROM crops WHERE is_active = TRUE ORDER BY name")
+named_query('catalog.locations', "SELECT id, name, type FROM locations WHERE is_active = TRUE ORDER BY name")
+
+def load_catalog_from_db():
+    """Fetches active crops and locations for the USSD menus using a single connection."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("Failed to get DB connection for fetching crops.")
-            return [] # Return empty list on error
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, name FROM crops WHERE is_active = TRUE ORDER BY name")
-        crops = cursor.fetchall()
-        return crops # List of dicts e.g. [{'id': 1, 'name': 'Mahindi'}]
+        with db_session() as db:
+            crops = db.fetchall('catalog.crops')
+            locations = db.fetchall('catalog.locations')
+        pickup = tuple(loc for loc in locations if loc['type'] in ('pickup', 'both'))
+        destination = tuple(loc for loc in locations if loc['type'] in ('destination', 'both'))
+        return {
+            'crops': tuple(crops), # e.g. ({'id': 1, 'name': 'Mahindi'}, ...)
+            'locations': tuple(locations),
+            'pickup': pickup,
+            'destination': destination,
+            # Lookups by ID, for validating selections without a query
+            'crops_by_id': {crop['id']: crop for crop in crops},
+            'pickup_by_id': {loc['id']: loc for loc in pickup},
+            'destination_by_id': {loc['id']: loc for loc in destination},
+        }
     except MySQLError as e:
-        logger.error(f"Error fetching active crops: {e}")
-        return []
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        logger.error(f"Error loading USSD catalog: {e}")
+        return None
+
+def get_catalog():
+    """
+    Returns the current catalog snapshot, reloading it from MySQL if it is missing or expired.
+    The snapshot is a dict with 'version', 'loaded_at', 'crops', 'locations', 'pickup' and 'destination',
+    plus 'crops_by_id', 'pickup_by_id' and 'destination_by_id' lookups.
+    """
+    global catalog_snapshot, catalog_version
+    snapshot = catalog_snapshot
+    if snapshot and time.monotonic() - snapshot['loaded_at'] < Config.CATALOG_CACHE_TTL:
+        return snapshot
+
+    with catalog_lock:
+        # Another thread may have reloaded while we waited for the lock
+        snapshot = catalog_snapshot
+        if snapshot and time.monotonic() - snapshot['loaded_at'] < Config.CATALOG_CACHE_TTL:
+            return snapshot
+
+        loaded = load_catalog_from_db()
+        if loaded is None:
+            if snapshot:
+                logger.warning("Serving stale USSD catalog, reload from database failed.")
+                return snapshot
+            return {'version': catalog_version, 'loaded_at': 0.0,
+                    'crops': (), 'locations': (), 'pickup': (), 'destination': (),
+                    'crops_by_id': {}, 'pickup_by_id': {}, 'destination_by_id': {}}
+
+        catalog_version += 1
+        rendered_menu_cache.clear()
+        loaded['version'] = catalog_version
+        loaded['loaded_at'] = time.monotonic()
+        catalog_snapshot = loaded
+        logger.info(f"USSD catalog loaded (version {catalog_version}): {len(loaded['crops'])} crops, {len(loaded['locations'])} locations.")
+        return loaded
+
+def invalidate_catalog_cache():
+    """Drops the cached catalog so the next USSD request reloads it. Call after crops/locations change."""
+    global catalog_snapshot, catalog_version
+    with catalog_lock:
+        catalog_snapshot = None
+        catalog_version += 1
+        rendered_menu_cache.clear()
+    tracking_cache.clear() # Rendered tracking results include crop and location names
+    logger.debug("USSD catalog cache invalidated.")
+
+def get_active_crops_for_ussd():
+    """Returns active crops for USSD menu display (served from the catalog cache)."""
+    return get_catalog()['crops']
 
 def get_active_locations_for_ussd(location_type_filter=None):
     """
-    Fetches active locations from the database for USSD menu display.
-    location_type_filter can be 'pickup' or 'destination'.
-    If None, fetches all 'both' or specific types if needed broadly.
-    For USSD, we usually fetch specific types.
+    Returns active locations for USSD menu display (served from the catalog cache).
+    location_type_filter can be 'pickup' or 'destination'; both include locations of type 'both'.
+    If None, all active locations are returned.
     """
-    conn = None
-    cursor = None
-    try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("Failed to get DB connection for fetching locations.")
-            return []
-        cursor = conn.cursor(dictionary=True)
+    catalog = get_catalog()
+    if location_type_filter == 'pickup':
+        return catalog['pickup']
+    elif location_type_filter == 'destination':
+        return catalog['destination']
+    return catalog['locations']
+
+# --- USSD session store ---
+# The gateway only sends the accumulated `text`, so without server-side state every
+# step would have to re-fetch the lists shown earlier to map "2" back to an ID. The
+# session keeps a snapshot of each list exactly as it was displayed instead.
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire `ttl` seconds after being set."""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False) # Evict least recently used
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 4) if lookups else None,
+        }
 
-        sql = "SELECT id, name, type FROM locations WHERE is_active = TRUE "
-        params = []
-        if location_type_filter == 'pickup':
-            sql += "AND (type = 'pickup' OR type = 'both') "
-        elif location_type_filter == 'destination':
-            sql += "AND (type = 'destination' OR type = 'both') "
-        # else, could fetch all active if needed, or raise error for invalid filter
-
-        sql += "ORDER BY name"
-        cursor.execute(sql, tuple(params))
-        locations = cursor.fetchall()
-        return locations # List of dicts e.g. [{'id':1, 'name':'Mbeya Mjini', 'type':'both'}]
-    except MySQLError as e:
-        logger.error(f"Error fetching active locations (type: {location_type_filter}): {e}")
-        return []
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
-def get_entity_by_id(entity_type, entity_id):
-    """Generic function to fetch entity name by ID for confirmation messages."""
-    conn = None
-    cursor = None
-    table_name = ""
-    if entity_type == "crop":
-        table_name = "crops"
-    elif entity_type == "location":
-        table_name = "locations"
-    elif entity_type == "transporter":
-        table_name = "transporters"
-    else:
-        return None
+class MemorySessionStore:
+    """Keeps USSD sessions in process memory (LRU + TTL). Sessions are not shared between workers."""
 
-    try:
-        conn = get_db_connection()
-        if conn is None: return None
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(f"SELECT name FROM {table_name} WHERE id = %s", (entity_id,))
-        result = cursor.fetchone()
-        return result['name'] if result else None
-    except MySQLError as e:
-        logger.error(f"Error fetching {entity_type} with ID {entity_id}: {e}")
-        return None
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+    def __init__(self, max_entries, ttl):
+        self._cache = TTLCache(max_entries, ttl)
+
+    def get(self, session_id):
+        return self._cache.get(session_id)
+
+    def save(self, session_id, session):
+        self._cache.set(session_id, session)
+
+    def delete(self, session_id):
+        self._cache.delete(session_id)
+
+
+class SQLiteSessionStore:
+    """Keeps USSD sessions in a local SQLite file so every worker process on the host sees them."""
+
+    PURGE_EVERY = 1000 # Remove expired rows once per this many saves
 
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        self._saves = 0
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS ussd_sessions ("
+            " session_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # One connection per thread; autocommit since every statement stands alone
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def get(self, session_id):
+        row = self._db().execute(
+            "SELECT data FROM ussd_sessions WHERE session_id = ? AND expires_at > ?",
+            (session_id, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, session_id, session):
+        db = self._db()
+        db.execute(
+            "INSERT OR REPLACE INTO ussd_sessions (session_id, data, expires_at) VALUES (?, ?, ?)",
+            (session_id, json.dumps(session), time.time() + self.ttl)
+        )
+        self._saves += 1
+        if self._saves % self.PURGE_EVERY == 0:
+            db.execute("DELETE FROM ussd_sessions WHERE expires_at <= ?", (time.time(),))
+
+    def delete(self, session_id):
+        self._db().execute("DELETE FROM ussd_sessions WHERE session_id = ?", (session_id,))
+
+
+def create_session_store():
+    """Builds the session store selected by USSD_SESSION_BACKEND."""
+    backend = Config.USSD_SESSION_BACKEND
+    if backend == 'sqlite':
+        return SQLiteSessionStore(Config.USSD_SESSION_DB_PATH, Config.USSD_SESSION_TTL)
+    if backend != 'memory':
+        logger.warning(f"Unknown USSD_SESSION_BACKEND '{backend}', falling back to 'memory'.")
+    return MemorySessionStore(Config.USSD_SESSION_MAX_ENTRIES, Config.USSD_SESSION_TTL)
+
+session_store = create_session_store()
+
+def resolve_menu_choice(session, menu_name, choice_str):
+    """
+    Maps a 1-based menu choice back to the item that was displayed at that position.
+    Uses the session snapshot when there is one, otherwise the current catalog.
+    Returns None for out-of-range choices; raises ValueError if the choice is not a number.
+    """
+    items = session.get('menus', {}).get(menu_name)
+    if items is None:
+        if menu_name == 'crops':
+            items = get_active_crops_for_ussd()
+        else:
+            items = get_active_locations_for_ussd(location_type_filter=menu_name)
+    index = int(choice_str) - 1
+    if 0 <= index < len(items):
+        return items[index]
+    return None
 
 def is_valid_quantity(quantity_str):
     """Validate quantity input"""
@@ -353,146 +1292,1076 @@ def is_valid_quantity(quantity_str):
     except:
         return False
 
-def save_order(track_number, order_data):
-    """Save order to MySQL database"""
-    conn = None
-    cursor = None
+INITIAL_ORDER_STATUS = 'Ombi limepokelewa na Msafirishaji atawasiliana na wewe hivi karibuni'
+
+def order_row_values(track_number, order_data, current_time=None):
+    """Returns the values of ORDER_INSERT_COLUMNS for one order; order_insert_params() turns them into ORDER_INSERT_SQL parameters."""
+    # The old text fields (crop, pickup_location etc.) are populated alongside the IDs while orders has them.
+    current_time = current_time or datetime.now()
+    transporter_details = order_data.get('transporter') or {}
+
+    return (
+        track_number,
+        order_data.get('phone_number'),
+        order_data.get('crop_id'),  # New field
+        order_data.get('crop'), # Old field
+        order_data.get('quantity'),
+        order_data.get('pickup_location_id'), # New field
+        order_data.get('pickup_location'), # Old field
+        order_data.get('destination_location_id'), # New field
+        order_data.get('destination_location'), # Old field
+        transporter_details.get('id'), # New: ID of the selected transporter
+        transporter_details.get('name'), # Old field
+        transporter_details.get('phone'), # Old field
+        transporter_details.get('rating'),# Old field
+        INITIAL_ORDER_STATUS,
+        current_time, # created_at
+        current_time  # status_updated_at
+    )
+
+ORDER_INSERT_COLUMNS = (
+    'track_number', 'phone_number', 'crop_id', 'crop', 'quantity',
+    'pickup_location_id', 'pickup_location', 'destination_location_id', 'destination_location',
+    'transporter_id', 'transporter_name', 'transporter_phone', 'transporter_rating',
+    'status', 'created_at', 'status_updated_at',
+)
+# Names copied into each order before the *_id columns existed. They are only read and written
+# while orders still has them (see use_order_columns); `flask backfill-order-fks` fills the ids
+# from them and `flask drop-legacy-order-columns` removes them.
+LEGACY_ORDER_COLUMNS = ('crop', 'pickup_location', 'destination_location',
+                        'transporter_name', 'transporter_phone', 'transporter_rating')
+legacy_order_columns = frozenset(LEGACY_ORDER_COLUMNS) # Those in use, until the table has been inspected
+
+def order_insert_sql(legacy_columns):
+    columns = [column for column in ORDER_INSERT_COLUMNS
+               if column not in LEGACY_ORDER_COLUMNS or column in legacy_columns]
+    return f"INSERT INTO orders ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+
+ORDER_INSERT_SQL = named_query('orders.insert', order_insert_sql(legacy_order_columns))
+
+def order_insert_params(row):
+    """ORDER_INSERT_SQL parameters for an order_row_values() tuple."""
+    if len(legacy_order_columns) == len(LEGACY_ORDER_COLUMNS):
+        return row
+    return tuple(value for column, value in zip(ORDER_INSERT_COLUMNS, row)
+                 if column not in LEGACY_ORDER_COLUMNS or column in legacy_order_columns)
+
+def insert_orders(db, orders):
+    """
+    Inserts several (track_number, order_data, created_at) orders in the caller's DbSession and
+    counts them in the daily rollup. executemany() sends each as a single multi-row INSERT.
+    Returns the order_row_values() tuples, for new_order_events() once committed.
+    """
+    rows = [order_row_values(*order) for order in orders]
+    db.executemany(ORDER_INSERT_SQL, [order_insert_params(row) for row in rows])
+    add_order_stats(db, new_order_stats(rows))
+    return rows
+
+# --- Daily order rollup ---
+# orders_daily_stats holds order counts and bag totals per day, status, crop, pickup and
+# destination, so the reports read a few rows per day instead of scanning orders. Every write
+# to orders updates it in the same transaction: inserts add 1 to the order's row, a status
+# change moves 1 from the old status row to the new one. Missing ids are stored as 0 and a
+# missing status as '' (both are part of the primary key). `flask rebuild-order-stats`
+# recomputes it from orders, e.g. after changing orders by hand.
+
+ORDER_STATS_UPSERT_SQL = """
+INSERT INTO orders_daily_stats (stat_date, status, crop_id, pickup_location_id, destination_location_id, order_count, quantity_total)
+VALUES (%s, %s, %s, %s, %s, %s, %s)
+ON DUPLICATE KEY UPDATE order_count = order_count + VALUES(order_count), quantity_total = quantity_total + VALUES(quantity_total)
+"""
+
+def order_stats_key(order):
+    """The orders_daily_stats row `order` (a dict of orders columns) counts towards, or None without created_at."""
+    if order['created_at'] is None:
+        return None # Not counted; rebuild_order_stats() skips such orders too
+    return (order['created_at'].date(), order['status'] or '', order['crop_id'] or 0,
+            order['pickup_location_id'] or 0, order['destination_location_id'] or 0)
+
+def new_order_stats(rows):
+    """Rollup changes for order_row_values() tuples."""
+    orders = [dict(zip(ORDER_INSERT_COLUMNS, row)) for row in rows]
+    return [(order_stats_key(order), 1, order['quantity']) for order in orders]
+
+def moved_order_stats(order, **changes):
+    """Rollup changes for changing some rollup columns of `order` (a dict with the rollup columns and quantity)."""
+    return [(order_stats_key(order), -1, -(order['quantity'] or 0)),
+            (order_stats_key(dict(order, **changes)), 1, order['quantity'])]
+
+def status_change_stats(order, new_status):
+    """Rollup changes for moving `order` to `new_status`."""
+    return moved_order_stats(order, status=new_status)
+
+def add_order_stats(cursor, changes):
+    """
+    Applies (key, order_count, quantity) changes to orders_daily_stats with the caller's cursor
+    (or DbSession), inside the caller's transaction. Changes to the same row are summed first
+    and rows are written in key order, so concurrent writers lock them in the same order.
+    """
+    totals = {}
+    for key, count, quantity in changes:
+        if key is None:
+            continue
+        total_count, total_quantity = totals.get(key, (0, 0))
+        totals[key] = (total_count + count, total_quantity + (quantity or 0))
+    rows = [key + totals[key] for key in sorted(totals) if totals[key] != (0, 0)]
+    if rows:
+        cursor.executemany(ORDER_STATS_UPSERT_SQL, rows)
+
+def detach_order_stats(db, columns, entity_id):
+    """
+    Moves the rollup rows of a crop or location just deleted in the caller's transaction to id 0,
+    as ON DELETE SET NULL did to its orders. `columns` are the rollup key columns that referred
+    to it. Run after the DELETE, whose lock keeps new orders from referring to it meanwhile.
+    """
+    keys = [f"IF({column} = %s, 0, {column})" if column in columns else column
+            for column in ('crop_id', 'pickup_location_id', 'destination_location_id')]
+    where = " OR ".join(f"{column} = %s" for column in columns)
+    params = (entity_id,) * (2 * len(columns))
+    db.execute(f"""
+        INSERT INTO orders_daily_stats (stat_date, status, crop_id, pickup_location_id, destination_location_id, order_count, quantity_total)
+        SELECT stat_date, status, {', '.join(keys)}, order_count, quantity_total
+        FROM orders_daily_stats
+        WHERE {where}
+        ON DUPLICATE KEY UPDATE order_count = order_count + VALUES(order_count), quantity_total = quantity_total + VALUES(quantity_total)
+    """, params)
+    db.execute(f"DELETE FROM orders_daily_stats WHERE {where}", (entity_id,) * len(columns))
+
+def rebuild_order_stats(db, since=None):
+    """
+    Recomputes orders_daily_stats from orders for days from `since` on (all days if None), in the
+    caller's transaction. INSERT ... SELECT locks the orders rows it reads, so order writes wait
+    for the rebuild instead of being lost from it. Returns the number of rollup rows written.
+    """
+    where = "WHERE created_at >= %s" if since else "WHERE created_at IS NOT NULL"
+    params = (since,) if since else ()
+    db.execute("DELETE FROM orders_daily_stats" + (" WHERE stat_date >= %s" if since else ""), params)
+    return db.execute(f"""
+        INSERT INTO orders_daily_stats (stat_date, status, crop_id, pickup_location_id, destination_location_id, order_count, quantity_total)
+        SELECT DATE(created_at), COALESCE(status, ''), COALESCE(crop_id, 0), COALESCE(pickup_location_id, 0),
+               COALESCE(destination_location_id, 0), COUNT(*), COALESCE(SUM(quantity), 0)
+        FROM orders
+        {where}
+        GROUP BY 1, 2, 3, 4, 5
+    """, params).rowcount
+
+# --- Transporter assignment ---
+# Transporters are kept in an in-memory index so assigning one to an order needs no query.
+# A full reload (which also recounts open orders) runs every TRANSPORTER_INDEX_FULL_RELOAD
+# seconds; in between, only rows whose updated_at moved are fetched. The pick itself is
+# delegated to a pluggable strategy that keeps its own structure up to date.
+
+def parse_rating(rating):
+    """Turns a rating such as '4.8/5' or '4.8' into an integer weight (rating x 100, at least 1)."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error("Failed to get DB connection for saving order.")
-            return False
-        cursor = conn.cursor()
+        return max(int(float(str(rating).split('/')[0]) * 100), 1)
+    except (TypeError, ValueError):
+        return 100 # Unrated transporters weigh like a 1.0 rating
+
+
+class FenwickTree:
+    """Integer weights per slot with O(log n) updates and O(log n) lookup by cumulative weight."""
+
+    def __init__(self, size):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        self.weights = [0] * size
+        self.total = 0
+
+    def set(self, slot, weight):
+        delta = weight - self.weights[slot]
+        self.weights[slot] = weight
+        self.total += delta
+        i = slot + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, target):
+        """Returns the slot whose cumulative weight range contains `target` (0 <= target < total)."""
+        pos = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt] <= target:
+                pos = nxt
+                target -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+
+class LeastActiveOrdersStrategy:
+    """Picks the transporter with the fewest open orders; ties go to the lowest id. O(log n)."""
+
+    def __init__(self):
+        self.heap = [] # (open_orders, transporter_id); outdated entries are skipped lazily
+
+    def rebuild(self, index):
+        self.heap = [(index.active_orders.get(tid, 0), tid) for tid in index.transporters]
+        heapq.heapify(self.heap)
+
+    def upsert(self, index, tid):
+        heapq.heappush(self.heap, (index.active_orders.get(tid, 0), tid))
+
+    def remove(self, index, tid):
+        pass # Its heap entries no longer match a known transporter and get dropped on pick
+
+    def load_changed(self, index, tid):
+        heapq.heappush(self.heap, (index.active_orders.get(tid, 0), tid))
+        if len(self.heap) > 4 * len(index.transporters) + 64:
+            self.rebuild(index) # Compact accumulated outdated entries
+
+    def pick(self, index, pickup_location_id):
+        heap = self.heap
+        while heap:
+            count, tid = heap[0]
+            if tid in index.transporters and index.active_orders.get(tid, 0) == count:
+                return tid
+            heapq.heappop(heap)
+        return None
 
-        sql = """
-        INSERT INTO orders (
-            track_number, phone_number,
-            crop_id, crop,
-            quantity,
-            pickup_location_id, pickup_location,
-            destination_location_id, destination_location,
-            transporter_id, transporter_name, transporter_phone, transporter_rating,
-            status, created_at, status_updated_at
-        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        # The USSD callback will eventually need to provide these IDs.
-        # For now, they might be None if old USSD logic is still partially active.
-        # The old text fields (crop, pickup_location etc.) are still populated from order_data.
-
-        current_time = datetime.now()
-        transporter_details = order_data.get('transporter', {})
-
-        data_tuple = (
-            track_number,
-            order_data.get('phone_number'),
-            order_data.get('crop_id'),  # New field
-            order_data.get('crop'), # Old field
-            order_data.get('quantity'),
-            order_data.get('pickup_location_id'), # New field
-            order_data.get('pickup_location'), # Old field
-            order_data.get('destination_location_id'), # New field
-            order_data.get('destination_location'), # Old field
-            transporter_details.get('id'), # New: ID of the selected transporter
-            transporter_details.get('name'), # Old field
-            transporter_details.get('phone'), # Old field
-            transporter_details.get('rating'),# Old field
-            'Ombi limepokelewa na Msafirishaji atawasiliana na wewe hivi karibuni', # Initial status
-            current_time, # created_at
-            current_time  # status_updated_at
-        )
 
-        cursor.execute(sql, data_tuple)
-        conn.commit()
-        logger.info(f"Order {track_number} saved successfully to MySQL.")
+class RoundRobinStrategy:
+    """Rotates through all transporters, with a separate position per pickup location. O(1)."""
+
+    def __init__(self):
+        self.ids = []
+        self.positions = {} # pickup_location_id -> number of picks made there
+
+    def rebuild(self, index):
+        self.ids = sorted(index.transporters)
+
+    def upsert(self, index, tid):
+        i = bisect.bisect_left(self.ids, tid)
+        if i == len(self.ids) or self.ids[i] != tid:
+            self.ids.insert(i, tid)
+
+    def remove(self, index, tid):
+        i = bisect.bisect_left(self.ids, tid)
+        if i < len(self.ids) and self.ids[i] == tid:
+            del self.ids[i]
+
+    def load_changed(self, index, tid):
+        pass
+
+    def pick(self, index, pickup_location_id):
+        if not self.ids:
+            return None
+        # Start each location at a different offset so they don't all begin with the same transporter
+        position = self.positions.get(pickup_location_id, pickup_location_id or 0)
+        self.positions[pickup_location_id] = position + 1
+        return self.ids[position % len(self.ids)]
+
+
+class RatingWeightedStrategy:
+    """Random pick with probability proportional to rating. O(log n) via a Fenwick tree."""
+
+    def __init__(self):
+        self.tree = FenwickTree(0)
+        self.slots = {} # transporter_id -> slot
+        self.slot_ids = []
+
+    def rebuild(self, index):
+        self.tree = FenwickTree(max(2 * len(index.transporters), 16))
+        self.slots = {}
+        self.slot_ids = []
+        for tid in index.transporters:
+            self.upsert(index, tid)
+
+    def upsert(self, index, tid):
+        weight = parse_rating(index.transporters[tid].get('rating'))
+        slot = self.slots.get(tid)
+        if slot is None:
+            if len(self.slot_ids) == self.tree.size:
+                self.rebuild(index) # Out of slots; rebuild with double the capacity (includes tid)
+                return
+            slot = len(self.slot_ids)
+            self.slots[tid] = slot
+            self.slot_ids.append(tid)
+        self.tree.set(slot, weight)
+
+    def remove(self, index, tid):
+        slot = self.slots.pop(tid, None)
+        if slot is not None:
+            self.tree.set(slot, 0) # Slot stays unused until the next rebuild
+
+    def load_changed(self, index, tid):
+        pass
+
+    def pick(self, index, pickup_location_id):
+        if self.tree.total <= 0:
+            return None
+        return self.slot_ids[self.tree.find(random.randrange(self.tree.total))]
+
+
+ASSIGNMENT_STRATEGIES = {
+    'least_active': LeastActiveOrdersStrategy,
+    'round_robin': RoundRobinStrategy,
+    'rating_weighted': RatingWeightedStrategy,
+}
+
+
+class TransporterIndex:
+    """In-memory transporter index that hands out transporters for new orders."""
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.transporters = {} # id -> {'id', 'name', 'phone', 'rating'}
+        self.active_orders = {} # id -> number of open orders
+        self.high_water = None # Latest transporters.updated_at seen
+        self.refreshed_at = 0.0
+        self.fully_loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def load(self, rows, active_orders):
+        """Replaces the whole index (full reload)."""
+        with self._lock:
+            self.transporters = {row['id']: self._entry(row) for row in rows}
+            self.active_orders = {tid: count for tid, count in active_orders.items() if tid in self.transporters}
+            self.high_water = max((row['updated_at'] for row in rows if row.get('updated_at')), default=None)
+            self.strategy.rebuild(self)
+
+    def apply_changes(self, rows):
+        """Adds or updates the given transporter rows (incremental refresh)."""
+        with self._lock:
+            for row in rows:
+                self.transporters[row['id']] = self._entry(row)
+                self.strategy.upsert(self, row['id'])
+                if row.get('updated_at') and (self.high_water is None or row['updated_at'] > self.high_water):
+                    self.high_water = row['updated_at']
+
+    def remove(self, tid):
+        with self._lock:
+            if self.transporters.pop(tid, None) is not None:
+                self.active_orders.pop(tid, None)
+                self.strategy.remove(self, tid)
+
+    def mark_stale(self):
+        """Forces an incremental refresh before the next pick, e.g. after an admin edit."""
+        self.refreshed_at = 0.0
+
+    def order_opened(self, tid):
+        self._change_load(tid, 1)
+
+    def order_closed(self, tid):
+        self._change_load(tid, -1)
+
+    def _change_load(self, tid, delta):
+        with self._lock:
+            if tid in self.transporters:
+                self.active_orders[tid] = max(self.active_orders.get(tid, 0) + delta, 0)
+                self.strategy.load_changed(self, tid)
+
+    def pick(self, pickup_location_id=None):
+        """Chooses a transporter from the index as it is, counts the new order against them and returns a copy."""
+        with self._lock:
+            tid = self.strategy.pick(self, pickup_location_id)
+            if tid is None:
+                return None
+            self.active_orders[tid] = self.active_orders.get(tid, 0) + 1
+            self.strategy.load_changed(self, tid)
+            return dict(self.transporters[tid])
+
+    def assign(self, pickup_location_id=None):
+        """Refreshes the index if due, then picks a transporter. Returns None if there are none."""
+        self.refresh_if_due()
+        return self.pick(pickup_location_id)
+
+    def refresh_if_due(self):
+        now = time.monotonic()
+        if now - self.refreshed_at < Config.TRANSPORTER_INDEX_REFRESH:
+            return
+        # Before the first load every caller waits; afterwards one thread refreshes while
+        # the others keep picking from the current data.
+        if not self._refresh_lock.acquire(blocking=not self.fully_loaded_at):
+            return
+        try:
+            if time.monotonic() - self.refreshed_at < Config.TRANSPORTER_INDEX_REFRESH:
+                return
+            full = not self.fully_loaded_at or now - self.fully_loaded_at >= Config.TRANSPORTER_INDEX_FULL_RELOAD
+            if refresh_transporter_index(self, full) and full:
+                self.fully_loaded_at = time.monotonic()
+            self.refreshed_at = time.monotonic() # Also after a failure, so an outage isn't retried on every order
+        finally:
+            self._refresh_lock.release()
+
+    @staticmethod
+    def _entry(row):
+        return {'id': row['id'], 'name': row['name'], 'phone': row['phone'], 'rating': row['rating']}
+
+
+def open_orders_query():
+    """(sql, params) counting open orders per transporter; covered by idx_orders_transporter_status."""
+    placeholders = ', '.join(['%s'] * len(Config.CLOSED_ORDER_STATUSES))
+    return (f"SELECT transporter_id, COUNT(*) AS open_orders FROM orders "
+            f"WHERE transporter_id IS NOT NULL AND status NOT IN ({placeholders}) GROUP BY transporter_id",
+            tuple(Config.CLOSED_ORDER_STATUSES))
+
+named_query('transporter_index.all', "SELECT id, name, phone, rating, updated_at FROM transporters")
+# >= because updated_at has one-second resolution; re-applying a row is harmless
+named_query('transporter_index.changed', "SELECT id, name, phone, rating, updated_at FROM transporters WHERE updated_at >= %s")
+
+def refresh_transporter_index(index, full=False):
+    """Loads transporters (and, on a full reload, open order counts) into `index`. Returns True on success."""
+    try:
+        with db_session() as db:
+            if full or index.high_water is None:
+                rows = db.fetchall('transporter_index.all')
+                active_orders = {}
+                if Config.CLOSED_ORDER_STATUSES:
+                    active_orders = {row['transporter_id']: row['open_orders'] for row in db.fetchall(*open_orders_query())}
+                index.load(rows, active_orders)
+                logger.info(f"Transporter index loaded: {len(rows)} transporters.")
+            else:
+                index.apply_changes(db.fetchall('transporter_index.changed', (index.high_water,)))
         return True
     except MySQLError as e:
-        logger.error(f"Error saving order {track_number} to MySQL: {e}")
-        if conn:
-            conn.rollback() # Rollback in case of error
+        logger.error(f"Error refreshing transporter index: {e}")
         return False
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
-            logger.debug("MySQL connection closed after saving order.")
 
-def get_order_status(track_number):
-    """Get order status from MySQL database"""
-    conn = None
-    cursor = None
+def create_transporter_index():
+    """Builds the transporter index with the strategy selected by TRANSPORTER_ASSIGNMENT_STRATEGY."""
+    strategy_name = Config.TRANSPORTER_ASSIGNMENT_STRATEGY
+    if strategy_name not in ASSIGNMENT_STRATEGIES:
+        logger.warning(f"Unknown TRANSPORTER_ASSIGNMENT_STRATEGY '{strategy_name}', falling back to 'least_active'.")
+        strategy_name = 'least_active'
+    return TransporterIndex(ASSIGNMENT_STRATEGIES[strategy_name]())
+
+transporter_index = create_transporter_index()
+
+@app.cli.command('bench-assignment')
+@click.option('--sizes', default='10,100,1000,10000,100000', help='Comma-separated fleet sizes to test.')
+@click.option('--picks', default=20000, type=int, help='Picks to time per strategy and size.')
+def bench_assignment_command(sizes, picks):
+    """Measures transporter pick latency for every strategy as the fleet grows (no database needed)."""
+    click.echo(f"{'strategy':<16} {'transporters':>12} {'mean us':>9} {'p99 us':>9} {'load ms':>9}")
+    for size in (int(s) for s in sizes.split(',')):
+        rows = [{'id': i, 'name': f"Transporter {i}", 'phone': f"07{i:08d}", 'rating': f"{3 + (i % 21) / 10:.1f}/5", 'updated_at': None}
+                for i in range(1, size + 1)]
+        active_orders = {i: i % 7 for i in range(1, size + 1)}
+        for name, strategy_class in ASSIGNMENT_STRATEGIES.items():
+            index = TransporterIndex(strategy_class())
+            started = time.perf_counter()
+            index.load(rows, active_orders)
+            load_ms = (time.perf_counter() - started) * 1000
+            timings = []
+            for n in range(picks):
+                started = time.perf_counter_ns()
+                index.pick(pickup_location_id=n % 50)
+                timings.append(time.perf_counter_ns() - started)
+            timings.sort()
+            mean_us = sum(timings) / len(timings) / 1000
+            p99_us = timings[int(len(timings) * 0.99) - 1] / 1000
+            click.echo(f"{name:<16} {size:>12} {mean_us:>9.2f} {p99_us:>9.2f} {load_ms:>9.1f}")
+
+# --- Order write-behind journal ---
+# With ORDER_WRITE_MODE=write_behind a confirmed USSD order is not inserted during the request.
+# It is appended to a local SQLite journal (WAL, synchronous=FULL, so it is on disk before the
+# farmer sees the confirmation) and a background thread moves journaled orders into MySQL in
+# batches. Whatever is still in the journal after a restart is flushed by the next process.
+# Selections are validated against the in-memory catalog instead of the live tables.
+# Every worker on a host shares the journal file; entries are claimed before they are flushed,
+# and a claim older than CLAIM_TIMEOUT is taken over, so orders of a crashed worker are not lost.
+# A crop, location or transporter deleted after the order was journaled is checked for at flush
+# time (the catalog and transporter index may not have seen the delete yet). Orders that MySQL
+# still rejects are moved to the order_journal_dead_letter table in the same file, with the
+# error, so they cannot hold up the orders behind them.
+
+class OrderJournal:
+    """Durable local journal of confirmed orders that have not reached MySQL yet."""
+
+    CLAIM_TIMEOUT = 60 # Seconds before another worker may flush entries claimed by a stalled one
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS order_journal ("
+            " track_number TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at TEXT NOT NULL,"
+            " claimed_by TEXT, claimed_at REAL)"
+        )
+        self._db().execute(
+            "CREATE TABLE IF NOT EXISTS order_journal_dead_letter ("
+            " track_number TEXT PRIMARY KEY, payload TEXT NOT NULL, created_at TEXT NOT NULL,"
+            " error TEXT NOT NULL, failed_at TEXT NOT NULL)"
+        )
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=FULL") # fsync on every commit
+            self._local.db = db
+        return db
+
+    def append(self, track_number, order_data, created_at):
+        self._db().execute(
+            "INSERT INTO order_journal (track_number, payload, created_at) VALUES (?, ?, ?)",
+            (track_number, json.dumps(order_data), created_at.isoformat())
+        )
+
+    def get(self, track_number):
+        """Returns (order_data, created_at) for a journaled order, or None."""
+        row = self._db().execute(
+            "SELECT payload, created_at FROM order_journal WHERE track_number = ?", (track_number,)
+        ).fetchone()
+        return (json.loads(row[0]), datetime.fromisoformat(row[1])) if row else None
+
+    def claim(self, limit):
+        """Claims up to `limit` of the oldest unclaimed entries for this process, as (track_number, order_data, created_at)."""
+        db = self._db()
+        owner = str(os.getpid())
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "UPDATE order_journal SET claimed_by = ?, claimed_at = ? WHERE track_number IN ("
+                " SELECT track_number FROM order_journal WHERE claimed_by IS NULL OR claimed_at < ?"
+                " ORDER BY rowid LIMIT ?)",
+                (owner, now, now - self.CLAIM_TIMEOUT, limit)
+            )
+            rows = db.execute(
+                "SELECT track_number, payload, created_at FROM order_journal"
+                " WHERE claimed_by = ? AND claimed_at = ? ORDER BY rowid",
+                (owner, now)
+            ).fetchall()
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            db.execute("ROLLBACK")
+            raise
+        return [(track_number, json.loads(payload), datetime.fromisoformat(created_at))
+                for track_number, payload, created_at in rows]
+
+    def remove(self, track_numbers):
+        placeholders = ', '.join(['?'] * len(track_numbers))
+        self._db().execute(f"DELETE FROM order_journal WHERE track_number IN ({placeholders})", track_numbers)
+
+    def release(self, track_numbers):
+        """Returns claimed entries to the journal after a failed flush."""
+        placeholders = ', '.join(['?'] * len(track_numbers))
+        self._db().execute(
+            f"UPDATE order_journal SET claimed_by = NULL, claimed_at = NULL WHERE track_number IN ({placeholders})",
+            track_numbers
+        )
+
+    def dead_letter(self, track_number, error):
+        """Moves an entry that MySQL keeps rejecting to order_journal_dead_letter."""
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "INSERT OR REPLACE INTO order_journal_dead_letter (track_number, payload, created_at, error, failed_at)"
+                " SELECT track_number, payload, created_at, ?, ? FROM order_journal WHERE track_number = ?",
+                (error, datetime.now().isoformat(), track_number)
+            )
+            db.execute("DELETE FROM order_journal WHERE track_number = ?", (track_number,))
+            db.execute("COMMIT")
+        except sqlite3.Error:
+            db.execute("ROLLBACK")
+            raise
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM order_journal").fetchone()[0]
+
+
+# Errors caused by the order itself rather than the connection; retrying the same row won't help
+ORDER_DATA_ERRORS = (mysql.connector.errors.IntegrityError, mysql.connector.errors.DataError)
+
+def existing_order_references(db, orders):
+    """
+    {table: ids that still exist} for the crops, locations and transporters that `orders`
+    (order_data dicts) refer to. The rows are share-locked until the caller's transaction ends,
+    so they cannot be deleted before the orders are inserted.
+    """
+    wanted = {
+        'crops': {order['crop_id'] for order in orders},
+        'locations': {order[column] for order in orders for column in ('pickup_location_id', 'destination_location_id')},
+        'transporters': {(order['transporter'] or {}).get('id') for order in orders},
+    }
+    existing = {}
+    for table, ids in wanted.items():
+        ids = sorted(i for i in ids if i is not None)
+        existing[table] = set()
+        if ids:
+            placeholders = ', '.join(['%s'] * len(ids))
+            rows = db.fetchall(f"SELECT id FROM {table} WHERE id IN ({placeholders}) LOCK IN SHARE MODE", tuple(ids))
+            existing[table] = {row['id'] for row in rows}
+    return existing
+
+def drop_deleted_references(track_number, order_data, existing):
+    """Clears the ids of rows deleted since the order was journaled, as ON DELETE SET NULL would have."""
+    transporter = order_data['transporter'] or {}
+    if transporter.get('id') is not None and transporter['id'] not in existing['transporters']:
+        # Deleted by another worker since the index was refreshed
+        logger.warning(f"Transporter {transporter['id']} of journaled order {track_number} no longer exists, storing it without one.")
+        transporter_index.remove(transporter['id'])
+        order_data['transporter'] = {"name": "N/A", "phone": "N/A", "rating": "N/A", "id": None}
+    for column, table in (('crop_id', 'crops'), ('pickup_location_id', 'locations'), ('destination_location_id', 'locations')):
+        if order_data[column] is not None and order_data[column] not in existing[table]:
+            logger.warning(f"{column} {order_data[column]} of journaled order {track_number} no longer exists, storing it as NULL.")
+            order_data[column] = None
+
+def write_journaled_orders(entries):
+    """
+    Inserts journaled (track_number, order_data, created_at) entries in one transaction, skipping
+    those already in MySQL. Raises MySQLError if the transaction fails.
+    """
+    track_numbers = [entry[0] for entry in entries]
+    with db_transaction() as db:
+        # Orders whose earlier flush committed before their journal entries were removed
+        placeholders = ', '.join(['%s'] * len(track_numbers))
+        existing = {row['track_number'] for row in db.fetchall(
+            f"SELECT track_number FROM orders WHERE track_number IN ({placeholders})", tuple(track_numbers))}
+        new_orders = [entry for entry in entries if entry[0] not in existing]
+        rows = []
+        if new_orders:
+            references = existing_order_references(db, [order_data for _, order_data, _ in new_orders])
+            for track_number, order_data, _ in new_orders:
+                drop_deleted_references(track_number, order_data, references)
+            rows = insert_orders(db, new_orders)
+    if new_orders:
+        status_events.add(new_order_events(rows))
+        invalidate_report_cache()
+    logger.info(f"Flushed {len(new_orders)} journaled orders to MySQL ({len(existing)} already present).")
+
+def flush_order_journal(journal, batch_size):
+    """
+    Moves one batch of journaled orders into MySQL in a single transaction. If the batch is
+    rejected because of its data, the orders are written one at a time and those that still fail
+    are dead-lettered. Returns the number of journal entries processed, or None if the flush failed.
+    """
+    entries = journal.claim(batch_size)
+    if not entries:
+        return 0
+    track_numbers = [entry[0] for entry in entries]
     try:
-        conn = get_db_connection()
-        if conn is None:
-            logger.error(f"Failed to get DB connection for fetching order {track_number}.")
+        write_journaled_orders(entries)
+    except ORDER_DATA_ERRORS as e:
+        logger.warning(f"Batch of {len(entries)} journaled orders was rejected, writing them one at a time: {e}")
+        for position, entry in enumerate(entries):
+            try:
+                write_journaled_orders([entry])
+            except ORDER_DATA_ERRORS as e:
+                logger.error(f"Journaled order {entry[0]} was rejected by MySQL, moved to order_journal_dead_letter: {e}")
+                journal.dead_letter(entry[0], str(e))
+                continue
+            except MySQLError as e:
+                logger.error(f"Error flushing order journal: {e}")
+                journal.release(track_numbers[position:])
+                return None
+            journal.remove([entry[0]])
+        return len(entries)
+    except MySQLError as e:
+        logger.error(f"Error flushing order journal: {e}")
+        journal.release(track_numbers)
+        return None
+    journal.remove(track_numbers)
+    return len(entries)
+
+
+class BackgroundFlusher(abc.ABC):
+    """Background thread that keeps calling flush(), without pausing while full batches come back."""
+
+    thread_name = 'flusher'
+
+    def __init__(self, interval, batch_size):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def ensure_running(self):
+        """Starts the thread if it is not running in this process (threads do not survive a fork)."""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            if self._thread is None:
+                atexit.register(self.stop)
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    @abc.abstractmethod
+    def flush(self):
+        """Writes one batch of up to batch_size items. Returns the number written, or None if it failed."""
+
+    def _run(self):
+        while not self._stop.is_set():
+            processed = self.flush()
+            if processed != self.batch_size: # A full batch means there is a backlog, keep going
+                self._stop.wait(self.interval)
+
+    def stop(self):
+        """Stops the thread and makes a last attempt to flush what is left."""
+        self._stop.set()
+        if self._thread and self._pid == os.getpid():
+            self._thread.join(timeout=self.interval + 5)
+        while self.flush():
+            pass
+
+
+class OrderJournalFlusher(BackgroundFlusher):
+    """Background thread that keeps flushing the order journal into MySQL."""
+
+    thread_name = 'order-journal-flusher'
+
+    def __init__(self, journal, interval, batch_size):
+        super().__init__(interval, batch_size)
+        self.journal = journal
+
+    def flush(self):
+        try:
+            return flush_order_journal(self.journal, self.batch_size)
+        except sqlite3.Error as e:
+            logger.error(f"Error reading the order journal: {e}")
             return None
 
-        # Use a dictionary cursor to easily map column names to values
-        cursor = conn.cursor(dictionary=True)
-
-        # Join with related tables
-        sql = """
-        SELECT
-            o.track_number, o.phone_number, o.quantity, o.status,
-            o.created_at, o.status_updated_at,
-            COALESCE(c.name, o.crop) as crop_name,
-            COALESCE(pl.name, o.pickup_location) as pickup_location_name,
-            COALESCE(dl.name, o.destination_location) as destination_location_name,
-            COALESCE(t.name, o.transporter_name) as transporter_actual_name,
-            COALESCE(t.phone, o.transporter_phone) as transporter_actual_phone,
-            COALESCE(t.rating, o.transporter_rating) as transporter_actual_rating,
-            o.crop_id, o.pickup_location_id, o.destination_location_id, o.transporter_id
-        FROM orders o
-        LEFT JOIN crops c ON o.crop_id = c.id
-        LEFT JOIN locations pl ON o.pickup_location_id = pl.id
-        LEFT JOIN locations dl ON o.destination_location_id = dl.id
-        LEFT JOIN transporters t ON o.transporter_id = t.id
-        WHERE o.track_number = %s
-        """
-        cursor.execute(sql, (track_number,))
-        order_data_raw = cursor.fetchone()
-
-        if order_data_raw:
-            logger.info(f"Order {track_number} fetched successfully from MySQL for USSD.")
-            order_data = dict(order_data_raw) # Make it a mutable dict
-
-            # USSD logic expects 'crop', 'pickup_location', 'destination_location'
-            # and a nested 'transporter' dict.
-            order_data['crop'] = order_data.get('crop_name')
-            order_data['pickup_location'] = order_data.get('pickup_location_name')
-            order_data['destination_location'] = order_data.get('destination_location_name')
-
-            order_data['transporter'] = {
-                'id': order_data.get('transporter_id'), # Keep id if available
-                'name': order_data.get('transporter_actual_name'),
-                'phone': order_data.get('transporter_actual_phone'),
-                'rating': order_data.get('transporter_actual_rating')
-            }
 
-            # Clean up redundant fields from the root of order_data for USSD context
-            for key in ['crop_name', 'pickup_location_name', 'destination_location_name',
-                        'transporter_actual_name', 'transporter_actual_phone', 'transporter_actual_rating',
-                        'crop_id', 'pickup_location_id', 'destination_location_id', 'transporter_id']:
-                order_data.pop(key, None)
-
-            # Convert datetime objects if needed by any part of USSD (usually not directly, but good for consistency)
-            if isinstance(order_data.get('created_at'), datetime):
-                order_data['created_at'] = order_data['created_at'].isoformat()
-            if isinstance(order_data.get('status_updated_at'), datetime):
-                order_data['status_updated_at'] = order_data['status_updated_at'].isoformat()
-            return order_data
-        else:
-            logger.info(f"Order {track_number} not found in MySQL for USSD.")
+def create_order_journal():
+    """Returns (journal, flusher) for ORDER_WRITE_MODE=write_behind, otherwise (None, None)."""
+    mode = Config.ORDER_WRITE_MODE
+    if mode == 'write_behind':
+        journal = OrderJournal(Config.ORDER_JOURNAL_PATH)
+        return journal, OrderJournalFlusher(journal, Config.ORDER_JOURNAL_FLUSH_INTERVAL, Config.ORDER_JOURNAL_BATCH_SIZE)
+    if mode != 'sync':
+        logger.warning(f"Unknown ORDER_WRITE_MODE '{mode}', falling back to 'sync'.")
+    return None, None
+
+order_journal, order_journal_flusher = create_order_journal()
+
+@app.before_request
+def ensure_order_journal_flusher():
+    if order_journal_flusher is not None:
+        order_journal_flusher.ensure_running()
+
+def journal_order(track_number, phone_number, crop_id, quantity, pickup_location_id, destination_location_id, transporter):
+    """
+    Write-behind counterpart of the database part of submit_order(): validates the selections
+    against the catalog snapshot and appends the order to the journal.
+    Raises ValueError if a selection is not valid and sqlite3.Error if the journal is unavailable.
+    """
+    catalog = get_catalog()
+    crop = catalog['crops_by_id'].get(crop_id)
+    pickup = catalog['pickup_by_id'].get(pickup_location_id)
+    destination = catalog['destination_by_id'].get(destination_location_id)
+    if not crop:
+        raise ValueError(f"Crop {crop_id} is not available")
+    if not pickup:
+        raise ValueError(f"Pickup location {pickup_location_id} is not available")
+    if not destination:
+        raise ValueError(f"Destination location {destination_location_id} is not available")
+    if not transporter:
+        transporter = {"name": "N/A", "phone": "N/A", "rating": "N/A", "id": None}
+        logger.warning("No transporter available for USSD order, order will have NULL transporter_id.")
+
+    order_data = {
+        'phone_number': phone_number,
+        'crop_id': crop_id, 'crop': crop['name'],
+        'quantity': quantity,
+        'pickup_location_id': pickup_location_id, 'pickup_location': pickup['name'],
+        'destination_location_id': destination_location_id, 'destination_location': destination['name'],
+        'transporter': transporter
+    }
+    order_journal.append(track_number, order_data, datetime.now())
+    logger.info(f"Order {track_number} journaled for write-behind.")
+    return track_number, order_data
+
+# --- Order status events ---
+# order_status_events keeps every status an order has been in: one row when the order is
+# created and one per status change. Each row also carries the status it replaced and when that
+# one began, so the time spent in a status is read from a single row (see the time-in-status
+# report) instead of pairing it with the order's previous event.
+# Events are recorded once the order write has committed and reach MySQL from an in-process
+# buffer, flushed by a background thread as multi-row INSERTs every ORDER_EVENT_FLUSH_INTERVAL
+# seconds, so order writes don't pay for them. Events still buffered when a process is killed
+# are lost; if MySQL is unavailable they are kept up to ORDER_EVENT_MAX_PENDING.
+
+ORDER_STATUS_EVENT_INSERT_SQL = """
+INSERT INTO order_status_events (track_number, status, changed_at, previous_status, previous_changed_at)
+VALUES (%s, %s, %s, %s, %s)
+"""
+
+def new_order_events(rows):
+    """Status events for order_row_values() tuples: each order entered its status when it was created."""
+    orders = [dict(zip(ORDER_INSERT_COLUMNS, row)) for row in rows]
+    return [(order['track_number'], order['status'], order['created_at'], None, None) for order in orders]
+
+def status_change_event(order, new_status, changed_at):
+    """Status event for moving `order` (a dict with track_number, status and status_updated_at) to `new_status`."""
+    return (order['track_number'], new_status, changed_at, order['status'], order['status_updated_at'])
+
+
+class StatusEventBuffer(BackgroundFlusher):
+    """Status events waiting to be written to order_status_events, and the thread that writes them."""
+
+    thread_name = 'status-event-writer'
+
+    def __init__(self, interval, batch_size, max_pending):
+        super().__init__(interval, batch_size)
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._pending_lock = threading.Lock()
+
+    def add(self, events):
+        with self._pending_lock:
+            self._pending.extend(events)
+            dropped = max(len(self._pending) - self.max_pending, 0)
+            for _ in range(dropped):
+                self._pending.popleft()
+        if dropped:
+            logger.error(f"Status event buffer full, dropped the {dropped} oldest events.")
+        self.ensure_running()
+
+    def flush(self):
+        with self._pending_lock:
+            batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+        if not batch:
+            return 0
+        try:
+            with db_transaction() as db:
+                db.executemany(ORDER_STATUS_EVENT_INSERT_SQL, batch)
+        except MySQLError as e:
+            logger.error(f"Error writing {len(batch)} order status events: {e}")
+            with self._pending_lock:
+                self._pending.extendleft(reversed(batch)) # Retried first on the next flush
             return None
+        invalidate_report_cache() # The time-in-status report reads these
+        return len(batch)
+
+    def __len__(self):
+        return len(self._pending)
+
+
+status_events = StatusEventBuffer(Config.ORDER_EVENT_FLUSH_INTERVAL, Config.ORDER_EVENT_BATCH_SIZE, Config.ORDER_EVENT_MAX_PENDING)
+
+# --- Order submission (USSD final step) ---
+
+# Re-checks the user's selections and the transporter picked from the index against the
+# live tables in a single round trip. A NULL means the row is gone or no longer usable.
+ORDER_SELECTION_SQL = named_query('orders.check_selection', """
+SELECT
+    (SELECT name FROM crops WHERE id = %s AND is_active = TRUE) AS crop_name,
+    (SELECT name FROM locations WHERE id = %s AND is_active = TRUE AND type IN ('pickup', 'both')) AS pickup_location_name,
+    (SELECT name FROM locations WHERE id = %s AND is_active = TRUE AND type IN ('destination', 'both')) AS destination_location_name,
+    (SELECT id FROM transporters WHERE id = %s) AS transporter_id
+""")
+
+def submit_order(phone_number, crop_id, quantity, pickup_location_id, destination_location_id):
+    """
+    Creates an order on a single pooled connection inside one transaction: one query validates
+    the selected IDs and the transporter picked from the index, a second inserts the order.
+    Returns (track_number, order_data) on success and None if the database is unavailable.
+    Raises ValueError if a selection is no longer valid.
+    In write-behind mode the order is journaled instead (see journal_order()).
+    """
+    # Both are taken before checking out the connection, since refilling the index or the
+    # tracking number block may need a connection of its own
+    track_number = generate_track_number()
+    if track_number is None:
+        logger.error("No tracking number available, cannot submit order.")
+        return None
+    transporter = transporter_index.assign(pickup_location_id)
+    if order_journal is not None:
+        try:
+            return journal_order(track_number, phone_number, crop_id, quantity,
+                                 pickup_location_id, destination_location_id, transporter)
+        except ValueError:
+            if transporter: transporter_index.order_closed(transporter['id'])
+            raise
+        except sqlite3.Error as e:
+            logger.error(f"Order journal unavailable, writing order {track_number} directly: {e}")
+    submitted = False
+    try:
+        with db_transaction() as db:
+            selection = db.fetchone('orders.check_selection', (crop_id, pickup_location_id, destination_location_id,
+                                                               transporter['id'] if transporter else None))
+            if not selection['crop_name']:
+                raise ValueError(f"Crop {crop_id} is not available")
+            if not selection['pickup_location_name']:
+                raise ValueError(f"Pickup location {pickup_location_id} is not available")
+            if not selection['destination_location_name']:
+                raise ValueError(f"Destination location {destination_location_id} is not available")
+
+            if transporter and selection['transporter_id'] is None:
+                # Deleted by another worker since the index was refreshed
+                transporter_index.remove(transporter['id'])
+                transporter = None
+            if not transporter:
+                transporter = {"name": "N/A", "phone": "N/A", "rating": "N/A", "id": None}
+                logger.warning("No transporter available for USSD order, order will have NULL transporter_id.")
+
+            order_data = {
+                'phone_number': phone_number,
+                'crop_id': crop_id, 'crop': selection['crop_name'],
+                'quantity': quantity,
+                'pickup_location_id': pickup_location_id, 'pickup_location': selection['pickup_location_name'],
+                'destination_location_id': destination_location_id, 'destination_location': selection['destination_location_name'],
+                'transporter': transporter
+            }
+            row = order_row_values(track_number, order_data)
+            db.execute('orders.insert', order_insert_params(row))
+            add_order_stats(db, new_order_stats([row]))
+        submitted = True
+        status_events.add(new_order_events([row]))
+        invalidate_report_cache()
+        logger.info(f"Order {track_number} submitted successfully.")
+        return track_number, order_data
     except MySQLError as e:
-        logger.error(f"Error fetching order {track_number} from MySQL: {e}")
+        logger.error(f"Error submitting order for {phone_number}: {e}")
         return None
     finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
-            logger.debug(f"MySQL connection closed after fetching order {track_number}.")
+        if not submitted and transporter and transporter.get('id') is not None:
+            transporter_index.order_closed(transporter['id']) # The order was never created
+
+# Every order read goes through this JOIN. The names of related rows come from the live
+# tables, falling back to the text copied into the order when the row is gone, for as long as
+# orders has those legacy columns. Queries built on it are registered with order_query() so
+# they can be rebuilt when the columns in use change.
+ORDER_NAME_COLUMNS = ( # (alias, live column, legacy column)
+    ('crop_name', 'c.name', 'crop'),
+    ('pickup_location_name', 'pl.name', 'pickup_location'),
+    ('destination_location_name', 'dl.name', 'destination_location'),
+    ('transporter_name', 't.name', 'transporter_name'),
+    ('transporter_phone', 't.phone', 'transporter_phone'),
+    ('transporter_rating', 't.rating', 'transporter_rating'),
+)
+
+def order_select_sql(legacy_columns):
+    names = {alias: f"COALESCE({live}, o.{legacy})" if legacy in legacy_columns else live
+             for alias, live, legacy in ORDER_NAME_COLUMNS}
+    return f"""
+SELECT
+    o.track_number, o.phone_number, o.quantity, o.status,
+    o.created_at, o.status_updated_at,
+    o.crop_id, {names['crop_name']} AS crop_name,
+    o.pickup_location_id, {names['pickup_location_name']} AS pickup_location_name,
+    o.destination_location_id, {names['destination_location_name']} AS destination_location_name,
+    o.transporter_id,
+    {names['transporter_name']} AS transporter_name,
+    {names['transporter_phone']} AS transporter_phone,
+    {names['transporter_rating']} AS transporter_rating
+FROM orders o
+LEFT JOIN crops c ON o.crop_id = c.id
+LEFT JOIN locations pl ON o.pickup_location_id = pl.id
+LEFT JOIN locations dl ON o.destination_location_id = dl.id
+LEFT JOIN transporters t ON o.transporter_id = t.id
+"""
+
+ORDER_SELECT = order_select_sql(legacy_order_columns)
+ORDER_QUERIES = {} # name -> what follows ORDER_SELECT
+
+def order_query(name, suffix):
+    """Registers ORDER_SELECT + `suffix` as a named query and returns it."""
+    ORDER_QUERIES[name] = suffix
+    return named_query(name, ORDER_SELECT + suffix)
+
+def use_order_columns(legacy_columns):
+    """Reads and writes only the LEGACY_ORDER_COLUMNS in `legacy_columns` from now on (in this process)."""
+    global legacy_order_columns, ORDER_SELECT, ORDER_INSERT_SQL
+    legacy_order_columns = frozenset(legacy_columns)
+    ORDER_SELECT = order_select_sql(legacy_order_columns)
+    ORDER_INSERT_SQL = named_query('orders.insert', order_insert_sql(legacy_order_columns))
+    for name, suffix in ORDER_QUERIES.items():
+        named_query(name, ORDER_SELECT + suffix)
+
+def legacy_columns_in_table(db):
+    """The LEGACY_ORDER_COLUMNS that the orders table has."""
+    return {row['Field'] for row in db.fetchall("SHOW COLUMNS FROM orders")} & set(LEGACY_ORDER_COLUMNS)
+
+def detect_order_columns():
+    """
+    Uses the legacy columns that orders has (none if ORDER_LEGACY_COLUMNS is 'ignore'). A missing
+    orders table is about to be created without them; on other errors nothing changes.
+    """
+    if Config.ORDER_LEGACY_COLUMNS == 'ignore':
+        present = set()
+    else:
+        try:
+            with db_session() as db:
+                present = legacy_columns_in_table(db)
+        except MySQLError as e:
+            if e.errno != 1146: # ER_NO_SUCH_TABLE
+                logger.error(f"Could not inspect the orders table, assuming the legacy columns are present: {e}")
+                return
+            present = set()
+    use_order_columns(present)
+    if legacy_order_columns:
+        logger.info(f"orders has legacy columns {', '.join(sorted(legacy_order_columns))}; run `flask backfill-order-fks` to retire them.")
+
+order_query('orders.get', "WHERE o.track_number = %s")
+
+def map_order(row):
+    """Order as returned by the admin API, with related entities nested as *_details."""
+    return {
+        'track_number': row['track_number'],
+        'phone_number': row['phone_number'],
+        'quantity': row['quantity'],
+        'status': row['status'],
+        'created_at': json_value(row['created_at']),
+        'status_updated_at': json_value(row['status_updated_at']),
+        'crop_details': {'id': row['crop_id'], 'name': row['crop_name']},
+        'pickup_location_details': {'id': row['pickup_location_id'], 'name': row['pickup_location_name']},
+        'destination_location_details': {'id': row['destination_location_id'], 'name': row['destination_location_name']},
+        'transporter_details': {
+            'id': row['transporter_id'],
+            'name': row['transporter_name'],
+            'phone': row['transporter_phone'],
+            'rating': row['transporter_rating']
+        },
+    }
+
+def map_ussd_order(row):
+    """Order as used by the USSD screens: flat names plus a nested 'transporter' dict."""
+    return {
+        'track_number': row['track_number'],
+        'phone_number': row['phone_number'],
+        'quantity': row['quantity'],
+        'status': row['status'],
+        'created_at': json_value(row['created_at']),
+        'status_updated_at': json_value(row['status_updated_at']),
+        'crop': row['crop_name'],
+        'pickup_location': row['pickup_location_name'],
+        'destination_location': row['destination_location_name'],
+        'transporter': {
+            'id': row['transporter_id'],
+            'name': row['transporter_name'],
+            'phone': row['transporter_phone'],
+            'rating': row['transporter_rating']
+        },
+    }
+
+def get_order_status(track_number):
+    """Get order status from MySQL database"""
+    try:
+        with db_session() as db:
+            order = db.fetchone('orders.get', (track_number,), map_ussd_order)
+    except MySQLError as e:
+        logger.error(f"Error fetching order {track_number} from MySQL: {e}")
+        return None
+    if order:
+        logger.info(f"Order {track_number} fetched successfully from MySQL for USSD.")
+    else:
+        logger.info(f"Order {track_number} not found in MySQL for USSD.")
+    return order
+
+order_query('orders.recent_for_phone', """WHERE o.phone_number = %s
+ORDER BY o.created_at DESC, o.track_number DESC LIMIT %s""")
+
+def get_recent_orders(phone_number, limit):
+    """A customer's latest orders, newest first (reads idx_orders_phone_created). None on a database error."""
+    try:
+        with db_session() as db:
+            return db.fetchall('orders.recent_for_phone', (phone_number, limit), map_ussd_order)
+    except MySQLError as e:
+        logger.error(f"Error fetching recent orders for {phone_number}: {e}")
+        return None
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -503,6 +2372,449 @@ def health_check():
         'service': 'USSD Transport Service'
     })
 
+# --- Order tracking cache ---
+# Farmers re-check the same tracking numbers while waiting for pickup, so the rendered
+# tracking screen is cached per (track number, language). Anything that changes what the
+# screen shows must call invalidate_tracking_cache() (or clear the cache for bulk changes).
+# Not-found results are not cached, so a new order is visible immediately.
+# Invalidation is per process; TRACKING_CACHE_TTL bounds staleness across workers.
+tracking_cache = TTLCache(Config.TRACKING_CACHE_MAX_ENTRIES, Config.TRACKING_CACHE_TTL)
+
+def invalidate_tracking_cache(track_number):
+    for language in USSD_TEXT:
+        tracking_cache.delete((track_number, language))
+
+def get_journaled_order(track_number):
+    """Returns a write-behind order that has not been flushed to MySQL yet, shaped like get_order_status()."""
+    try:
+        journaled = order_journal.get(track_number)
+    except sqlite3.Error as e:
+        logger.error(f"Error reading order {track_number} from the order journal: {e}")
+        return None
+    if not journaled:
+        return None
+    order_data, created_at = journaled
+    order = dict(order_data, track_number=track_number, status=INITIAL_ORDER_STATUS)
+    order['created_at'] = order['status_updated_at'] = created_at.isoformat()
+    return order
+
+def render_tracking_result(track_number, order):
+    db_status = order.get('status', 'Hali haijulikani') # Get status from DB
+    response = f"END HALI YA OMBI: {track_number}\n\n"
+    # Names are None when the related row is gone and orders no longer has the copied names
+    response += f"Zao: {order.get('crop') or 'N/A'}\n"
+    response += f"Kiasi: {order.get('quantity', 'N/A')} Magunia\n"
+    response += f"Kutoka: {order.get('pickup_location') or 'N/A'}\n"
+    response += f"Kwenda: {order.get('destination_location') or 'N/A'}\n"
+    response += f"Hali: {db_status}\n\n"
+    response += "MAELEZO YA MSAFIRISHAJI:\n"
+    response += f"Msafirishaji: {(order.get('transporter') or {}).get('name') or 'N/A'}\n"
+    response += f"Mawasiliano: {(order.get('transporter') or {}).get('phone') or 'N/A'}\n\n"
+    response += "Kwa maelezo zaidi wasiliana na Msafirishaji."
+    return response
+
+def get_tracking_response(track_number, language):
+    """Returns the rendered tracking screen for an order, reading through the tracking cache."""
+    key = (track_number, language)
+    response = tracking_cache.get(key)
+    if response is not None:
+        return response
+
+    order = get_order_status(track_number)
+    if not order and order_journal is not None:
+        order = get_journaled_order(track_number)
+    if not order:
+        response = "END NAMBA HAIJAPATIKANA\n\n"
+        response += "Namba ya ufuatiliaji haipo kwenye mfumo wetu.\n"
+        response += "Tafadhali hakikisha umeweka namba sahihi.\n\n"
+        response += "Asante!"
+        return response
+
+    response = render_tracking_result(track_number, order)
+    tracking_cache.set(key, response)
+    return response
+
+# --- USSD menu engine ---
+# The gateway sends every answer given so far in the session joined with '*'. The text is
+# parsed once into the path of answers still in effect, and the screen to show is found
+# with a single dict lookup on (menu, depth): the main-menu option the path starts with
+# and how many answers it holds. Each screen is a handler registered with @ussd_screen.
+
+USSD_SCREENS = {}
+
+def ussd_screen(menu, depth):
+    """Registers the handler for the screen reached after `depth` answers starting with `menu`."""
+    def register(handler):
+        USSD_SCREENS[(menu, depth)] = handler
+        return handler
+    return register
+
+def parse_ussd_path(text, ignored=(), error_screens=()):
+    """
+    Turns the gateway's accumulated `text` into (path, positions).
+    '0' after another answer means "Rudi Nyuma" and cancels that answer. Answers whose raw
+    position is in `ignored` were rejected and re-prompted, so they are skipped. Those also in
+    `error_screens` were answered with a screen whose only option is "0. Rudi Nyuma"; a '0'
+    right after one just dismisses that screen.
+    `positions` holds the raw position of every answer kept in `path`.
+    """
+    path = []
+    positions = []
+    if not text:
+        return path, positions
+    for position, answer in enumerate(text.split('*')):
+        if position in ignored:
+            continue
+        if answer == '0' and position - 1 in error_screens:
+            continue
+        if answer == '0' and path:
+            path.pop()
+            positions.pop()
+        else:
+            path.append(answer)
+            positions.append(position)
+    return path, positions
+
+
+class UssdRequest:
+    """One parsed USSD request as seen by the screen handlers."""
+
+    def __init__(self, session_id, phone_number, text, session, language=None):
+        self.session_id = session_id
+        self.phone_number = phone_number
+        self.text = text
+        self.session = session
+        self.language = language or Config.USSD_LANGUAGE
+        self.texts = ussd_text(self.language)
+        self.path, self.positions = parse_ussd_path(text, set(session.get('ignored', ())),
+                                                    set(session.get('error_screens', ())))
+
+    def reject_last_answer(self, error_screen=False):
+        """
+        Marks the latest answer as invalid so the re-prompted screen receives the next one.
+        `error_screen` means the rejection is shown on a screen of its own that only offers
+        "0. Rudi Nyuma", which then returns to the screen the answer was given on.
+        """
+        if self.positions:
+            self.session.setdefault('ignored', []).append(self.positions[-1])
+            if error_screen:
+                self.session.setdefault('error_screens', []).append(self.positions[-1])
+
+
+# Screen texts per language. Static screens are complete responses; the catalog menus
+# are assembled from the *_menu titles by render_catalog_menu().
+USSD_TEXT = {
+    'sw': {
+        'main_menu': (
+            "CON Karibu Huduma ya Usafirishaji wa Mazao\n"
+            "1. Omba Usafiri\n"
+            "2. Fuatilia Ombi\n"
+            "3. Mawasiliano\n"
+            "4. Maombi Yangu\n"
+            "0. Toka"
+        ),
+        'crops_menu': "CHAGUA ZAO UNALOTAKA KUSAFIRISHA:",
+        'crops_invalid': "Chaguo la zao si sahihi. Jaribu tena.",
+        'crops_empty': "END Samahani, hakuna mazao yanayopatikana kwa sasa.",
+        'pickup_menu': "CHAGUA MAHALI PA KUCHUKUA MIZIGO:",
+        'pickup_invalid': "Chaguo la eneo si sahihi. Jaribu tena:",
+        'pickup_empty': "END Samahani, hakuna maeneo ya kuchukua mizigo kwa sasa.",
+        'destination_menu': "CHAGUA MAHALI MZIGO UNAPOENDA:",
+        'destination_invalid': "Chaguo la eneo si sahihi. Jaribu tena:",
+        'destination_empty': "END Samahani, hakuna maeneo ya kupeleka mizigo kwa sasa.",
+        'from_location': "(Kutoka: {name})\n",
+        'back': "0. Rudi Nyuma",
+        'track_prompt': (
+            "CON FUATILIA OMBI LAKO\n\n"
+            "Weka namba ya ufuatiliaji:\n"
+            "(Mfano: TRK000012344)\n\n"
+            "0. Rudi Nyuma"
+        ),
+        'track_invalid': (
+            "CON NAMBA SI SAHIHI\n\n"
+            "Namba ya ufuatiliaji si sahihi.\n"
+            "Tafadhali weka namba sahihi\n"
+            "(Mfano: TRK000012344)\n\n"
+            "0. Rudi Nyuma"
+        ),
+        'my_orders_menu': "MAOMBI YAKO YA KARIBUNI:",
+        'my_orders_invalid': "Chaguo si sahihi. Chagua ombi:",
+        'my_orders_empty': (
+            "END HAKUNA MAOMBI\n\n"
+            "Hakuna maombi yaliyotumwa kwa namba hii ya simu.\n\n"
+            "Asante!"
+        ),
+        'contact': (
+            "END MAWASILIANO YETU\n\n"
+            "Ofisi Kuu - Mbeya:\n"
+            "Simu: +255 25 250 1234\n"
+            "WhatsApp: +255 754 123 456\n"
+            "Barua pepe: info@safirimazao.co.tz\n\n"
+            "Masaa ya kazi:\n"
+            "Jumatatu - Jumamosi: 7:00 - 18:00\n"
+            "Jumapili: 8:00 - 14:00\n\n"
+            "Asante kwa kutumia huduma yetu."
+        ),
+        'exit': (
+            "END ASANTE KWA KUTUMIA HUDUMA YETU\n\n"
+            "Huduma ya usafiridhaji mazao kwa watu wote.\n"
+            "Karibu tena!\n\n"
+            "Kwa huduma zaidi piga: +255 25 250 1234"
+        ),
+        'invalid_choice': (
+            "CON CHAGUO HALIPO\n\n"
+            "Chaguo ulilochagua halipo.\n"
+            "Tafadhali jaribu tena na uchague chaguo sahihi.\n\n"
+            "0. Rudi Nyuma"
+        ),
+    },
+}
+
+def ussd_text(language):
+    """Returns the screen texts for `language`, falling back to Swahili."""
+    return USSD_TEXT.get(language) or USSD_TEXT['sw']
+
+# Rendered catalog menus keyed by (catalog version, language, menu, invalid). Each value is
+# (head, body, items): the response is head + body, with dynamic fragments such as the
+# "(Kutoka: X)" line spliced in between, and `items` is the list to snapshot into the session.
+# Only the current catalog version is kept; the dict is cleared whenever the version changes.
+rendered_menu_cache = {}
+
+def render_catalog_menu(catalog, menu_name, language, invalid=False):
+    """Returns the cached (head, body, items) for a catalog menu, rendering it on first use."""
+    key = (catalog['version'], language, menu_name, invalid)
+    rendered = rendered_menu_cache.get(key)
+    if rendered is None:
+        texts = ussd_text(language)
+        items = catalog[menu_name]
+        if not items:
+            rendered = (texts[f'{menu_name}_empty'], "", ())
+        else:
+            title = texts[f'{menu_name}_invalid'] if invalid else texts[f'{menu_name}_menu']
+            lines = [f"{i+1}. {item['name']}" for i, item in enumerate(items)]
+            body = "\n".join(lines) + "\n\n" + texts['back']
+            rendered = ("CON " + title + "\n", body, [{'id': item['id'], 'name': item['name']} for item in items])
+        rendered_menu_cache[key] = rendered
+    return rendered
+
+def show_catalog_menu(ctx, menu_name, invalid=False, from_location=None):
+    """Renders a crop/pickup/destination menu and snapshots the exact list shown into the session."""
+    head, body, items = render_catalog_menu(get_catalog(), menu_name, ctx.language, invalid)
+    if not items:
+        return head
+    ctx.session.setdefault('menus', {})[menu_name] = items # Shared list, never mutated
+    if from_location is not None:
+        return head + ctx.texts['from_location'].format(name=from_location) + body
+    return head + body
+
+def render_quantity_prompt(crop_name, error=None):
+    response = f"CON {error}\n\n" if error else "CON "
+    response += f"WEKA KIASI CHA {crop_name.upper()}:\n" + ("" if error else "\n")
+    response += "Andika idadi ya magunia\n"
+    response += f"(Kiwango: {Config.MIN_QUANTITY}-{Config.MAX_QUANTITY} magunia)\n\n"
+    response += "0. Rudi Nyuma"
+    return response
+
+def resolve_or_none(ctx, menu_name, choice_str):
+    """resolve_menu_choice() that treats non-numeric input as an invalid choice."""
+    try:
+        return resolve_menu_choice(ctx.session, menu_name, choice_str)
+    except ValueError:
+        return None
+
+
+@ussd_screen('', 0)
+def main_menu_screen(ctx):
+    return ctx.texts['main_menu']
+
+# Option 1: Request Transport
+# Path: 1*<crop_choice>*<quantity>*<pickup_choice>*<destination_choice>
+
+@ussd_screen('1', 1)
+def crop_menu_screen(ctx):
+    return show_catalog_menu(ctx, 'crops')
+
+@ussd_screen('1', 2)
+def quantity_screen(ctx):
+    crop = resolve_or_none(ctx, 'crops', ctx.path[1])
+    if not crop:
+        ctx.reject_last_answer()
+        return show_catalog_menu(ctx, 'crops', invalid=True)
+    return render_quantity_prompt(crop['name'])
+
+@ussd_screen('1', 3)
+def pickup_screen(ctx):
+    crop = resolve_or_none(ctx, 'crops', ctx.path[1])
+    if not crop:
+        return "END Kosa la mfumo (crop index out of bounds). Tafadhali anza upya."
+    if not is_valid_quantity(ctx.path[2]):
+        ctx.reject_last_answer()
+        return render_quantity_prompt(crop['name'], error="KIASI SI SAHIHI!")
+    return show_catalog_menu(ctx, 'pickup')
+
+@ussd_screen('1', 4)
+def destination_screen(ctx):
+    pickup = resolve_or_none(ctx, 'pickup', ctx.path[3])
+    if not pickup:
+        ctx.reject_last_answer()
+        return show_catalog_menu(ctx, 'pickup', invalid=True)
+    return show_catalog_menu(ctx, 'destination', from_location=pickup['name'])
+
+@ussd_screen('1', 5)
+def confirm_order_screen(ctx):
+    crop = resolve_or_none(ctx, 'crops', ctx.path[1])
+    quantity_str = ctx.path[2]
+    pickup = resolve_or_none(ctx, 'pickup', ctx.path[3])
+    if not crop or not pickup:
+        logger.error(f"Could not resolve crop/pickup choices for final order step (text: {ctx.text})")
+        return "END Kosa la mfumo. Tafadhali anza upya."
+
+    destination = resolve_or_none(ctx, 'destination', ctx.path[4])
+    if not destination:
+        ctx.reject_last_answer()
+        return show_catalog_menu(ctx, 'destination', invalid=True, from_location=pickup['name'])
+
+    if pickup['id'] == destination['id']:
+        response = "END MAKOSA - MAHALI NI SAWA\n\n"
+        response += "Mahali pa kuchukua na pa uwasilishaji haviwezi kuwa sawa.\n"
+        response += "Tafadhali chagua maeneo tofauti.\nAsante!"
+        return response
+    if not is_valid_quantity(quantity_str):
+        return "END Kiasi si sahihi. Anza upya."
+
+    try:
+        submitted = submit_order(ctx.phone_number, crop['id'], int(quantity_str), pickup['id'], destination['id'])
+    except ValueError as ve:
+        logger.warning(f"Order selection no longer valid (text: {ctx.text}): {ve}")
+        return "END Samahani, chaguo lako halipatikani tena. Tafadhali anza upya."
+    except Exception as e:
+        logger.error(f"General Exception during final order processing (text: {ctx.text}): {e}", exc_info=True)
+        return "END Samahani, tatizo la kimfumo limetokea. Jaribu tena."
+    if not submitted:
+        return "END Samahani, ombi lako limeshindikana. Jaribu tena."
+    track_number, order = submitted
+    assigned_transporter = order['transporter']
+
+    response = "END UTHIBITISHO - OMBI LIMEPOKELEWA!\n\n"
+    response += f"Zao: {order['crop']}\n"
+    response += f"Kiasi: {order['quantity']} Magunia\n"
+    response += f"Kutoka: {order['pickup_location']}\n"
+    response += f"Kwenda: {order['destination_location']}\n"
+    response += f"Namba ya Ufuatiliaji: {track_number}\n\n"
+    response += f"Msafirishaji: {assigned_transporter.get('name', 'Atathibitishwa')}\n"
+    response += f"Mawasiliano: {assigned_transporter.get('phone', 'Atathibitishwa')}\n"
+    response += "Msafirishaji atawasiliana nawe.\nAsante!"
+    return response
+
+# Option 2: Track Order
+# Path: 2*<track_number>
+
+@ussd_screen('2', 1)
+def track_prompt_screen(ctx):
+    return ctx.texts['track_prompt']
+
+@ussd_screen('2', 2)
+def track_result_screen(ctx):
+    track_input = ctx.path[1].strip().upper()
+
+    if not is_plausible_track_number(track_input):
+        ctx.reject_last_answer()
+        return ctx.texts['track_invalid']
+    return get_tracking_response(track_input, ctx.language)
+
+# Option 3: Contact Information
+@ussd_screen('3', 1)
+def contact_screen(ctx):
+    return ctx.texts['contact']
+
+# Option 4: My Orders
+# Path: 4*<order_choice>
+# Lists the caller's latest orders so a lost tracking number is not a dead end; choosing one
+# shows the same (cached) tracking screen as option 2. Orders still in the write-behind
+# journal appear once they are flushed.
+
+def recent_order_date(order):
+    """dd/mm of an order's creation, or '' for legacy rows without created_at."""
+    return f"{datetime.fromisoformat(order['created_at']):%d/%m}" if order['created_at'] else ''
+
+def show_recent_orders(ctx, invalid=False):
+    """Lists the caller's latest orders and snapshots them into the session."""
+    orders = get_recent_orders(ctx.phone_number, Config.USSD_RECENT_ORDERS)
+    if orders is None:
+        return "END Samahani, tatizo la kimfumo limetokea. Jaribu tena."
+    if not orders:
+        return ctx.texts['my_orders_empty']
+    ctx.session.setdefault('menus', {})['my_orders'] = [order['track_number'] for order in orders]
+    lines = [f"{i+1}. {order['track_number']} {order['crop'] or ''} {recent_order_date(order)}".rstrip()
+             for i, order in enumerate(orders)]
+    title = ctx.texts['my_orders_invalid'] if invalid else ctx.texts['my_orders_menu']
+    return "CON " + title + "\n" + "\n".join(lines) + "\n\n" + ctx.texts['back']
+
+@ussd_screen('4', 1)
+def my_orders_screen(ctx):
+    return show_recent_orders(ctx)
+
+@ussd_screen('4', 2)
+def my_order_result_screen(ctx):
+    track_numbers = ctx.session.get('menus', {}).get('my_orders')
+    if track_numbers is None: # Session snapshot expired; the list is re-read
+        orders = get_recent_orders(ctx.phone_number, Config.USSD_RECENT_ORDERS) or []
+        track_numbers = [order['track_number'] for order in orders]
+    choice = ctx.path[1]
+    if not choice.isdigit() or not 1 <= int(choice) <= len(track_numbers):
+        ctx.reject_last_answer()
+        return show_recent_orders(ctx, invalid=True)
+    return get_tracking_response(track_numbers[int(choice) - 1], ctx.language)
+
+# Option 0: Exit
+@ussd_screen('0', 1)
+def exit_screen(ctx):
+    return ctx.texts['exit']
+
+def invalid_choice_screen(ctx):
+    ctx.reject_last_answer(error_screen=True)
+    return ctx.texts['invalid_choice']
+
+@app.route('/api/cache-stats', methods=['GET'])
+def get_cache_stats():
+    """Counters for the in-process caches. Each worker process reports its own numbers."""
+    catalog = catalog_snapshot
+    return jsonify({
+        'pid': os.getpid(),
+        'tracking': tracking_cache.stats(),
+        'reports': report_cache.stats(),
+        'catalog': {
+            'version': catalog_version,
+            'age_seconds': round(time.monotonic() - catalog['loaded_at'], 1) if catalog else None,
+            'crops': len(catalog['crops']) if catalog else 0,
+            'locations': len(catalog['locations']) if catalog else 0,
+        },
+    }), 200
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        REQUEST_LATENCY.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                request.method, str(response.status_code))
+    return response
+
+@app.route('/api/db-pool-stats', methods=['GET'])
+def get_db_pool_stats():
+    """Live state and counters of this worker's database connection pool."""
+    if not isinstance(db_pool, ConnectionPool):
+        return jsonify({'error': 'Database pool not initialized'}), 503
+    return jsonify(dict(db_pool.stats(), pid=os.getpid())), 200
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request, USSD and database metrics of this worker process in the Prometheus text format."""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/', methods=['POST', 'GET'])
 def ussd_callback():
     """Main USSD callback handler"""
@@ -512,575 +2824,253 @@ def ussd_callback():
         service_code = request.values.get("serviceCode", "")
         phone_number = request.values.get("phoneNumber", "")
         text = request.values.get("text", "")
-        
+
         # Log the request
         logger.info(f"USSD Request - Session: {session_id}, Phone: {phone_number}, Text: '{text}'")
-        
-        response = ""
-        
-        # REMOVE Old Mapping dictionaries - Data will be fetched from DB
-        # crops_dict_hardcoded = {'1': 'Mahindi', '2': 'Viazi', '3': 'Mpunga', '4': 'Zao Jingine'}
-        # locations_dict_hardcoded = { ... }
-
-        # Session cache for dynamic menu items (simple approach)
-        # A more robust session management (e.g. Redis, Flask session) would be better for production
-        # For this example, we'll assume choices are encoded in the 'text' string or re-fetched.
-        # However, to map user's numeric choice back to an ID, we often need to store the list
-        # that was presented. This is a challenge in pure USSD text string.
-        # A common pattern is:
-        # 1. Show menu: 1. ItemA (ID:10), 2. ItemB (ID:25)
-        # 2. User enters '1'. We need to know that '1' maps to ID 10.
-        # The text string becomes e.g., level1_choice*level2_choice_index*level3_choice_index...
-        # Then at each stage, we re-fetch the list shown at previous stage to find the ID.
-
-        # Main Menu
-        if text == '':
-            response = "CON Karibu Huduma ya Usafirishaji wa Mazao\n"
-            response += "1. Omba Usafiri\n"
-            response += "2. Fuatilia Ombi\n"
-            response += "3. Mawasiliano\n"
-            response += "0. Toka"
-        
-        # Option 1: Request Transport - Display list of crops from DB
-        elif text == '1': # User chose "1. Omba Usafiri" from main menu
-            active_crops = get_active_crops_for_ussd()
-            if not active_crops:
-                response = "END Samahani, hakuna mazao yanayopatikana kwa sasa."
-            else:
-                response = "CON CHAGUA ZAO UNALOTAKA KUSAFIRISHA:\n"
-                for i, crop_item in enumerate(active_crops):
-                    # User will choose 1, 2, 3...
-                    # The text input for next stage will be "1*<choice_number>"
-                    # e.g., if user picks 1st crop, next text is "1*1"
-                    response += f"{i+1}. {crop_item['name']}\n"
-                response += "\n0. Rudi Nyuma" # This 0 should lead to text "1*0"
-
-        # User has selected a crop (by index from menu), or chose 0 to go back
-        # Text format: 1*<user_choice_for_crop_OR_0>
-        elif text.startswith('1*') and len(text.split('*')) == 2:
-            parts = text.split('*')
-            crop_menu_choice_str = parts[1]
-
-            if crop_menu_choice_str == '0': # User selected "0. Rudi Nyuma" from Crop Selection menu
-                # Go back to Main Menu
-                response = "CON Karibu Huduma ya Usafirishaji wa Mazao\n"
-                response += "1. Omba Usafiri\n"
-                response += "2. Fuatilia Ombi\n"
-                response += "3. Mawasiliano\n"
-                response += "0. Toka"
-            else:
-                # User selected a crop by its menu number (1-based)
-                try:
-                    crop_choice_idx_from_menu = int(crop_menu_choice_str) - 1 # Convert to 0-based index
-
-                    # Re-fetch the list of crops to map the menu index back to the actual crop object/ID
-                    # This is important if the list is dynamic or could change between requests.
-                    # For USSD, this re-fetch per step is a common pattern if not using server-side session state.
-                    active_crops_session = get_active_crops_for_ussd()
-
-                    if 0 <= crop_choice_idx_from_menu < len(active_crops_session):
-                        selected_crop_obj = active_crops_session[crop_choice_idx_from_menu]
-                        # Now we have selected_crop_obj['id'] and selected_crop_obj['name']
-                        # The next state will be asking for quantity.
-                        # The text for the next stage will be: "1*<crop_menu_idx>*<quantity_or_0_for_back>"
-                        response = f"CON WEKA KIASI CHA {selected_crop_obj['name'].upper()}:\n\n"
-                        response += "Andika idadi ya magunia\n"
-                        response += f"(Kiwango: {Config.MIN_QUANTITY}-{Config.MAX_QUANTITY} magunia)\n\n"
-                        response += "0. Rudi Nyuma" # This 0 should lead to "1*<crop_menu_idx>*0"
-                    else:
-                        # Invalid index chosen, re-show crop list
-                        response = "CON Chaguo la zao si sahihi. Jaribu tena.\n"
-                        active_crops_menu_again = get_active_crops_for_ussd()
-                        if not active_crops_menu_again:
-                            response = "END Samahani, hakuna mazao yanayopatikana kwa sasa."
-                        else:
-                            for i, crop_item_again in enumerate(active_crops_menu_again):
-                                response += f"{i+1}. {crop_item_again['name']}\n"
-                            response += "\n0. Rudi Nyuma" # Back to main menu (text='1*0')
-                except ValueError: # If crop_menu_choice_str is not a valid number
-                     response = "CON Chaguo si sahihi. Jaribu tena.\n0. Rudi Nyuma" # Back to main menu (text='1*0')
-        
-        # OLD: elif text == '1*0':  # Back to main menu from crop selection - Handled by 1*<0> above
-            # response = "CON HUDUMA YA USAFIRIDHAJI MAZAO\n"
-
-        # User has entered quantity (or 0 to go back from quantity screen)
-        # Text format: 1*<crop_menu_idx>*<quantity_or_0>
-        elif text.startswith('1*') and len(text.split('*')) == 3:
-            parts = text.split('*')
-            crop_choice_idx_str = parts[1] # This is the MENU INDEX previously chosen for crop
-            quantity_input_str = parts[2]  # This is the quantity entered, or "0" if user chose back
-
-            if quantity_input_str == '0':  # User chose "0. Rudi Nyuma" from Quantity Input screen
-                # Go back to Crop Selection screen (which is text='1')
-                active_crops_reselect = get_active_crops_for_ussd()
-                if not active_crops_reselect:
-                    response = "END Samahani, hakuna mazao yanayopatikana kwa sasa."
-                else:
-                    response = "CON CHAGUA ZAO UNALOTAKA KUSAFIRISHA:\n"
-                    for i, crop_item_reselect in enumerate(active_crops_reselect):
-                        response += f"{i+1}. {crop_item_reselect['name']}\n"
-                    response += "\n0. Rudi Nyuma" # This 0 leads to text "1*0" (Main Menu)
-            elif not is_valid_quantity(quantity_input_str):
-                # Invalid quantity, re-ask quantity for the previously selected crop
-                try:
-                    crop_choice_idx = int(crop_choice_idx_str) - 1
-                    active_crops_qty_err = get_active_crops_for_ussd()
-                    if 0 <= crop_choice_idx < len(active_crops_qty_err):
-                        selected_crop_name_qty_err = active_crops_qty_err[crop_choice_idx]['name']
-                        response = f"CON KIASI SI SAHIHI!\n\n"
-                        response += f"WEKA KIASI CHA {selected_crop_name_qty_err.upper()}:\n"
-                        response += "Andika idadi ya magunia\n"
-                        response += f"(Kiwango: {Config.MIN_QUANTITY}-{Config.MAX_QUANTITY} magunia)\n\n"
-                        response += "0. Rudi Nyuma" # This 0 leads to "1*<crop_menu_idx>*0" (Back to Crop Selection)
-                    else:
-                        response = "END Kosa la mfumo (crop index out of bounds). Tafadhali anza upya."
-                except ValueError:
-                    response = "END Kosa la mfumo (invalid crop index format). Tafadhali anza upya."
-            else:
-                # Quantity is valid. Text is 1*<crop_menu_idx>*<valid_qty>
-                # Now show pickup locations
-                active_pickup_locations = get_active_locations_for_ussd(location_type_filter='pickup')
-                if not active_pickup_locations:
-                    response = "END Samahani, hakuna maeneo ya kuchukua mizigo kwa sasa."
-                else:
-                    response = "CON CHAGUA MAHALI PA KUCHUKUA MIZIGO:\n"
-                    for i, loc_item_pickup in enumerate(active_pickup_locations):
-                        response += f"{i+1}. {loc_item_pickup['name']}\n"
-                    response += "\n0. Rudi Nyuma"
-                    # This 0 leads to "1*<crop_menu_idx>*<valid_qty>*0" (Back to Quantity Input)
-
-        # Destination location selection after pickup location
-        # Text format: 1*<crop_menu_idx>*<qty>*<pickup_loc_menu_idx_or_0>
-        elif text.startswith('1*') and len(text.split('*')) == 4:
-            parts = text.split('*')
-            crop_choice_idx_str = parts[1]
-            quantity_str = parts[2]
-            pickup_loc_menu_idx_input_str = parts[3]
-
-            if pickup_loc_menu_idx_input_str == '0':  # User chose "0. Rudi Nyuma" from Pickup Location screen
-                # Go back to Quantity Input screen for the selected crop
-                try:
-                    crop_choice_idx = int(crop_choice_idx_str) - 1
-                    active_crops_pickup_back = get_active_crops_for_ussd()
-                    if 0 <= crop_choice_idx < len(active_crops_pickup_back):
-                        selected_crop_name_pickup_back = active_crops_pickup_back[crop_choice_idx]['name']
-                        # Text for next stage will be "1*<crop_menu_idx>*<new_qty_or_0>"
-                        response = f"CON WEKA KIASI CHA {selected_crop_name_pickup_back.upper()}:\n\n"
-                        response += "Andika idadi ya magunia\n"
-                        response += f"(Kiwango: {Config.MIN_QUANTITY}-{Config.MAX_QUANTITY} magunia)\n\n"
-                        response += "0. Rudi Nyuma" # This 0 leads to "1*<crop_menu_idx>*0" (Crop Selection)
-                    else:
-                        response = "END Kosa la mfumo (crop index out of bounds). Anza upya."
-                except ValueError:
-                     response = "END Kosa la mfumo (invalid crop index format). Anza upya."
-            else:
-                # Valid pickup location menu index chosen.
-                # Text is 1*<crop_menu_idx>*<qty>*<pickup_loc_menu_idx>
-                # Show destination locations
-                try:
-                    pickup_loc_menu_idx = int(pickup_loc_menu_idx_input_str) - 1
-                    active_pickup_locations_session = get_active_locations_for_ussd(location_type_filter='pickup')
-
-                    if not (0 <= pickup_loc_menu_idx < len(active_pickup_locations_session)):
-                        # Invalid index, reshow pickup locations
-                        response = "CON Chaguo la eneo si sahihi. Jaribu tena:\n"
-                        if not active_pickup_locations_session:
-                            response = "END Samahani, hakuna maeneo ya kuchukua mizigo kwa sasa."
-                        else:
-                            for i, loc_item_pickup_err in enumerate(active_pickup_locations_session):
-                                response += f"{i+1}. {loc_item_pickup_err['name']}\n"
-                            response += "\n0. Rudi Nyuma" # To quantity input
-                    else:
-                        selected_pickup_loc_obj = active_pickup_locations_session[pickup_loc_menu_idx]
-                        selected_pickup_loc_name = selected_pickup_loc_obj['name']
-
-                        active_dest_locations = get_active_locations_for_ussd(location_type_filter='destination')
-                        if not active_dest_locations:
-                            response = "END Samahani, hakuna maeneo ya kupeleka mizigo kwa sasa."
-                        else:
-                            response = f"CON CHAGUA MAHALI MZIGO UNAPOENDA:\n(Kutoka: {selected_pickup_loc_name})\n"
-                            for i, loc_item_dest in enumerate(active_dest_locations):
-                                response += f"{i+1}. {loc_item_dest['name']}\n"
-                            response += "\n0. Rudi Nyuma"
-                            # This 0 leads to "1*<crop_idx>*<qty>*<pickup_idx>*0" (Back to Pickup Location Selection)
-                except ValueError:
-                    response = "END Kosa la mfumo (invalid pickup location index format). Jaribu tena."
-
-        # Final confirmation and order creation
-        # Text format: 1*<crop_menu_idx>*<qty>*<pickup_loc_menu_idx>*<dest_loc_menu_idx_or_0>
-        elif text.startswith('1*') and len(text.split('*')) == 5:
-            parts = text.split('*')
-            crop_choice_menu_idx_str = parts[1]
-            quantity_str = parts[2]
-            pickup_loc_menu_idx_str = parts[3]
-            dest_loc_menu_idx_input_str = parts[4]
-
-            if dest_loc_menu_idx_input_str == '0':  # User chose "0. Rudi Nyuma" from Destination Location screen
-                # Go back to Pickup Location selection screen
-                # Need to display the list of pickup locations again.
-                active_pickup_locations_reselect = get_active_locations_for_ussd(location_type_filter='pickup')
-                if not active_pickup_locations_reselect:
-                    response = "END Samahani, hakuna maeneo ya kuchukua mizigo kwa sasa."
-                else:
-                    response = "CON CHAGUA MAHALI PA KUCHUKUA MIZIGO:\n"
-                    for i, loc_item_pickup_reselect in enumerate(active_pickup_locations_reselect):
-                        response += f"{i+1}. {loc_item_pickup_reselect['name']}\n"
-                    response += "\n0. Rudi Nyuma" # This 0 leads to "1*<crop_idx>*<qty>*0" (Back to Quantity Input)
-            else:
-                # All inputs gathered (by menu indices), proceed to create order
-                try:
-                    # Resolve all choices to their actual DB objects/IDs
-                    crop_choice_idx = int(crop_choice_menu_idx_str) - 1
-                    active_crops_final = get_active_crops_for_ussd()
-                    if not (0 <= crop_choice_idx < len(active_crops_final)): raise ValueError("Invalid crop index")
-                    final_selected_crop = active_crops_final[crop_choice_idx]
-
-                    pickup_loc_idx = int(pickup_loc_menu_idx_str) - 1
-                    active_pickup_locs_final = get_active_locations_for_ussd(location_type_filter='pickup')
-                    if not (0 <= pickup_loc_idx < len(active_pickup_locs_final)): raise ValueError("Invalid pickup location index")
-                    final_selected_pickup_loc = active_pickup_locs_final[pickup_loc_idx]
-
-                    dest_loc_idx = int(dest_loc_menu_idx_input_str) - 1
-                    active_dest_locs_final = get_active_locations_for_ussd(location_type_filter='destination')
-                    if not (0 <= dest_loc_idx < len(active_dest_locs_final)): raise ValueError("Invalid destination location index")
-                    final_selected_dest_loc = active_dest_locs_final[dest_loc_idx]
-
-                    if final_selected_pickup_loc['id'] == final_selected_dest_loc['id']:
-                        response = "END MAKOSA - MAHALI NI SAWA\n\n"
-                        response += "Mahali pa kuchukua na pa uwasilishaji haviwezi kuwa sawa.\n"
-                        response += "Tafadhali chagua maeneo tofauti.\nAsante!" # End session here.
-                    elif not is_valid_quantity(quantity_str):
-                        response = "END Kiasi si sahihi. Anza upya."
-                    else:
-                        track_number = generate_track_number()
-
-                        assigned_transporter = None
-                        conn_tp = get_db_connection()
-                        if conn_tp:
-                            cursor_tp = conn_tp.cursor(dictionary=True)
-                            cursor_tp.execute("SELECT id, name, phone, rating FROM transporters ORDER BY RAND() LIMIT 1")
-                            assigned_transporter = cursor_tp.fetchone()
-                            if cursor_tp: cursor_tp.close()
-                            if conn_tp: conn_tp.close()
-
-                        if not assigned_transporter:
-                            assigned_transporter = {"name": "N/A", "phone": "N/A", "rating": "N/A", "id": None}
-                            logger.warning("No transporter found in DB or DB error for USSD order, order will have NULL transporter_id.")
-
-                        order_data_to_save = {
-                            'phone_number': phone_number,
-                            'crop_id': final_selected_crop['id'], 'crop': final_selected_crop['name'],
-                            'quantity': quantity_str,
-                            'pickup_location_id': final_selected_pickup_loc['id'], 'pickup_location': final_selected_pickup_loc['name'],
-                            'destination_location_id': final_selected_dest_loc['id'], 'destination_location': final_selected_dest_loc['name'],
-                            'transporter': assigned_transporter
-                        }
-
-                        if save_order(track_number, order_data_to_save):
-                            response = "END UTHIBITISHO - OMBI LIMEPOKELEWA!\n\n"
-                            response += f"Zao: {final_selected_crop['name']}\n"
-                            response += f"Kiasi: {quantity_str} Magunia\n"
-                            response += f"Kutoka: {final_selected_pickup_loc['name']}\n"
-                            response += f"Kwenda: {final_selected_dest_loc['name']}\n"
-                            response += f"Namba ya Ufuatiliaji: {track_number}\n\n"
-                            response += f"Msafirishaji: {assigned_transporter.get('name', 'Atathibitishwa')}\n"
-                            response += f"Mawasiliano: {assigned_transporter.get('phone', 'Atathibitishwa')}\n"
-                            response += "Msafirishaji atawasiliana nawe.\nAsante!"
-                        else:
-                            response = "END Samahani, ombi lako limeshindikana. Jaribu tena."
-                except ValueError as ve:
-                    logger.error(f"ValueError during final order processing (text: {text}): {ve}")
-                    response = "END Kosa la mfumo. Tafadhali anza upya."
-                except Exception as e:
-                    logger.error(f"General Exception during final order processing (text: {text}): {e}", exc_info=True)
-                    response = "END Samahani, tatizo la kimfumo limetokea. Jaribu tena."
-        
-        # Option 2: Track Order
-        elif text == '2':
-            response += "Karibu! Chagua huduma:\n\n"
-            response += "1. Omba Usafiri\n"
-            response += "2. Fuatilia Ombi\n"
-            response += "3. Mawasiliano\n"
-            response += "0. Toka"
-        
-        # Pickup location selection after quantity input
-        elif text.startswith('1*') and len(text.split('*')) == 3:
-            parts = text.split('*')
-            crop_choice = parts[1]
-            quantity = parts[2]
-            
-            if quantity == '0':  # Back to crop selection
-                response = "CON CHAGUA ZAO UNALOTAKA KUSAFIRISHA:\n\n"
-                response += "1. Mahindi\n"
-                response += "2. Viazi\n"
-                response += "3. Mpunga\n"
-                response += "4. Zao Jingine\n\n"
-                response += "0. Rudi Nyuma"
-            elif not is_valid_quantity(quantity):
-                crop_name = crops.get(crop_choice, 'Zao')
-                response = f"CON KIASI SI SAHIHI!\n\n"
-                response += f"WEKA KIASI CHA {crop_name.upper()}:\n"
-                response += "Andika idadi ya magunia\n"
-                response += f"(Kiwango: {Config.MIN_QUANTITY}-{Config.MAX_QUANTITY} magunia)\n\n"
-                response += "0. Rudi Nyuma"
-            else:
-                response = "CON CHAGUA MAHALI PA KUCHUKUA MIZIGO:\n\n"
-                response += "1. Mbalali\n"
-                response += "2. Uyole\n"
-                response += "3. Kyela\n"
-                response += "11. Sehemu nyingine\n"
-                response += "0. Rudi Nyuma"
-        
-        # Destination location selection after pickup location
-        elif text.startswith('1*') and len(text.split('*')) == 4:
-            parts = text.split('*')
-            crop_choice = parts[1]
-            quantity = parts[2]
-            pickup_choice = parts[3]
-            
-            if pickup_choice == '0':  # Back to quantity
-                crop_name = crops.get(crop_choice, 'Zao')
-                response = f"CON WEKA KIASI CHA {crop_name.upper()}:\n\n"
-                response += "Andika idadi ya magunia\n"
-                response += f"(Kiwango: {Config.MIN_QUANTITY}-{Config.MAX_QUANTITY} magunia)\n\n"
-                response += "0. Rudi Nyuma"
-            elif pickup_choice == '11':  # Other pickup location
-                response = "END HUDUMA BADO Haijafika huko\n\n"
-                response += "Huduma hii bado haijapatikana kwa sehemu nyingine.\n"
-                response += "Tafadhali chagua kutoka kwenye maeneo yaliyoorodheshwa.\n\n"
-                response += "Asante kwa kutumia huduma yetu!"
-            else:
-                pickup_name = locations.get(pickup_choice, 'Mahali')
-                response = f"CON CHAGUA MAHALI MZIGO UNAPOENDA:\n"
-                response += f"(Kutoka: {pickup_name})\n\n"
-                response += "1. Soweto\n"
-                response += "2. Mwanjelwa\n"
-                response += "3. Maendeleo\n"
-                response += "4. Igurusi\n"
-                response += "11. Sehemu nyingine\n"
-                response += "0. Rudi Nyuma"
-        
-        # Final confirmation and order creation
-        elif text.startswith('1*') and len(text.split('*')) == 5:
-            parts = text.split('*')
-            crop_choice = parts[1]
-            quantity = parts[2]
-            pickup_choice = parts[3]
-            destination_choice = parts[4]
-            
-            if destination_choice == '0':  # Back to pickup location
-                response = "CON CHAGUA MAHALI KUCHUKUA MIZIGO:\n\n"
-                response += "1. Mbalali \n"
-                response += "2. Uyole\n"
-                response += "3. Kyela\n"
-                response += "5. Sehemu nyingine\n"
-                response += "0. Rudi Nyuma"
-            elif destination_choice == '11':  # Other destination
-                response = "END HUDUMA BADO Haijafika \n\n"
-                response += "Huduma hii bado haijapatikana kwa sehemu nyingine.\n"
-                response += "Tafadhali chagua kutoka kwenye maeneo yaliyoorodheshwa.\n\n"
-                response += "Asante kwa kutumia huduma yetu!"
-            elif pickup_choice == destination_choice:  # Same pickup and destination
-                response = "END MAKOSA - MAHALI NI SAWA\n\n"
-                response += "Mahali pa kuchukua na pa uwasilishaji haviwezi kuwa sawa.\n"
-                response += "Tafadhali chagua maeneo tofauti.\n\n"
-                response += "Asante kwa kutumia huduma yetu!"
-            else:
-                # Create order
-                track_number = generate_track_number()
-                transporter = get_transporter_details()
-                
-                crop_name = crops.get(crop_choice, 'Zao')
-                pickup_name = locations.get(pickup_choice, 'Mahali')
-                destination_name = locations.get(destination_choice, 'Mahali')
-                
-                # Save order
-                order_data = {
-                    'phone_number': phone_number,
-                    'crop': crop_name,
-                    'quantity': quantity,
-                    'pickup_location': pickup_name,
-                    'destination_location': destination_name,
-                    'transporter': transporter
-                }
-                save_order(track_number, order_data)
-                
-                response = "END UTHIBITISHO - OMBI LIMEPOKELEWA!\n\n"
-                response += f"Zao: {crop_name}\n"
-                response += f"Kiasi: {quantity} Magunia\n"
-                response += f"Kutoka: {pickup_name}\n"
-                response += f"Kwenda: {destination_name}\n"
-                response += f"Namba ya Ufuatiliaji: {track_number}\n\n"
-                response += f"Msafirishaji : {transporter['name']}\n"
-                response += f"Mawasiliano: {transporter['phone']}\n"
-                response += "Msafirishaji atawasiliana nawe kwa maeleezo ya bei na muda.\n"
-                response += "Utapokea ujumbe wa uthibitisho.\n"
-                response += "Asante kwa kutumia huduma yetu!"
-        
-        # Option 2: Track Order
-        elif text == '2':
-            response = "CON FUATILIA OMBI LAKO\n\n"
-            response += "Weka namba ya ufuatiliaji:\n"
-            response += "(Mfano: TRK240315001)\n\n"
-            response += "0. Rudi Nyuma"
-        
-        elif text.startswith('2*'):
-            track_input = text.split('*')[1].strip().upper()
-            
-            if track_input == '0':  # Back to main menu
-                response = "CON HUDUMA YA USAFIRISHAJI MAZAO\n"
-                response += "Karibu! Chagua huduma:\n\n"
-                response += "1. Omba Usafiri\n"
-                response += "2. Fuatilia Ombi\n"
-                response += "3. Mawasiliano\n"
-                response += "0. Toka"
-            elif track_input.startswith('TRK') and len(track_input) >= 9:
-                order = get_order_status(track_input)
-                
-                if order:
-                    # Update status randomly for demo
-                    statuses = [
-                        "Ombi limepokewa na linatarajiwa kuanza safari",
-                        "Msafiri amepokea ombi na ameshaanza safari",
-                        "Mizigo iko njiani - eneo la Makambako",
-                        # "Mizigo iko karibu na mahali pa utoaji", # Example statuses removed
-                        # "Mizigo imefika mahali pa utoaji" # Actual status comes from DB
-                    # ]
-                    # current_status = random.choice(statuses) # Using actual status from DB
-                    db_status = order.get('status', 'Hali haijulikani') # Get status from DB
-                    
-                    response = f"END HALI YA OMBI: {track_input}\n\n"
-                    response += f"Zao: {order.get('crop', 'N/A')}\n"
-                    response += f"Kiasi: {order.get('quantity', 'N/A')} Magunia\n"
-                    response += f"Kutoka: {order.get('pickup_location', 'N/A')}\n"
-                    response += f"Kwenda: {order.get('destination_location', 'N/A')}\n" # Corrected field
-                    response += f"Hali: {db_status}\n\n" # Use status from DB
-                    response += "MAELEZO YA MSAFIRISHAJI:\n"
-                    response += f"Msafirishaji: {order.get('transporter', {}).get('name', 'N/A')}\n"
-                    response += f"Mawasiliano: {order.get('transporter', {}).get('phone', 'N/A')}\n\n"
-                    response += "Kwa maelezo zaidi wasiliana na Msafirishaji."
-                else:
-                    response = "END NAMBA HAIJAPATIKANA\n\n"
-                    response += "Namba ya ufuatiliaji haipo kwenye mfumo wetu.\n"
-                    response += "Tafadhali hakikisha umeweka namba sahihi.\n\n"
-                    response += "Asante!"
-            else:
-                response = "CON NAMBA SI SAHIHI\n\n"
-                response += "Namba ya ufuatiliaji si sahihi.\n"
-                response += "Tafadhali weka namba sahihi\n"
-                response += "(Mfano: TRK240315001)\n\n"
-                response += "0. Rudi Nyuma"
-        
-        # Option 3: Contact Information
-        elif text == '3':
-            response = "END MAWASILIANO YETU\n\n"
-            response += "Ofisi Kuu - Mbeya:\n"
-            response += "Simu: +255 25 250 1234\n"
-            response += "WhatsApp: +255 754 123 456\n"
-            response += "Barua pepe: info@safirimazao.co.tz\n\n"
-            response += "Masaa ya kazi:\n"
-            response += "Jumatatu - Jumamosi: 7:00 - 18:00\n"
-            response += "Jumapili: 8:00 - 14:00\n\n"
-            response += "Asante kwa kutumia huduma yetu."
-        
-        # Option 0: Exit
-        elif text == '0':
-            response = "END ASANTE KWA KUTUMIA HUDUMA YETU\n\n"
-            response += "Huduma ya usafiridhaji mazao kwa watu wote.\n"
-            response += "Karibu tena!\n\n"
-            response += "Kwa huduma zaidi piga: +255 25 250 1234"
-        
-        # Handle invalid inputs
+
+        # Server-side session state keyed by the gateway's sessionId. Every list shown to the
+        # user is snapshotted (show_catalog_menu) and the next step maps the numeric choice back to
+        # an ID from that snapshot (resolve_menu_choice), so a catalog change mid-session can't
+        # shift the mapping and no list has to be re-fetched. An empty text starts a new session.
+        session = (session_store.get(session_id) if session_id and text else None) or {}
+
+        ctx = UssdRequest(session_id, phone_number, text, session)
+        screen = USSD_SCREENS.get((ctx.path[0] if ctx.path else '', len(ctx.path)), invalid_choice_screen)
+        response = screen(ctx)
+        if screen is invalid_choice_screen:
+            USSD_LATENCY.observe(time.perf_counter() - g.request_started, 'invalid', 'any')
         else:
-            response = "CON CHAGUO HALIPO\n\n"
-            response += "Chaguo ulilochagua halipo.\n"
-            response += "Tafadhali jaribu tena na uchague chaguo sahihi.\n\n"
-            response += "0. Rudi Nyuma"
-        
+            USSD_LATENCY.observe(time.perf_counter() - g.request_started, ctx.path[0] if ctx.path else '', str(len(ctx.path)))
+
+        if session_id:
+            if response.startswith('END'):
+                session_store.delete(session_id) # Session is over, free the snapshot
+            else:
+                session_store.save(session_id, session)
+
         # Log the response
         logger.info(f"USSD Response - Session: {session_id}, Response length: {len(response)}")
-        
+
         return response
-        
+
     except Exception as e:
         logger.error(f"Error processing USSD request: {e}")
+        USSD_ERRORS.inc()
         return "END Samahani, kuna tatizo la kimfumo. Tafadhali jaribu baadae."
 
 # Admin Web Dashboard APIs
-@app.route('/api/orders', methods=['GET'])
-def get_all_orders():
-    """API endpoint to fetch all orders for the admin dashboard."""
-    conn = None
-    cursor = None
+# Keyset pagination: pages are ordered by created_at (newest first by default), track_number breaks
+# ties between orders created in the same second. Legacy orders without created_at sort as MySQL
+# puts NULL, below every date (last when newest first), and the cursor carries the NULL. Filters become a parameterized WHERE; the
+# common ones are served by an index in page order (status and phone_number by their
+# (x, created_at) indexes, a created_at range by idx_orders_created_at), so a page costs the
+# same however deep it is. Other filters use their foreign key index and sort only the matches.
+ORDER_LOCK_FOR_STATUS_SELECT = """SELECT track_number, status, status_updated_at, transporter_id, quantity, created_at,
+    crop_id, pickup_location_id, destination_location_id
+FROM orders """
+named_query('orders.lock_for_status', ORDER_LOCK_FOR_STATUS_SELECT + "WHERE track_number = %s FOR UPDATE")
+named_query('orders.update_status', "UPDATE orders SET status = %s, status_updated_at = %s WHERE track_number = %s")
+
+def filter_datetime(value):
+    return datetime.fromisoformat(value)
+
+def filter_end_datetime(value):
+    """Exclusive upper bound; a date alone includes that whole day."""
+    end = datetime.fromisoformat(value)
+    return end + timedelta(days=1) if len(value) == 10 else end
+
+# Query parameter: (condition, converter). `status` is handled separately since it may repeat.
+ORDER_FILTERS = {
+    'phone': ("o.phone_number = %s", str),
+    'crop_id': ("o.crop_id = %s", int),
+    'pickup_location_id': ("o.pickup_location_id = %s", int),
+    'destination_location_id': ("o.destination_location_id = %s", int),
+    'transporter_id': ("o.transporter_id = %s", int),
+    'created_from': ("o.created_at >= %s", filter_datetime),
+    'created_to': ("o.created_at < %s", filter_end_datetime),
+}
+ORDER_SORTS = {'-created_at': 'DESC', 'created_at': 'ASC'}
+
+def order_filter_conditions(args):
+    """WHERE conditions and parameters for the order filters in `args`. Raises ValueError for a bad value."""
+    conditions = []
+    params = []
+    statuses = [status for status in args.getlist('status') if status]
+    if statuses:
+        conditions.append(f"o.status IN ({', '.join(['%s'] * len(statuses))})")
+        params.extend(statuses)
+    for name, (condition, convert) in ORDER_FILTERS.items():
+        value = args.get(name)
+        if value:
+            try:
+                params.append(convert(value))
+            except ValueError:
+                raise ValueError(f"Invalid value for {name}: {value}")
+            conditions.append(condition)
+    return conditions, params
+
+def order_page_query(conditions, params, direction, after, limit):
+    """(sql, params) for up to `limit` orders matching `conditions`, after the (created_at, track_number) position `after`."""
+    conditions = list(conditions)
+    params = list(params)
+    if after:
+        created_at, track_number = after
+        op = '<' if direction == 'DESC' else '>'
+        if created_at is None:
+            # Among the NULLs by track number; ascending, every dated order comes after them
+            later = "o.created_at IS NOT NULL OR " if direction == 'ASC' else ""
+            conditions.append(f"({later}(o.created_at IS NULL AND o.track_number {op} %s))")
+            params.append(track_number)
+        else:
+            # Descending, the NULLs come after every dated order
+            later = " OR o.created_at IS NULL" if direction == 'DESC' else ""
+            conditions.append(f"(o.created_at {op} %s OR (o.created_at = %s AND o.track_number {op} %s){later})")
+            params.extend([created_at, created_at, track_number])
+    sql = ORDER_SELECT
+    if conditions:
+        sql += "WHERE " + "\n  AND ".join(conditions) + "\n"
+    sql += f"ORDER BY o.created_at {direction}, o.track_number {direction} LIMIT %s"
+    return sql, tuple(params) + (limit,)
+
+def encode_order_cursor(order):
+    """Opaque cursor for the page after `order` (a map_order dict)."""
+    position = json.dumps([order['created_at'], order['track_number']])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+def decode_order_cursor(cursor):
+    """(created_at or None, track_number) from encode_order_cursor(). Raises ValueError if it is malformed."""
     try:
-        conn = get_db_connection()
-        if conn is None:
-            return jsonify({'error': 'Database connection failed'}), 500
-
-        cursor = conn.cursor(dictionary=True)
-
-        # Join with related tables to get names and other details
-        sql = """
-        SELECT
-            o.track_number, o.phone_number, o.quantity, o.status,
-            o.created_at, o.status_updated_at,
-            c.name as crop_name, c.id as crop_id,
-            pl.name as pickup_location_name, pl.id as pickup_location_id,
-            dl.name as destination_location_name, dl.id as destination_location_id,
-            t.name as transporter_name, t.phone as transporter_phone,
-            t.rating as transporter_rating, t.id as transporter_id,
-            o.crop as old_crop, -- Keep old fields for now if needed for data that hasn't been migrated
-            o.pickup_location as old_pickup_location,
-            o.destination_location as old_destination_location,
-            o.transporter_name as old_transporter_name,
-            o.transporter_phone as old_transporter_phone,
-            o.transporter_rating as old_transporter_rating
-        FROM orders o
-        LEFT JOIN crops c ON o.crop_id = c.id
-        LEFT JOIN locations pl ON o.pickup_location_id = pl.id
-        LEFT JOIN locations dl ON o.destination_location_id = dl.id
-        LEFT JOIN transporters t ON o.transporter_id = t.id
-        ORDER BY o.created_at DESC
-        """
-        cursor.execute(sql)
-        orders_raw = cursor.fetchall()
-
-        orders_processed = []
-        for order_row in orders_raw:
-            order_dict = dict(order_row) # Convert named tuple/dict from cursor
-            if isinstance(order_dict.get('created_at'), datetime):
-                order_dict['created_at'] = order_dict['created_at'].isoformat()
-            if isinstance(order_dict.get('status_updated_at'), datetime):
-                order_dict['status_updated_at'] = order_dict['status_updated_at'].isoformat()
-
-            # Structure related entities for clarity in API response
-            order_dict['crop_details'] = {'id': order_dict.pop('crop_id', None), 'name': order_dict.pop('crop_name', None) or order_dict.get('old_crop')}
-            order_dict['pickup_location_details'] = {'id': order_dict.pop('pickup_location_id', None), 'name': order_dict.pop('pickup_location_name', None) or order_dict.get('old_pickup_location')}
-            order_dict['destination_location_details'] = {'id': order_dict.pop('destination_location_id', None), 'name': order_dict.pop('destination_location_name', None) or order_dict.get('old_destination_location')}
-            order_dict['transporter_details'] = {
-                'id': order_dict.pop('transporter_id', None),
-                'name': order_dict.pop('transporter_name', None) or order_dict.get('old_transporter_name'), # Prioritize joined name
-                'phone': order_dict.pop('transporter_phone', None) or order_dict.get('old_transporter_phone'),
-                'rating': order_dict.pop('transporter_rating', None) or order_dict.get('old_transporter_rating')
-            }
-            # Remove redundant old fields from the main dict if they were only used for fallback
-            for old_field in ['old_crop', 'old_pickup_location', 'old_destination_location', 'old_transporter_name', 'old_transporter_phone', 'old_transporter_rating']:
-                order_dict.pop(old_field, None)
+        created_at, track_number = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return (None if created_at is None else datetime.fromisoformat(created_at)), str(track_number)
+    except (TypeError, ValueError) as e: # binascii.Error and UnicodeDecodeError are ValueErrors
+        raise ValueError(f"Invalid cursor: {cursor}") from e
 
-            orders_processed.append(order_dict)
+def fetch_order_page(conditions, params):
+    """
+    Response with the page of orders matching `conditions` selected by the limit, sort and
+    cursor parameters of the current request.
+    """
+    try:
+        limit = int(request.args.get('limit', Config.ORDERS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if not 1 <= limit <= Config.ORDERS_MAX_PAGE_SIZE:
+        return jsonify({'error': f"limit must be between 1 and {Config.ORDERS_MAX_PAGE_SIZE}"}), 400
+    direction = ORDER_SORTS.get(request.args.get('sort', '-created_at'))
+    if direction is None:
+        return jsonify({'error': f"Invalid sort. Must be one of: {', '.join(ORDER_SORTS)}."}), 400
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = decode_order_cursor(request.args['cursor'])
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
 
-        return jsonify(orders_processed), 200
+    try:
+        # One extra row tells us whether there is a next page
+        sql, params = order_page_query(conditions, params, direction, after, limit + 1)
+        with db_session() as db:
+            orders = db.fetchall(sql, params, map_order)
+        next_cursor = encode_order_cursor(orders[limit - 1]) if len(orders) > limit else None
+        return jsonify({'orders': orders[:limit], 'next_cursor': next_cursor}), 200
     except MySQLError as e:
-        logger.error(f"Error fetching all orders for admin: {e}")
+        logger.error(f"Error fetching orders for {request.endpoint}: {e}")
         return jsonify({'error': 'Failed to fetch orders', 'details': str(e)}), 500
     except Exception as e:
-        logger.error(f"Unexpected error fetching all orders: {e}")
+        logger.error(f"Unexpected error fetching orders for {request.endpoint}: {e}")
         return jsonify({'error': 'An unexpected error occurred', 'details': str(e)}), 500
-    finally:
-        if cursor:
-            cursor.close()
-        if conn and conn.is_connected():
-            conn.close()
+
+@app.route('/api/orders', methods=['GET'])
+def get_all_orders():
+    """API endpoint to fetch a page of orders for the admin dashboard, optionally filtered."""
+    try:
+        conditions, params = order_filter_conditions(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return fetch_order_page(conditions, params)
+
+@app.route('/api/customers/<string:phone_number>/orders', methods=['GET'])
+def get_customer_orders(phone_number):
+    """A customer's order history, newest first. Takes the same paging and filter parameters as /api/orders."""
+    try:
+        conditions, params = order_filter_conditions(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return fetch_order_page(["o.phone_number = %s"] + conditions, [phone_number] + params)
+
+# Full order export for accounting. Rows stream from an unbuffered cursor through generators
+# straight into a chunked response, so memory stays flat however many orders there are.
+# Primary key order is a plain clustered-index scan; ordering by created_at without a LIMIT would
+# make MySQL sort the whole table before sending the first row.
+order_query('orders.export', "ORDER BY o.track_number")
+ORDER_EXPORT_COLUMNS = (
+    'track_number', 'phone_number', 'quantity', 'status', 'created_at', 'status_updated_at',
+    'crop_id', 'crop_name', 'pickup_location_id', 'pickup_location_name',
+    'destination_location_id', 'destination_location_name',
+    'transporter_id', 'transporter_name', 'transporter_phone', 'transporter_rating',
+)
+
+def order_export_chunks():
+    """Lists of order rows in tracking number order, read Config.ORDER_EXPORT_CHUNK_SIZE at a time."""
+    with db_session() as db:
+        yield from db.stream('orders.export', (), Config.ORDER_EXPORT_CHUNK_SIZE)
+
+def ndjson_export(chunks):
+    """One JSON order per line, in the same shape as GET /api/orders."""
+    for rows in chunks:
+        yield ''.join(json.dumps(map_order(row)) + '\n' for row in rows)
+
+def csv_export(chunks):
+    """Header line plus one flat CSV row per order."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(ORDER_EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows([json_value(row[column]) for column in ORDER_EXPORT_COLUMNS] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell(): # No orders: just the header
+        yield buffer.getvalue()
+
+ORDER_EXPORT_FORMATS = {
+    'ndjson': (ndjson_export, 'application/x-ndjson'),
+    'csv': (csv_export, 'text/csv'),
+}
+
+@app.route('/api/orders/export', methods=['GET'])
+def export_orders():
+    """Streams every order as NDJSON (default) or CSV."""
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ORDER_EXPORT_FORMATS:
+        return jsonify({'error': f"Invalid format. Must be one of: {', '.join(ORDER_EXPORT_FORMATS)}."}), 400
+    formatter, mimetype = ORDER_EXPORT_FORMATS[export_format]
+    body = formatter(order_export_chunks())
+    try:
+        # Produce the first chunk now, so that a database error is still a proper 500
+        first_chunk = next(body, '')
+    except MySQLError as e:
+        logger.error(f"Database error exporting orders: {e}")
+        return jsonify({'error': 'Failed to export orders', 'details': str(e)}), 500
+
+    def generate():
+        yield first_chunk
+        yield from body # Closing this generator (client gone) closes the cursor and connection too
+
+    filename = f"orders-{datetime.now():%Y%m%d-%H%M%S}.{export_format}"
+    return Response(stream_with_context(generate()), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+def update_transporter_open_orders(order, new_status):
+    """Tells the transporter index that `order` (as locked before the change) was closed or reopened by `new_status`."""
+    if order['transporter_id'] is None:
+        return
+    was_closed = order['status'] in Config.CLOSED_ORDER_STATUSES
+    is_closed = new_status in Config.CLOSED_ORDER_STATUSES
+    if is_closed and not was_closed:
+        transporter_index.order_closed(order['transporter_id'])
+    elif was_closed and not is_closed:
+        transporter_index.order_opened(order['transporter_id'])
 
 @app.route('/api/orders/<string:track_number>/status', methods=['PUT'])
 def update_order_status_api(track_number):
@@ -1092,128 +3082,204 @@ def update_order_status_api(track_number):
         if not new_status:
             return jsonify({'error': 'New status is required'}), 400
 
-        conn = None
-        cursor = None
         try:
-            conn = get_db_connection()
-            if conn is None:
-                return jsonify({'error': 'Database connection failed'}), 500
-
-            cursor = conn.cursor()
-
-            # Check if order exists
-            cursor.execute("SELECT track_number FROM orders WHERE track_number = %s", (track_number,))
-            order_exists = cursor.fetchone()
-            if not order_exists:
-                return jsonify({'error': 'Order not found'}), 404
-
-            # Update status and status_updated_at
-            sql = "UPDATE orders SET status = %s, status_updated_at = %s WHERE track_number = %s"
-            current_time = datetime.now()
-            cursor.execute(sql, (new_status, current_time, track_number))
-            conn.commit()
-
-            if cursor.rowcount > 0:
-                logger.info(f"Status for order {track_number} updated to '{new_status}' via API.")
-
-                # Fetch the updated order with joined details to return
-                # Close the current cursor and get a dictionary cursor
-                if cursor: cursor.close()
-                cursor = conn.cursor(dictionary=True)
-
-                fetch_sql = """
-                SELECT
-                    o.track_number, o.phone_number, o.quantity, o.status,
-                    o.created_at, o.status_updated_at,
-                    c.name as crop_name, c.id as crop_id,
-                    pl.name as pickup_location_name, pl.id as pickup_location_id,
-                    dl.name as destination_location_name, dl.id as destination_location_id,
-                    t.name as transporter_name, t.phone as transporter_phone,
-                    t.rating as transporter_rating, t.id as transporter_id,
-                    o.crop as old_crop, o.pickup_location as old_pickup_location,
-                    o.destination_location as old_destination_location,
-                    o.transporter_name as old_transporter_name,
-                    o.transporter_phone as old_transporter_phone,
-                    o.transporter_rating as old_transporter_rating
-                FROM orders o
-                LEFT JOIN crops c ON o.crop_id = c.id
-                LEFT JOIN locations pl ON o.pickup_location_id = pl.id
-                LEFT JOIN locations dl ON o.destination_location_id = dl.id
-                LEFT JOIN transporters t ON o.transporter_id = t.id
-                WHERE o.track_number = %s
-                """
-                cursor.execute(fetch_sql, (track_number,))
-                updated_order_raw = cursor.fetchone()
-
-                if updated_order_raw:
-                    updated_order_dict = dict(updated_order_raw)
-                    if isinstance(updated_order_dict.get('created_at'), datetime):
-                        updated_order_dict['created_at'] = updated_order_dict['created_at'].isoformat()
-                    if isinstance(updated_order_dict.get('status_updated_at'), datetime):
-                        updated_order_dict['status_updated_at'] = updated_order_dict['status_updated_at'].isoformat()
-
-                    updated_order_dict['crop_details'] = {'id': updated_order_dict.pop('crop_id', None), 'name': updated_order_dict.pop('crop_name', None) or updated_order_dict.get('old_crop')}
-                    updated_order_dict['pickup_location_details'] = {'id': updated_order_dict.pop('pickup_location_id', None), 'name': updated_order_dict.pop('pickup_location_name', None) or updated_order_dict.get('old_pickup_location')}
-                    updated_order_dict['destination_location_details'] = {'id': updated_order_dict.pop('destination_location_id', None), 'name': updated_order_dict.pop('destination_location_name', None) or updated_order_dict.get('old_destination_location')}
-                    updated_order_dict['transporter_details'] = {
-                        'id': updated_order_dict.pop('transporter_id', None),
-                        'name': updated_order_dict.pop('transporter_name', None) or updated_order_dict.get('old_transporter_name'),
-                        'phone': updated_order_dict.pop('transporter_phone', None) or updated_order_dict.get('old_transporter_phone'),
-                        'rating': updated_order_dict.pop('transporter_rating', None) or updated_order_dict.get('old_transporter_rating')
-                    }
-                    for old_field in ['old_crop', 'old_pickup_location', 'old_destination_location', 'old_transporter_name', 'old_transporter_phone', 'old_transporter_rating']:
-                        updated_order_dict.pop(old_field, None)
-                    return jsonify(updated_order_dict), 200
-                else: # Should not happen if update was successful
-                    return jsonify({'error': 'Failed to retrieve updated order details'}), 500
-            else:
-                # This case should ideally not be reached if existence check passed and update occurred
-                return jsonify({'error': 'Order not found or status not changed'}), 404
+            with db_transaction() as db:
+                # Status and transporter keep open-order counts right, status_updated_at the
+                # status history, the rest the daily rollup
+                order = db.fetchone('orders.lock_for_status', (track_number,))
+                if not order:
+                    return jsonify({'error': 'Order not found'}), 404
+                changed_at = datetime.now()
+                db.execute('orders.update_status', (new_status, changed_at, track_number))
+                add_order_stats(db, status_change_stats(order, new_status))
+                # Read back inside the transaction, on the same connection
+                updated_order = db.fetchone('orders.get', (track_number,), map_order)
+            status_events.add([status_change_event(order, new_status, changed_at)])
+            invalidate_tracking_cache(order['track_number'].upper()) # USSD tracking looks orders up upper-cased
+            invalidate_report_cache()
+
+            logger.info(f"Status for order {track_number} updated to '{new_status}' via API.")
+            update_transporter_open_orders(order, new_status)
+            return jsonify(updated_order), 200
 
         except MySQLError as e:
             logger.error(f"Database error updating status for order {track_number}: {e}")
-            if conn:
-                conn.rollback()
             return jsonify({'error': 'Database error updating status', 'details': str(e)}), 500
         except Exception as e:
             logger.error(f"Unexpected error updating status for order {track_number}: {e}")
-            if conn:
-                conn.rollback()
             return jsonify({'error': 'An unexpected error occurred', 'details': str(e)}), 500
-        finally:
-            if cursor:
-                cursor.close()
-            if conn and conn.is_connected():
-                conn.close()
     except BadRequest:
         return jsonify({'error': 'Invalid JSON data'}), 400
 
+# Bulk status update, e.g. every order on a truck leaving a market. The whole batch is one
+# transaction with a constant number of statements whatever its size: one SELECT ... FOR UPDATE
+# for all orders (in primary key order, so concurrent batches lock rows in the same order), one
+# UPDATE with a CASE for the new statuses, one multi-row upsert of the daily rollup, and
+# optionally one JOIN to read the updated orders back.
+
+def parse_status_batch(data):
+    """
+    [(track_number, status, error)] for the items of a batch request body, in request order.
+    `error` is None for a valid item. Track numbers are compared case-insensitively, as MySQL
+    does. Raises ValueError if the body itself is malformed.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("Request body must be a JSON object")
+    default_status = data.get('status')
+    if 'updates' in data:
+        items = data['updates']
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError("updates must be a list of objects")
+        items = [(item.get('track_number'), item.get('status') or default_status) for item in items]
+    elif 'track_numbers' in data:
+        if not isinstance(data['track_numbers'], list):
+            raise ValueError("track_numbers must be a list")
+        items = [(track_number, default_status) for track_number in data['track_numbers']]
+    else:
+        raise ValueError("Either track_numbers (with status) or updates is required")
+    if not items:
+        raise ValueError("No orders to update")
+    if len(items) > Config.ORDER_STATUS_BATCH_MAX_SIZE:
+        raise ValueError(f"At most {Config.ORDER_STATUS_BATCH_MAX_SIZE} orders per batch")
+
+    parsed = []
+    seen = set()
+    for track_number, status in items:
+        if not isinstance(track_number, str) or not track_number:
+            error = 'track_number is required'
+        elif not isinstance(status, str) or not status:
+            error = 'New status is required'
+        elif track_number.upper() in seen:
+            error = 'Duplicate track_number in batch'
+        else:
+            error = None
+            seen.add(track_number.upper())
+        parsed.append((track_number, status, error))
+    return parsed
+
+def update_order_statuses(db, updates, changed_at):
+    """
+    Sets the status of each (track_number, status) in `updates` in the caller's transaction.
+    Returns the locked orders as they were before the change, by upper-cased track number;
+    missing orders are left out.
+    """
+    track_numbers = sorted(track_number for track_number, _ in updates)
+    placeholders = ', '.join(['%s'] * len(track_numbers))
+    # The lookup matches track numbers case-insensitively, so both sides are upper-cased
+    orders = {order['track_number'].upper(): order for order in db.fetchall(
+        ORDER_LOCK_FOR_STATUS_SELECT + f"WHERE track_number IN ({placeholders}) ORDER BY track_number FOR UPDATE",
+        tuple(track_numbers))}
+    updates = [(orders[track_number.upper()]['track_number'], status) for track_number, status in updates
+               if track_number.upper() in orders]
+    if not updates:
+        return orders
+    cases = " ".join(["WHEN %s THEN %s"] * len(updates))
+    params = [value for update in updates for value in update]
+    params.append(changed_at)
+    params.extend(track_number for track_number, _ in updates)
+    db.execute(f"UPDATE orders SET status = CASE track_number {cases} END, status_updated_at = %s "
+               f"WHERE track_number IN ({', '.join(['%s'] * len(updates))})", tuple(params))
+    add_order_stats(db, [change for track_number, status in updates
+                         for change in status_change_stats(orders[track_number.upper()], status)])
+    return orders
+
+@app.route('/api/orders/status:batch', methods=['POST'])
+def update_order_statuses_api():
+    """API endpoint to update the status of many orders in one transaction."""
+    try:
+        data = request.get_json()
+        items = parse_status_batch(data)
+    except BadRequest:
+        return jsonify({'error': 'Invalid JSON data'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    updates = [(track_number, status) for track_number, status, error in items if error is None]
+
+    try:
+        changed_at = datetime.now()
+        updated_orders = {}
+        with db_transaction() as db:
+            orders = update_order_statuses(db, updates, changed_at) if updates else {}
+            if orders and data.get('return_orders'):
+                placeholders = ', '.join(['%s'] * len(orders))
+                updated_orders = {order['track_number'].upper(): order for order in db.fetchall(
+                    ORDER_SELECT + f"WHERE o.track_number IN ({placeholders})",
+                    tuple(order['track_number'] for order in orders.values()), map_order)}
+    except MySQLError as e:
+        logger.error(f"Database error updating the status of {len(updates)} orders: {e}")
+        return jsonify({'error': 'Database error updating status', 'details': str(e)}), 500
+
+    results = []
+    events = []
+    for track_number, status, error in items:
+        if error:
+            results.append({'track_number': track_number, 'result': 'invalid', 'error': error})
+        elif track_number.upper() not in orders:
+            results.append({'track_number': track_number, 'result': 'not_found', 'error': 'Order not found'})
+        else:
+            order = orders[track_number.upper()]
+            results.append({'track_number': track_number, 'result': 'updated', 'status': status})
+            events.append(status_change_event(order, status, changed_at))
+            invalidate_tracking_cache(track_number.upper()) # USSD tracking looks orders up upper-cased
+            update_transporter_open_orders(order, status)
+            if updated_orders:
+                results[-1]['order'] = updated_orders.get(track_number.upper())
+    if events:
+        status_events.add(events)
+        invalidate_report_cache()
+    logger.info(f"Batch status update via API: {len(events)} of {len(items)} orders updated.")
+    return jsonify({'updated': len(events), 'results': results}), 200
+
+named_query('status_events.for_order', """SELECT status, changed_at, previous_status
+FROM order_status_events WHERE track_number = %s ORDER BY changed_at, id""")
+
+@app.route('/api/orders/<string:track_number>/status-history', methods=['GET'])
+def get_order_status_history(track_number):
+    """The statuses an order has been in, oldest first. Events reach the table within ORDER_EVENT_FLUSH_INTERVAL."""
+    try:
+        with db_session() as db:
+            events = db.fetchall('status_events.for_order', (track_number,), map_row)
+        return jsonify(events), 200
+    except MySQLError as e:
+        logger.error(f"Database error fetching status history for order {track_number}: {e}")
+        return jsonify({'error': 'Failed to fetch status history', 'details': str(e)}), 500
+
+def build_update_set(data, fields):
+    """
+    SET clause for the `fields` present in `data`, as (assignments, values).
+    `fields` maps a field name to a converter for its value, or None to store it as sent.
+    """
+    assignments = []
+    values = []
+    for field, convert in fields.items():
+        if field in data:
+            assignments.append(f"{field} = %s")
+            values.append(convert(data[field]) if convert else data[field])
+    return assignments, values
+
 # --- CRUD APIs for New Entities ---
 
 # Transporters API
+TRANSPORTER_COLUMNS = "id, name, phone, rating, vehicle_details, notes, created_at, updated_at"
+named_query('transporters.insert', "INSERT INTO transporters (name, phone, rating, vehicle_details, notes) VALUES (%s, %s, %s, %s, %s)")
+named_query('transporters.list', f"SELECT {TRANSPORTER_COLUMNS} FROM transporters ORDER BY name")
+named_query('transporters.get', f"SELECT {TRANSPORTER_COLUMNS} FROM transporters WHERE id = %s")
+named_query('transporters.delete', "DELETE FROM transporters WHERE id = %s")
+
 @app.route('/api/transporters', methods=['POST'])
 def create_transporter():
-    conn = None
-    cursor = None
     try:
         data = request.get_json()
         if not data or not data.get('name') or not data.get('phone'):
             return jsonify({'error': 'Missing required fields: name and phone'}), 400
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
-        sql = """INSERT INTO transporters (name, phone, rating, vehicle_details, notes)
-                 VALUES (%s, %s, %s, %s, %s)"""
-        cursor.execute(sql, (data['name'], data['phone'], data.get('rating'),
-                              data.get('vehicle_details'), data.get('notes')))
-        conn.commit()
-        transporter_id = cursor.lastrowid
+        with db_transaction() as db:
+            transporter_id = db.execute('transporters.insert', (data['name'], data['phone'], data.get('rating'),
+                                                                data.get('vehicle_details'), data.get('notes'))).lastrowid
+        transporter_index.mark_stale()
         return jsonify({'message': 'Transporter created successfully', 'id': transporter_id}), 201
     except MySQLError as e:
         logger.error(f"Database error creating transporter: {e}")
-        if conn: conn.rollback()
         # Check for unique constraint violation (e.g., phone)
         if e.errno == 1062: # Error number for duplicate entry
             return jsonify({'error': 'Duplicate entry, transporter with this phone may already exist.'}), 409
@@ -1222,25 +3288,13 @@ def create_transporter():
         return jsonify({'error': 'Invalid JSON data'}), 400
     except Exception as e:
         logger.error(f"Unexpected error creating transporter: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/transporters', methods=['GET'])
 def get_transporters():
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, name, phone, rating, vehicle_details, notes, created_at, updated_at FROM transporters ORDER BY name")
-        transporters = cursor.fetchall()
-        for t in transporters: # Convert datetime to ISO format
-            if isinstance(t.get('created_at'), datetime): t['created_at'] = t['created_at'].isoformat()
-            if isinstance(t.get('updated_at'), datetime): t['updated_at'] = t['updated_at'].isoformat()
+        with db_session() as db:
+            transporters = db.fetchall('transporters.list', (), map_row)
         return jsonify(transporters), 200
     except MySQLError as e:
         logger.error(f"Database error fetching transporters: {e}")
@@ -1248,23 +3302,13 @@ def get_transporters():
     except Exception as e:
         logger.error(f"Unexpected error fetching transporters: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/transporters/<int:transporter_id>', methods=['GET'])
 def get_transporter(transporter_id):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, name, phone, rating, vehicle_details, notes, created_at, updated_at FROM transporters WHERE id = %s", (transporter_id,))
-        transporter = cursor.fetchone()
+        with db_session() as db:
+            transporter = db.fetchone('transporters.get', (transporter_id,), map_row)
         if transporter:
-            if isinstance(transporter.get('created_at'), datetime): transporter['created_at'] = transporter['created_at'].isoformat()
-            if isinstance(transporter.get('updated_at'), datetime): transporter['updated_at'] = transporter['updated_at'].isoformat()
             return jsonify(transporter), 200
         return jsonify({'error': 'Transporter not found'}), 404
     except MySQLError as e:
@@ -1273,56 +3317,31 @@ def get_transporter(transporter_id):
     except Exception as e:
         logger.error(f"Unexpected error fetching transporter {transporter_id}: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/transporters/<int:transporter_id>', methods=['PUT'])
 def update_transporter(transporter_id):
-    conn = None
-    cursor = None
     try:
         data = request.get_json()
         if not data: return jsonify({'error': 'No data provided for update'}), 400
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
         # Construct SQL query dynamically based on provided fields
-        update_fields = []
-        update_values = []
-        if 'name' in data:
-            update_fields.append("name = %s")
-            update_values.append(data['name'])
-        if 'phone' in data:
-            update_fields.append("phone = %s")
-            update_values.append(data['phone'])
-        if 'rating' in data:
-            update_fields.append("rating = %s")
-            update_values.append(data['rating'])
-        if 'vehicle_details' in data:
-            update_fields.append("vehicle_details = %s")
-            update_values.append(data['vehicle_details'])
-        if 'notes' in data:
-            update_fields.append("notes = %s")
-            update_values.append(data['notes'])
-
+        update_fields, update_values = build_update_set(data, {
+            'name': None, 'phone': None, 'rating': None, 'vehicle_details': None, 'notes': None})
         if not update_fields:
             return jsonify({'error': 'No valid fields provided for update'}), 400
 
         update_values.append(transporter_id)
         sql = f"UPDATE transporters SET {', '.join(update_fields)}, updated_at = NOW() WHERE id = %s"
+        with db_transaction() as db:
+            updated = db.execute(sql, tuple(update_values)).rowcount
+        tracking_cache.clear() # Cached tracking screens show transporter name/phone
+        transporter_index.mark_stale()
 
-        cursor.execute(sql, tuple(update_values))
-        conn.commit()
-
-        if cursor.rowcount == 0:
+        if updated == 0:
             return jsonify({'error': 'Transporter not found or no new data to update'}), 404
         return jsonify({'message': 'Transporter updated successfully'}), 200
     except MySQLError as e:
         logger.error(f"Database error updating transporter {transporter_id}: {e}")
-        if conn: conn.rollback()
         if e.errno == 1062: # Error number for duplicate entry (e.g. phone)
             return jsonify({'error': 'Update failed, phone number may already exist for another transporter.'}), 409
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
@@ -1330,71 +3349,60 @@ def update_transporter(transporter_id):
         return jsonify({'error': 'Invalid JSON data'}), 400
     except Exception as e:
         logger.error(f"Unexpected error updating transporter {transporter_id}: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/transporters/<int:transporter_id>', methods=['DELETE'])
 def delete_transporter(transporter_id):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
         # Note: Consider implications of ON DELETE SET NULL for orders.transporter_id
-        cursor.execute("DELETE FROM transporters WHERE id = %s", (transporter_id,))
-        conn.commit()
+        with db_transaction() as db:
+            deleted = db.execute('transporters.delete', (transporter_id,)).rowcount
+        tracking_cache.clear()
+        transporter_index.remove(transporter_id)
 
-        if cursor.rowcount == 0:
+        if deleted == 0:
             return jsonify({'error': 'Transporter not found'}), 404
         return jsonify({'message': 'Transporter deleted successfully'}), 200
     except MySQLError as e:
         # Handle cases where transporter cannot be deleted due to foreign key constraints
         # if not handled by ON DELETE SET NULL or ON DELETE CASCADE (which we are not using here for delete)
         logger.error(f"Database error deleting transporter {transporter_id}: {e}")
-        if conn: conn.rollback()
         if e.errno == 1451: # Foreign key constraint fails
              return jsonify({'error': 'Cannot delete transporter, they are referenced in existing orders. Consider deactivating instead.'}), 409
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
     except Exception as e:
         logger.error(f"Unexpected error deleting transporter {transporter_id}: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 # Locations API
+LOCATION_TYPES = ['pickup', 'destination', 'both']
+LOCATION_COLUMNS = "id, name, type, region, is_active, created_at, updated_at"
+named_query('locations.insert', "INSERT INTO locations (name, type, region, is_active) VALUES (%s, %s, %s, %s)")
+named_query('locations.list', f"SELECT {LOCATION_COLUMNS} FROM locations ORDER BY name")
+# 'both' locations can serve as either pickup or destination
+named_query('locations.list_usable_as', f"SELECT {LOCATION_COLUMNS} FROM locations WHERE type = %s OR type = 'both' ORDER BY name")
+named_query('locations.list_by_type', f"SELECT {LOCATION_COLUMNS} FROM locations WHERE type = %s ORDER BY name")
+named_query('locations.get', f"SELECT {LOCATION_COLUMNS} FROM locations WHERE id = %s")
+named_query('locations.delete', "DELETE FROM locations WHERE id = %s")
+
 @app.route('/api/locations', methods=['POST'])
 def create_location():
-    conn = None
-    cursor = None
     try:
         data = request.get_json()
         if not data or not data.get('name'):
             return jsonify({'error': 'Missing required field: name'}), 400
 
         location_type = data.get('type', 'both')
-        if location_type not in ['pickup', 'destination', 'both']:
+        if location_type not in LOCATION_TYPES:
             return jsonify({'error': "Invalid type. Must be 'pickup', 'destination', or 'both'."}), 400
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
-        sql = """INSERT INTO locations (name, type, region, is_active)
-                 VALUES (%s, %s, %s, %s)"""
-        cursor.execute(sql, (data['name'], location_type, data.get('region'), data.get('is_active', True)))
-        conn.commit()
-        location_id = cursor.lastrowid
+        with db_transaction() as db:
+            location_id = db.execute('locations.insert', (data['name'], location_type, data.get('region'),
+                                                          data.get('is_active', True))).lastrowid
+        invalidate_catalog_cache()
         return jsonify({'message': 'Location created successfully', 'id': location_id}), 201
     except MySQLError as e:
         logger.error(f"Database error creating location: {e}")
-        if conn: conn.rollback()
         if e.errno == 1062: # Unique constraint (name, type)
             return jsonify({'error': f"Location with name '{data.get('name')}' and type '{location_type}' may already exist."}), 409
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
@@ -1402,45 +3410,22 @@ def create_location():
         return jsonify({'error': 'Invalid JSON data'}), 400
     except Exception as e:
         logger.error(f"Unexpected error creating location: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/locations', methods=['GET'])
 def get_locations():
-    conn = None
-    cursor = None
     try:
         filter_type = request.args.get('type')
-
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
-
-        query = "SELECT id, name, type, region, is_active, created_at, updated_at FROM locations"
-        params = []
-        if filter_type:
-            if filter_type not in ['pickup', 'destination', 'both']:
-                 return jsonify({'error': "Invalid type filter. Must be 'pickup', 'destination', or 'both'."}), 400
-            query += " WHERE type = %s OR type = 'both'" # 'both' locations can serve as either
-            if filter_type == 'pickup': # if specifically pickup, then type='pickup' or type='both'
-                params.append('pickup')
-            elif filter_type == 'destination': # if specifically destination, then type='destination' or type='both'
-                params.append('destination')
-            else: # if 'both' is queried, it means locations explicitly marked as 'both'
-                 query = "SELECT id, name, type, region, is_active, created_at, updated_at FROM locations WHERE type = %s"
-                 params.append('both')
-
-
-        query += " ORDER BY name"
-        cursor.execute(query, tuple(params) if params else None)
-
-        locations = cursor.fetchall()
-        for loc in locations: # Convert datetime to ISO format
-            if isinstance(loc.get('created_at'), datetime): loc['created_at'] = loc['created_at'].isoformat()
-            if isinstance(loc.get('updated_at'), datetime): loc['updated_at'] = loc['updated_at'].isoformat()
+        if filter_type and filter_type not in LOCATION_TYPES:
+            return jsonify({'error': "Invalid type filter. Must be 'pickup', 'destination', or 'both'."}), 400
+
+        with db_session() as db:
+            if not filter_type:
+                locations = db.fetchall('locations.list', (), map_row)
+            elif filter_type == 'both': # Only locations explicitly marked as 'both'
+                locations = db.fetchall('locations.list_by_type', ('both',), map_row)
+            else: # 'pickup' or 'destination', including 'both' locations
+                locations = db.fetchall('locations.list_usable_as', (filter_type,), map_row)
         return jsonify(locations), 200
     except MySQLError as e:
         logger.error(f"Database error fetching locations: {e}")
@@ -1448,23 +3433,13 @@ def get_locations():
     except Exception as e:
         logger.error(f"Unexpected error fetching locations: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/locations/<int:location_id>', methods=['GET'])
 def get_location(location_id):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, name, type, region, is_active, created_at, updated_at FROM locations WHERE id = %s", (location_id,))
-        location = cursor.fetchone()
+        with db_session() as db:
+            location = db.fetchone('locations.get', (location_id,), map_row)
         if location:
-            if isinstance(location.get('created_at'), datetime): location['created_at'] = location['created_at'].isoformat()
-            if isinstance(location.get('updated_at'), datetime): location['updated_at'] = location['updated_at'].isoformat()
             return jsonify(location), 200
         return jsonify({'error': 'Location not found'}), 404
     except MySQLError as e:
@@ -1473,55 +3448,31 @@ def get_location(location_id):
     except Exception as e:
         logger.error(f"Unexpected error fetching location {location_id}: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/locations/<int:location_id>', methods=['PUT'])
 def update_location(location_id):
-    conn = None
-    cursor = None
     try:
         data = request.get_json()
         if not data: return jsonify({'error': 'No data provided for update'}), 400
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
-        update_fields = []
-        update_values = []
-        if 'name' in data:
-            update_fields.append("name = %s")
-            update_values.append(data['name'])
-        if 'type' in data:
-            location_type = data['type']
-            if location_type not in ['pickup', 'destination', 'both']:
-                return jsonify({'error': "Invalid type. Must be 'pickup', 'destination', or 'both'."}), 400
-            update_fields.append("type = %s")
-            update_values.append(location_type)
-        if 'region' in data:
-            update_fields.append("region = %s")
-            update_values.append(data['region'])
-        if 'is_active' in data:
-            update_fields.append("is_active = %s")
-            update_values.append(bool(data['is_active']))
-
+        if 'type' in data and data['type'] not in LOCATION_TYPES:
+            return jsonify({'error': "Invalid type. Must be 'pickup', 'destination', or 'both'."}), 400
+        update_fields, update_values = build_update_set(data, {
+            'name': None, 'type': None, 'region': None, 'is_active': bool})
         if not update_fields:
             return jsonify({'error': 'No valid fields provided for update'}), 400
 
         update_values.append(location_id)
         sql = f"UPDATE locations SET {', '.join(update_fields)}, updated_at = NOW() WHERE id = %s"
+        with db_transaction() as db:
+            updated = db.execute(sql, tuple(update_values)).rowcount
+        invalidate_catalog_cache()
 
-        cursor.execute(sql, tuple(update_values))
-        conn.commit()
-
-        if cursor.rowcount == 0:
+        if updated == 0:
             return jsonify({'error': 'Location not found or no new data to update'}), 404
         return jsonify({'message': 'Location updated successfully'}), 200
     except MySQLError as e:
         logger.error(f"Database error updating location {location_id}: {e}")
-        if conn: conn.rollback()
         if e.errno == 1062: # Unique constraint (name, type)
              return jsonify({'error': f"Update failed, location name and type combination may already exist."}), 409
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
@@ -1529,64 +3480,52 @@ def update_location(location_id):
         return jsonify({'error': 'Invalid JSON data'}), 400
     except Exception as e:
         logger.error(f"Unexpected error updating location {location_id}: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/locations/<int:location_id>', methods=['DELETE'])
 def delete_location(location_id):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
-        cursor.execute("DELETE FROM locations WHERE id = %s", (location_id,))
-        conn.commit()
-
-        if cursor.rowcount == 0:
+        with db_transaction() as db:
+            deleted = db.execute('locations.delete', (location_id,)).rowcount
+            if deleted:
+                detach_order_stats(db, ('pickup_location_id', 'destination_location_id'), location_id)
+        invalidate_catalog_cache()
+        if deleted:
+            invalidate_report_cache()
+
+        if deleted == 0:
             return jsonify({'error': 'Location not found'}), 404
         return jsonify({'message': 'Location deleted successfully'}), 200
     except MySQLError as e:
         logger.error(f"Database error deleting location {location_id}: {e}")
-        if conn: conn.rollback()
         if e.errno == 1451: # Foreign key constraint fails
              return jsonify({'error': 'Cannot delete location, it is referenced in existing orders. Consider deactivating it instead.'}), 409
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
     except Exception as e:
         logger.error(f"Unexpected error deleting location {location_id}: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 # Crops API
+CROP_COLUMNS = "id, name, description, is_active, created_at, updated_at"
+named_query('crops.insert', "INSERT INTO crops (name, description, is_active) VALUES (%s, %s, %s)")
+named_query('crops.list', f"SELECT {CROP_COLUMNS} FROM crops ORDER BY name")
+named_query('crops.list_by_active', f"SELECT {CROP_COLUMNS} FROM crops WHERE is_active = %s ORDER BY name")
+named_query('crops.get', f"SELECT {CROP_COLUMNS} FROM crops WHERE id = %s")
+named_query('crops.delete', "DELETE FROM crops WHERE id = %s")
+
 @app.route('/api/crops', methods=['POST'])
 def create_crop():
-    conn = None
-    cursor = None
     try:
         data = request.get_json()
         if not data or not data.get('name'):
             return jsonify({'error': 'Missing required field: name'}), 400
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
-        sql = """INSERT INTO crops (name, description, is_active)
-                 VALUES (%s, %s, %s)"""
-        cursor.execute(sql, (data['name'], data.get('description'), data.get('is_active', True)))
-        conn.commit()
-        crop_id = cursor.lastrowid
+        with db_transaction() as db:
+            crop_id = db.execute('crops.insert', (data['name'], data.get('description'), data.get('is_active', True))).lastrowid
+        invalidate_catalog_cache()
         return jsonify({'message': 'Crop created successfully', 'id': crop_id}), 201
     except MySQLError as e:
         logger.error(f"Database error creating crop: {e}")
-        if conn: conn.rollback()
         if e.errno == 1062: # Unique constraint (name)
             return jsonify({'error': f"Crop with name '{data.get('name')}' may already exist."}), 409
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
@@ -1594,41 +3533,19 @@ def create_crop():
         return jsonify({'error': 'Invalid JSON data'}), 400
     except Exception as e:
         logger.error(f"Unexpected error creating crop: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/crops', methods=['GET'])
 def get_crops():
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
-
         # Option to filter by is_active status, e.g., /api/crops?active=true
-        is_active_filter = request.args.get('active')
-        query = "SELECT id, name, description, is_active, created_at, updated_at FROM crops"
-        params = []
-
-        if is_active_filter is not None:
-            if is_active_filter.lower() == 'true':
-                query += " WHERE is_active = TRUE"
-            elif is_active_filter.lower() == 'false':
-                query += " WHERE is_active = FALSE"
-            # No else, if 'active' param is present but not true/false, ignore it or return error
-            # For now, ignoring invalid active filter values and returning all
-
-        query += " ORDER BY name"
-        cursor.execute(query, tuple(params)) # No params yet, but good practice
-
-        crops_list = cursor.fetchall()
-        for crop_item in crops_list: # Convert datetime to ISO format
-            if isinstance(crop_item.get('created_at'), datetime): crop_item['created_at'] = crop_item['created_at'].isoformat()
-            if isinstance(crop_item.get('updated_at'), datetime): crop_item['updated_at'] = crop_item['updated_at'].isoformat()
+        # Values other than true/false are ignored and all crops are returned
+        is_active_filter = (request.args.get('active') or '').lower()
+        with db_session() as db:
+            if is_active_filter in ('true', 'false'):
+                crops_list = db.fetchall('crops.list_by_active', (is_active_filter == 'true',), map_row)
+            else:
+                crops_list = db.fetchall('crops.list', (), map_row)
         return jsonify(crops_list), 200
     except MySQLError as e:
         logger.error(f"Database error fetching crops: {e}")
@@ -1636,23 +3553,13 @@ def get_crops():
     except Exception as e:
         logger.error(f"Unexpected error fetching crops: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/crops/<int:crop_id>', methods=['GET'])
 def get_crop(crop_id):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT id, name, description, is_active, created_at, updated_at FROM crops WHERE id = %s", (crop_id,))
-        crop_item = cursor.fetchone()
+        with db_session() as db:
+            crop_item = db.fetchone('crops.get', (crop_id,), map_row)
         if crop_item:
-            if isinstance(crop_item.get('created_at'), datetime): crop_item['created_at'] = crop_item['created_at'].isoformat()
-            if isinstance(crop_item.get('updated_at'), datetime): crop_item['updated_at'] = crop_item['updated_at'].isoformat()
             return jsonify(crop_item), 200
         return jsonify({'error': 'Crop not found'}), 404
     except MySQLError as e:
@@ -1661,49 +3568,28 @@ def get_crop(crop_id):
     except Exception as e:
         logger.error(f"Unexpected error fetching crop {crop_id}: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/crops/<int:crop_id>', methods=['PUT'])
 def update_crop(crop_id):
-    conn = None
-    cursor = None
     try:
         data = request.get_json()
         if not data: return jsonify({'error': 'No data provided for update'}), 400
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
-        update_fields = []
-        update_values = []
-        if 'name' in data:
-            update_fields.append("name = %s")
-            update_values.append(data['name'])
-        if 'description' in data:
-            update_fields.append("description = %s")
-            update_values.append(data['description'])
-        if 'is_active' in data:
-            update_fields.append("is_active = %s")
-            update_values.append(bool(data['is_active']))
-
+        update_fields, update_values = build_update_set(data, {'name': None, 'description': None, 'is_active': bool})
         if not update_fields:
             return jsonify({'error': 'No valid fields provided for update'}), 400
 
         update_values.append(crop_id)
         sql = f"UPDATE crops SET {', '.join(update_fields)}, updated_at = NOW() WHERE id = %s"
+        with db_transaction() as db:
+            updated = db.execute(sql, tuple(update_values)).rowcount
+        invalidate_catalog_cache()
 
-        cursor.execute(sql, tuple(update_values))
-        conn.commit()
-
-        if cursor.rowcount == 0:
+        if updated == 0:
             return jsonify({'error': 'Crop not found or no new data to update'}), 404
         return jsonify({'message': 'Crop updated successfully'}), 200
     except MySQLError as e:
         logger.error(f"Database error updating crop {crop_id}: {e}")
-        if conn: conn.rollback()
         if e.errno == 1062: # Unique constraint (name)
              return jsonify({'error': f"Update failed, crop name may already exist."}), 409
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
@@ -1711,54 +3597,44 @@ def update_crop(crop_id):
         return jsonify({'error': 'Invalid JSON data'}), 400
     except Exception as e:
         logger.error(f"Unexpected error updating crop {crop_id}: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/crops/<int:crop_id>', methods=['DELETE'])
 def delete_crop(crop_id):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
-        cursor.execute("DELETE FROM crops WHERE id = %s", (crop_id,))
-        conn.commit()
-
-        if cursor.rowcount == 0:
+        with db_transaction() as db:
+            deleted = db.execute('crops.delete', (crop_id,)).rowcount
+            if deleted:
+                detach_order_stats(db, ('crop_id',), crop_id)
+        invalidate_catalog_cache()
+        if deleted:
+            invalidate_report_cache()
+
+        if deleted == 0:
             return jsonify({'error': 'Crop not found'}), 404
         return jsonify({'message': 'Crop deleted successfully'}), 200
     except MySQLError as e:
         logger.error(f"Database error deleting crop {crop_id}: {e}")
-        if conn: conn.rollback()
         if e.errno == 1451: # Foreign key constraint fails
              return jsonify({'error': 'Cannot delete crop, it is referenced in existing orders. Consider deactivating it instead.'}), 409
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
     except Exception as e:
         logger.error(f"Unexpected error deleting crop {crop_id}: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 # System Settings API
+named_query('settings.list', "SELECT setting_key, setting_value, description, updated_at FROM system_settings")
+named_query('settings.get', "SELECT setting_key, setting_value, description, updated_at FROM system_settings WHERE setting_key = %s")
+# Upsert; setting_key is the primary key
+named_query('settings.upsert', """INSERT INTO system_settings (setting_key, setting_value, description)
+VALUES (%s, %s, %s)
+ON DUPLICATE KEY UPDATE setting_value = VALUES(setting_value), description = VALUES(description), updated_at = NOW()""")
+
 @app.route('/api/system-settings', methods=['GET'])
 def get_all_system_settings():
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT setting_key, setting_value, description, updated_at FROM system_settings")
-        settings = cursor.fetchall()
-        for s in settings: # Convert datetime to ISO format
-            if isinstance(s.get('updated_at'), datetime): s['updated_at'] = s['updated_at'].isoformat()
+        with db_session() as db:
+            settings = db.fetchall('settings.list', (), map_row)
         return jsonify(settings), 200
     except MySQLError as e:
         logger.error(f"Database error fetching system settings: {e}")
@@ -1766,22 +3642,13 @@ def get_all_system_settings():
     except Exception as e:
         logger.error(f"Unexpected error fetching system settings: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/system-settings/<string:setting_key>', methods=['GET'])
 def get_system_setting(setting_key):
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT setting_key, setting_value, description, updated_at FROM system_settings WHERE setting_key = %s", (setting_key,))
-        setting = cursor.fetchone()
+        with db_session() as db:
+            setting = db.fetchone('settings.get', (setting_key,), map_row)
         if setting:
-            if isinstance(setting.get('updated_at'), datetime): setting['updated_at'] = setting['updated_at'].isoformat()
             return jsonify(setting), 200
         return jsonify({'error': 'System setting not found'}), 404
     except MySQLError as e:
@@ -1790,41 +3657,26 @@ def get_system_setting(setting_key):
     except Exception as e:
         logger.error(f"Unexpected error fetching system setting {setting_key}: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/system-settings/<string:setting_key>', methods=['PUT'])
 def update_system_setting(setting_key):
-    conn = None
-    cursor = None
     try:
         data = request.get_json()
         if not data or 'setting_value' not in data : # description is optional
             return jsonify({'error': 'Missing required field: setting_value'}), 400
 
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor()
-
-        # Using INSERT ... ON DUPLICATE KEY UPDATE for simplicity (upsert)
-        # Requires setting_key to be PRIMARY or UNIQUE for ON DUPLICATE KEY UPDATE to work as expected.
-        sql = """INSERT INTO system_settings (setting_key, setting_value, description)
-                 VALUES (%s, %s, %s)
-                 ON DUPLICATE KEY UPDATE setting_value = VALUES(setting_value), description = VALUES(description), updated_at = NOW()"""
-
-        cursor.execute(sql, (setting_key, data['setting_value'], data.get('description')))
-        conn.commit()
+        with db_transaction() as db:
+            rowcount = db.execute('settings.upsert', (setting_key, data['setting_value'], data.get('description'))).rowcount
 
         # lastrowid is not reliable for ON DUPLICATE KEY UPDATE.
         # rowcount returns 1 for INSERT, 2 for UPDATE (if data changed), 0 if no change.
-        if cursor.rowcount == 0 : # No change, means value was same. Still a success.
+        if rowcount == 0 : # No change, means value was same. Still a success.
              logger.info(f"System setting '{setting_key}' value unchanged.")
              return jsonify({'message': f"System setting '{setting_key}' value unchanged."}), 200
-        elif cursor.rowcount == 1: # Inserted
+        elif rowcount == 1: # Inserted
             logger.info(f"System setting '{setting_key}' created successfully.")
             return jsonify({'message': f"System setting '{setting_key}' created successfully."}), 201
-        elif cursor.rowcount == 2: # Updated
+        elif rowcount == 2: # Updated
             logger.info(f"System setting '{setting_key}' updated successfully.")
             return jsonify({'message': f"System setting '{setting_key}' updated successfully."}), 200
         else: # Should not happen with this logic but as a fallback
@@ -1833,35 +3685,415 @@ def update_system_setting(setting_key):
 
     except MySQLError as e:
         logger.error(f"Database error updating system setting {setting_key}: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'Database error', 'details': str(e)}), 500
     except BadRequest:
         return jsonify({'error': 'Invalid JSON data'}), 400
     except Exception as e:
         logger.error(f"Unexpected error updating system setting {setting_key}: {e}")
-        if conn: conn.rollback()
         return jsonify({'error': 'An unexpected error occurred'}), 500
+
+# --- Bulk import ---
+# POST /api/import/<entity> and `flask import-data` load transporters, locations or crops from
+# CSV or NDJSON. Input is read and validated record by record, so memory does not grow with
+# the file. Valid rows are written in batches of IMPORT_BATCH_SIZE, each batch in its own
+# transaction: one SELECT to tell which keys already exist, and one executemany() upsert
+# (sent as a single multi-row INSERT ... ON DUPLICATE KEY UPDATE) on the table's unique key.
+# Empty or missing optional fields keep the existing value of a row that is updated.
+# If a batch fails, its rows are retried one by one, so the error lands on the offending row.
+
+def import_text(value):
+    """A text field from an import record: stripped, with '' and null as None."""
+    if value is None:
+        return None
+    return str(value).strip() or None
+
+def import_bool(value):
+    """A boolean field from an import record (true/false, 1/0, yes/no), None if empty."""
+    if isinstance(value, bool):
+        return value
+    text = (import_text(value) or '').lower()
+    if not text:
+        return None
+    if text in ('true', '1', 'yes'):
+        return True
+    if text in ('false', '0', 'no'):
+        return False
+    raise ValueError(f"Invalid boolean: {value}")
+
+def transporter_import_values(record):
+    values = {field: import_text(record.get(field)) for field in ('name', 'phone', 'rating', 'vehicle_details', 'notes')}
+    if not values['name'] or not values['phone']:
+        raise ValueError('Missing required fields: name and phone')
+    return values
+
+def location_import_values(record):
+    values = {'name': import_text(record.get('name')), 'type': import_text(record.get('type')) or 'both',
+              'region': import_text(record.get('region')), 'is_active': import_bool(record.get('is_active'))}
+    if not values['name']:
+        raise ValueError('Missing required field: name')
+    if values['type'] not in LOCATION_TYPES:
+        raise ValueError("Invalid type. Must be 'pickup', 'destination', or 'both'.")
+    return values
+
+def crop_import_values(record):
+    values = {'name': import_text(record.get('name')), 'description': import_text(record.get('description')),
+              'is_active': import_bool(record.get('is_active'))}
+    if not values['name']:
+        raise ValueError('Missing required field: name')
+    return values
+
+def transporters_imported():
+    tracking_cache.clear() # Cached tracking screens show transporter name/phone
+    transporter_index.mark_stale()
+
+# Entity: table, columns in INSERT order, unique key columns, record -> {column: value}
+# (raises ValueError), defaults for new rows, and what to invalidate afterwards
+IMPORT_ENTITIES = {
+    'transporters': {
+        'table': 'transporters', 'columns': ('name', 'phone', 'rating', 'vehicle_details', 'notes'), 'key': ('phone',),
+        'values': transporter_import_values, 'defaults': {}, 'imported': transporters_imported,
+    },
+    'locations': {
+        'table': 'locations', 'columns': ('name', 'type', 'region', 'is_active'), 'key': ('name', 'type'),
+        'values': location_import_values, 'defaults': {'is_active': True}, 'imported': invalidate_catalog_cache,
+    },
+    'crops': {
+        'table': 'crops', 'columns': ('name', 'description', 'is_active'), 'key': ('name',),
+        'values': crop_import_values, 'defaults': {'is_active': True}, 'imported': invalidate_catalog_cache,
+    },
+}
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+def import_upsert_sql(spec):
+    columns = spec['columns']
+    updates = [f"{column} = COALESCE(VALUES({column}), {column})" for column in columns if column not in spec['key']]
+    return (f"INSERT INTO {spec['table']} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})\n"
+            f"ON DUPLICATE KEY UPDATE {', '.join(updates)}, updated_at = NOW()")
+
+def import_key(spec, values):
+    # Compared the way the unique index compares them (case-insensitive collation)
+    return tuple(values[column].lower() for column in spec['key'])
+
+def existing_import_keys(db, spec, keys):
+    """The subset of `keys` (from import_key) already in the table."""
+    columns = spec['key']
+    if len(columns) == 1:
+        condition = f"{columns[0]} IN ({', '.join(['%s'] * len(keys))})"
+    else:
+        row = f"({', '.join(['%s'] * len(columns))})"
+        condition = f"({', '.join(columns)}) IN ({', '.join([row] * len(keys))})"
+    rows = db.fetchall(f"SELECT {', '.join(columns)} FROM {spec['table']} WHERE {condition}",
+                       tuple(value for key in keys for value in key))
+    return {tuple(str(row[column]).lower() for column in columns) for row in rows}
+
+def read_import_records(stream, import_format):
+    """Yields (line, record, error) for each record of a text stream; `record` is a dict, or None with an `error`."""
+    if import_format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record, None
+        return
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_number, None, f"Invalid JSON: {e}"
+            continue
+        if isinstance(record, dict):
+            yield line_number, record, None
+        else:
+            yield line_number, None, 'Each line must be a JSON object'
+
+def write_import_batch(spec, batch, seen):
+    """
+    Upserts a batch of (line, values) in one transaction and yields a result per row. `seen`
+    holds the keys written earlier in the import, and gets this batch's keys once committed.
+    Raises DatabaseUnavailable if no connection can be had.
+    """
+    keys = [import_key(spec, values) for _, values in batch]
+    results = []
+    try:
+        with db_transaction() as db:
+            unseen = list(dict.fromkeys(key for key in keys if key not in seen))
+            known = set(seen) | (existing_import_keys(db, spec, unseen) if unseen else set())
+            rows = []
+            for (line, values), key in zip(batch, keys):
+                exists = key in known
+                if not exists:
+                    values = dict(spec['defaults'], **{k: v for k, v in values.items() if v is not None})
+                    known.add(key)
+                rows.append(tuple(values.get(column) for column in spec['columns']))
+                results.append({'line': line, 'result': 'updated' if exists else 'created'})
+            db.executemany(import_upsert_sql(spec), rows)
+    except DatabaseUnavailable:
+        raise
+    except MySQLError as e:
+        if len(batch) == 1:
+            yield {'line': batch[0][0], 'result': 'failed', 'error': str(e)}
+            return
+        logger.warning(f"Import batch of {len(batch)} {spec['table']} failed, retrying row by row: {e}")
+        for row in batch:
+            yield from write_import_batch(spec, [row], seen)
+        return
+    seen.update(keys)
+    yield from results
+
+def import_records(entity, records, batch_size):
+    """
+    Validates and upserts (line, record, error) tuples from read_import_records() into `entity`,
+    yielding a result per record: created, updated, invalid or failed (with an error).
+    Results for invalid records come as soon as they are read, the others once their batch is written.
+    """
+    spec = IMPORT_ENTITIES[entity]
+    batch = []
+    seen = set()
+    try:
+        for line, record, error in records:
+            if error is None:
+                try:
+                    values = spec['values'](record)
+                except ValueError as e:
+                    error = str(e)
+            if error:
+                yield {'line': line, 'result': 'invalid', 'error': error}
+                continue
+            batch.append((line, values))
+            if len(batch) >= batch_size:
+                yield from write_import_batch(spec, batch, seen)
+                batch = []
+        if batch:
+            yield from write_import_batch(spec, batch, seen)
     finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        if seen:
+            spec['imported']()
+
+def summarize_import(results):
+    summary = {result: 0 for result in ('created', 'updated', 'invalid', 'failed')}
+    for result in results:
+        summary[result['result']] += 1
+    return summary
+
+@app.route('/api/import/<string:entity>', methods=['POST'])
+def import_entities(entity):
+    """
+    Bulk upsert of transporters, locations or crops from the request body: CSV with a header row
+    or NDJSON (?format=, by default from the Content-Type). Responds with a result per record.
+    """
+    if entity not in IMPORT_ENTITIES:
+        return jsonify({'error': f"Unknown entity. Must be one of: {', '.join(IMPORT_ENTITIES)}"}), 404
+    import_format = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'ndjson')
+    if import_format not in IMPORT_FORMATS:
+        return jsonify({'error': f"Invalid format. Must be one of: {', '.join(IMPORT_FORMATS)}"}), 400
+    try:
+        batch_size = int(request.args.get('batch_size', Config.IMPORT_BATCH_SIZE))
+    except ValueError:
+        return jsonify({'error': 'batch_size must be an integer'}), 400
+    if not 1 <= batch_size <= Config.IMPORT_MAX_BATCH_SIZE:
+        return jsonify({'error': f"batch_size must be between 1 and {Config.IMPORT_MAX_BATCH_SIZE}"}), 400
+
+    # utf-8-sig skips the byte order mark spreadsheet programs put in front of CSV exports
+    stream = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig', newline='')
+    results = []
+    try:
+        for result in import_records(entity, read_import_records(stream, import_format), batch_size):
+            results.append(result)
+    except (csv.Error, UnicodeDecodeError) as e:
+        # Rows before this point are already written; the results say which
+        results.sort(key=lambda result: result['line'])
+        return jsonify({'error': f"Could not read the input: {e}", **summarize_import(results), 'results': results}), 400
+    except MySQLError as e:
+        logger.error(f"Database error importing {entity}: {e}")
+        results.sort(key=lambda result: result['line'])
+        return jsonify({'error': 'Database error', 'details': str(e), **summarize_import(results), 'results': results}), 500
+
+    results.sort(key=lambda result: result['line'])
+    summary = summarize_import(results)
+    logger.info(f"Imported {entity} via API: {summary}")
+    return jsonify({**summary, 'results': results}), 200
+
+@app.cli.command('import-data')
+@click.argument('entity', type=click.Choice(list(IMPORT_ENTITIES)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(IMPORT_FORMATS),
+              help='Input format (default: csv for a .csv file, otherwise ndjson).')
+@click.option('--batch-size', type=click.IntRange(1), default=Config.IMPORT_BATCH_SIZE, show_default=True,
+              help='Rows per multi-row upsert (and transaction).')
+def import_data_command(entity, path, import_format, batch_size):
+    """Bulk upserts transporters, locations or crops from a CSV or NDJSON file; lists the rows that were not imported."""
+    init_db_pool()
+    if not db_pool:
+        raise click.ClickException("Database pool could not be initialized.")
+    import_format = import_format or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+    started = time.perf_counter()
+    summary = {result: 0 for result in ('created', 'updated', 'invalid', 'failed')}
+    with open(path, encoding='utf-8-sig', newline='') as stream:
+        try:
+            for result in import_records(entity, read_import_records(stream, import_format), batch_size):
+                summary[result['result']] += 1
+                if 'error' in result:
+                    click.echo(f"line {result['line']}: {result['result']}: {result['error']}", err=True)
+        except (csv.Error, UnicodeDecodeError, MySQLError) as e:
+            raise click.ClickException(f"Import stopped ({', '.join(f'{k}: {v}' for k, v in summary.items())}): {e}")
+    click.echo(f"Imported {entity} in {time.perf_counter() - started:.1f}s: "
+               + ', '.join(f"{count} {result}" for result, count in summary.items()))
+    if summary['invalid'] or summary['failed']:
+        raise click.ClickException(f"{summary['invalid'] + summary['failed']} rows were not imported.")
+
+# --- Report cache ---
+# Dashboards refetch the reports on every mount and ops screens stay open all day. A report
+# response is cached per (path, query string) for REPORT_CACHE_TTL seconds and carries a strong
+# ETag (a hash of the body), so a client that already has it gets a bodyless 304. Writes that
+# change orders call invalidate_report_cache() once committed. Like the tracking cache this is
+# per process; the TTL bounds staleness across workers.
+report_cache = TTLCache(Config.REPORT_CACHE_MAX_ENTRIES, Config.REPORT_CACHE_TTL)
+
+def invalidate_report_cache():
+    report_cache.clear()
+
+def cached_report(view):
+    """Serves a report view through report_cache and answers If-None-Match with 304. Errors are not cached."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.path, tuple(sorted(request.args.items(multi=True))))
+        entry = report_cache.get(key)
+        if entry is None:
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            entry = (body, hashlib.sha256(body).hexdigest()[:32])
+            report_cache.set(key, entry)
+        body, etag = entry
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache' # Browsers may keep it but must revalidate
+        return response.make_conditional(request)
+    return wrapper
 
 # --- Reporting Data API Endpoints ---
+# The summary reads the orders_daily_stats rollup, so its cost grows with days, not orders.
+# SUM() is cast because mysql.connector returns it as a Decimal.
+named_query('reports.total_orders', "SELECT CAST(COALESCE(SUM(order_count), 0) AS SIGNED) as total_orders FROM orders_daily_stats")
+named_query('reports.orders_by_status', """SELECT NULLIF(status, '') as status, CAST(SUM(order_count) AS SIGNED) as count
+FROM orders_daily_stats
+GROUP BY status
+HAVING count > 0""")
+
+# Orders over time: counts per hour, day, week (starting Monday) or month between start and end.
+# Day, week and month buckets are summed from the rollup by a range on its stat_date primary key
+# prefix; hours come from orders by a created_at range, served by idx_orders_created_at (or
+# idx_orders_status_created with a status filter). Both tables carry the filter columns under
+# the same names. Buckets without orders are filled in with a zero count.
+REPORT_GRANULARITIES = ('hour', 'day', 'week', 'month')
+# Query parameter: converter; `status` is handled separately since it may repeat
+REPORT_FILTERS = {
+    'crop_id': int,
+    'pickup_location_id': int,
+    'destination_location_id': int,
+}
+
+def report_bucket(value, granularity):
+    """Start of the `granularity` bucket containing the datetime `value`."""
+    if granularity == 'hour':
+        return value.replace(minute=0, second=0, microsecond=0)
+    day = datetime(value.year, value.month, value.day)
+    if granularity == 'week':
+        return day - timedelta(days=day.weekday())
+    if granularity == 'month':
+        return day.replace(day=1)
+    return day
+
+def next_report_bucket(bucket, granularity):
+    if granularity == 'hour':
+        return bucket + timedelta(hours=1)
+    if granularity == 'week':
+        return bucket + timedelta(days=7)
+    if granularity == 'month':
+        return bucket.replace(year=bucket.year + 1, month=1) if bucket.month == 12 else bucket.replace(month=bucket.month + 1)
+    return bucket + timedelta(days=1)
+
+def report_buckets(start, end, granularity):
+    """Starts of the buckets overlapping [start, end), and the end of the last one."""
+    buckets = []
+    bucket = report_bucket(start, granularity)
+    while bucket < end:
+        if len(buckets) == Config.REPORT_MAX_BUCKETS:
+            raise ValueError(f"Range has more than {Config.REPORT_MAX_BUCKETS} {granularity} buckets; use a coarser granularity")
+        buckets.append(bucket)
+        bucket = next_report_bucket(bucket, granularity)
+    return buckets, bucket
+
+def report_filter_conditions(args):
+    """WHERE conditions and parameters for the report filters in `args`. Raises ValueError for a bad value."""
+    conditions = []
+    params = []
+    statuses = [status for status in args.getlist('status') if status]
+    if statuses:
+        conditions.append(f"status IN ({', '.join(['%s'] * len(statuses))})")
+        params.extend(statuses)
+    for name, convert in REPORT_FILTERS.items():
+        value = args.get(name)
+        if value:
+            try:
+                params.append(convert(value))
+            except ValueError:
+                raise ValueError(f"Invalid value for {name}: {value}")
+            conditions.append(f"{name} = %s")
+    return conditions, params
+
+def report_range(args):
+    """
+    (start, end) datetimes from the `start` and `end` parameters in `args`, by default the last
+    REPORT_DEFAULT_DAYS days up to and including today. `end` is exclusive; a date alone includes
+    that whole day (as for created_to on /api/orders). Raises ValueError for a bad value.
+    """
+    if args.get('end'):
+        end = filter_end_datetime(args['end'])
+    else:
+        end = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+    start = filter_datetime(args['start']) if args.get('start') else end - timedelta(days=Config.REPORT_DEFAULT_DAYS)
+    if start >= end:
+        raise ValueError("start must be before end")
+    return start, end
+
+def orders_over_time_query(granularity, start, end, conditions, params):
+    """(sql, params) counting the orders in [start, end) matching `conditions`, per hour or per day."""
+    if granularity == 'hour':
+        sql = """SELECT DATE(created_at) as bucket_date, HOUR(created_at) as bucket_hour, COUNT(*) as count
+FROM orders
+WHERE created_at >= %s AND created_at < %s"""
+        range_params = [start, end]
+        group_by = "GROUP BY bucket_date, bucket_hour"
+    else:
+        sql = """SELECT stat_date as bucket_date, 0 as bucket_hour, CAST(SUM(order_count) AS SIGNED) as count
+FROM orders_daily_stats
+WHERE stat_date >= %s AND stat_date < %s"""
+        range_params = [start.date(), end.date()]
+        group_by = "GROUP BY stat_date"
+    for condition in conditions:
+        sql += "\n  AND " + condition
+    return sql + "\n" + group_by, tuple(range_params + list(params))
+
+def orders_over_time(db, granularity, buckets, end, conditions, params):
+    """[{order_date, count}] for each bucket in `buckets` (from report_buckets, ending at `end`)."""
+    counts = dict.fromkeys(buckets, 0)
+    for row in db.fetchall(*orders_over_time_query(granularity, buckets[0], end, conditions, params)):
+        day = row['bucket_date']
+        counts[report_bucket(datetime(day.year, day.month, day.day, row['bucket_hour']), granularity)] += row['count']
+    return [{'order_date': bucket.isoformat() if granularity == 'hour' else bucket.date().isoformat(), 'count': count}
+            for bucket, count in counts.items()]
+
 @app.route('/api/reports/orders-summary', methods=['GET'])
+@cached_report
 def get_orders_summary_report():
-    conn = None
-    cursor = None
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
-
-        # Total orders
-        cursor.execute("SELECT COUNT(*) as total_orders FROM orders")
-        total_orders = cursor.fetchone()['total_orders']
-
-        # Orders by status
-        cursor.execute("SELECT status, COUNT(*) as count FROM orders GROUP BY status")
-        orders_by_status = cursor.fetchall()
+        with db_session() as db:
+            # Total orders
+            total_orders = db.fetchone('reports.total_orders')['total_orders']
+            # Orders by status
+            orders_by_status = db.fetchall('reports.orders_by_status')
 
         return jsonify({
             'total_orders': total_orders,
@@ -1873,49 +4105,752 @@ def get_orders_summary_report():
     except Exception as e:
         logger.error(f"Unexpected error generating orders summary report: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
 
 @app.route('/api/reports/orders-over-time', methods=['GET'])
+@cached_report
 def get_orders_over_time_report():
-    # Add date range filters later if needed e.g. ?start_date=YYYY-MM-DD&end_date=YYYY-MM-DD
-    conn = None
-    cursor = None
+    granularity = request.args.get('granularity', 'day')
+    if granularity not in REPORT_GRANULARITIES:
+        return jsonify({'error': f"Invalid granularity. Must be one of: {', '.join(REPORT_GRANULARITIES)}"}), 400
     try:
-        conn = get_db_connection()
-        if conn is None: return jsonify({'error': 'Database connection failed'}), 500
-        cursor = conn.cursor(dictionary=True)
+        start, end = report_range(request.args)
+        conditions, params = report_filter_conditions(request.args)
+        buckets, buckets_end = report_buckets(start, end, granularity)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        # Orders grouped by creation date
-        # For simplicity, grouping by DATE(created_at). More complex grouping (week, month) can be added.
-        sql = """
-        SELECT DATE(created_at) as order_date, COUNT(*) as count
-        FROM orders
-        GROUP BY DATE(created_at)
-        ORDER BY order_date ASC
-        """
-        cursor.execute(sql)
-        orders_over_time = cursor.fetchall()
+    try:
+        with db_session() as db:
+            report = orders_over_time(db, granularity, buckets, buckets_end, conditions, params)
+        return jsonify(report), 200
+    except MySQLError as e:
+        logger.error(f"Database error generating orders over time report: {e}")
+        return jsonify({'error': 'Database error generating report', 'details': str(e)}), 500
+    except Exception as e:
+        logger.error(f"Unexpected error generating orders over time report: {e}")
+        return jsonify({'error': 'An unexpected error occurred'}), 500
 
-        # Convert date objects to string for JSON
-        for item in orders_over_time:
-            if isinstance(item.get('order_date'), datetime.date): # cursor returns datetime.date for DATE()
-                item['order_date'] = item['order_date'].isoformat()
-            elif isinstance(item.get('order_date'), datetime): # just in case
-                 item['order_date'] = item['order_date'].date().isoformat()
 
+# Time in status, from order_status_events: per status, how many orders entered and left it
+# between start and end, and how long those that left had been in it. Both counts are range
+# scans of one (status, changed_at) index for each status, so the cost follows the events in the
+# window, not the table. The statuses come from loose scans of the same indexes (one lookup per
+# distinct status).
+named_query('reports.event_statuses', """SELECT DISTINCT status FROM order_status_events WHERE status IS NOT NULL
+UNION
+SELECT DISTINCT previous_status FROM order_status_events WHERE previous_status IS NOT NULL""")
+named_query('reports.time_in_status', """SELECT
+    (SELECT COUNT(*) FROM order_status_events WHERE status = %s AND changed_at >= %s AND changed_at < %s) as entered,
+    COUNT(*) as exited,
+    CAST(AVG(TIMESTAMPDIFF(SECOND, previous_changed_at, changed_at)) AS SIGNED) as avg_seconds,
+    MAX(TIMESTAMPDIFF(SECOND, previous_changed_at, changed_at)) as max_seconds,
+    CAST(COALESCE(SUM(TIMESTAMPDIFF(SECOND, previous_changed_at, changed_at) > %s), 0) AS SIGNED) as sla_breaches
+FROM order_status_events
+WHERE previous_status = %s AND changed_at >= %s AND changed_at < %s AND previous_changed_at IS NOT NULL""")
+# Orders still in a status since before the SLA cutoff, longest waiting first. Read from orders
+# by idx_orders_status_updated, so only the breaching orders are touched.
+order_query('orders.over_sla', """WHERE o.status = %s AND o.status_updated_at < %s
+ORDER BY o.status_updated_at ASC, o.track_number ASC LIMIT %s""")
+
+def sla_hours(args):
+    """The `hours` parameter in `args`, by default ORDER_STATUS_SLA_HOURS. Raises ValueError for a bad value."""
+    try:
+        hours = float(args.get('hours', Config.ORDER_STATUS_SLA_HOURS))
+    except ValueError:
+        raise ValueError(f"Invalid value for hours: {args.get('hours')}")
+    if not hours > 0:
+        raise ValueError("hours must be greater than 0")
+    return hours
+
+@app.route('/api/reports/time-in-status', methods=['GET'])
+@cached_report
+def get_time_in_status_report():
+    try:
+        start, end = report_range(request.args)
+        hours = sla_hours(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    statuses = [status for status in request.args.getlist('status') if status]
 
-        return jsonify(orders_over_time), 200
+    try:
+        report = []
+        with db_session() as db:
+            if not statuses:
+                statuses = sorted(row['status'] for row in db.fetchall('reports.event_statuses'))
+            for status in statuses:
+                row = db.fetchone('reports.time_in_status', (status, start, end, hours * 3600, status, start, end))
+                if row['entered'] or row['exited']:
+                    report.append(dict(row, status=status))
+        return jsonify(report), 200
     except MySQLError as e:
-        logger.error(f"Database error generating orders over time report: {e}")
+        logger.error(f"Database error generating time in status report: {e}")
         return jsonify({'error': 'Database error generating report', 'details': str(e)}), 500
     except Exception as e:
-        logger.error(f"Unexpected error generating orders over time report: {e}")
+        logger.error(f"Unexpected error generating time in status report: {e}")
         return jsonify({'error': 'An unexpected error occurred'}), 500
-    finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+
+@app.route('/api/reports/sla-breaches', methods=['GET'])
+@cached_report
+def get_sla_breaches_report():
+    status = request.args.get('status') or INITIAL_ORDER_STATUS
+    try:
+        hours = sla_hours(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        limit = int(request.args.get('limit', Config.ORDERS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'limit must be an integer'}), 400
+    if not 1 <= limit <= Config.ORDERS_MAX_PAGE_SIZE:
+        return jsonify({'error': f"limit must be between 1 and {Config.ORDERS_MAX_PAGE_SIZE}"}), 400
+
+    try:
+        cutoff = datetime.now() - timedelta(hours=hours)
+        with db_session() as db:
+            orders = db.fetchall('orders.over_sla', (status, cutoff, limit), map_order)
+        return jsonify(orders), 200
+    except MySQLError as e:
+        logger.error(f"Database error generating SLA breaches report: {e}")
+        return jsonify({'error': 'Database error generating report', 'details': str(e)}), 500
+    except Exception as e:
+        logger.error(f"Unexpected error generating SLA breaches report: {e}")
+        return jsonify({'error': 'An unexpected error occurred'}), 500
+
+
+# --- USSD load test ---
+# `flask loadtest-ussd` plays complete gateway sessions against ussd_callback from many threads
+# and reports latency percentiles and database queries per menu step. It runs in-process
+# against the MySQL database from the environment or against StandInDatabase, an in-memory
+# imitation of the tables the USSD flow touches, or over HTTP against a running service (--url).
+
+class QueryCounter(threading.local):
+    """Statements executed by the current thread; read before and after a request to count its queries."""
+    count = 0
+
+query_counter = QueryCounter()
+
+
+class CountingCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        query_counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        query_counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class CountingConnection:
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._conn.cursor(*args, **kwargs))
+
+    def cached_cursor(self, key, **kwargs):
+        return CountingCursor(self._conn.cached_cursor(key, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class CountingConnectionPool:
+    """Wraps a connection pool so that every statement is counted in query_counter."""
+
+    def __init__(self, pool):
+        self._pool = pool
+
+    def get_connection(self):
+        return CountingConnection(self._pool.get_connection())
+
+
+class StandInCursor:
+    def __init__(self, database, conn, dictionary=False, **kwargs):
+        self.database = database
+        self.conn = conn
+        self.dictionary = dictionary
+        self.rows = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.rows = self.database.execute(self.conn, sql, params or ())
+        self.rowcount = len(self.rows) or 1
+        if not self.dictionary:
+            self.rows = [tuple(row.values()) for row in self.rows]
+
+    def executemany(self, sql, seq_params):
+        for params in seq_params:
+            self.database.execute(self.conn, sql, params, delay=False)
+        self.database.delay() # One round trip, like a multi-row INSERT
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        pass
+
+
+class StandInConnection:
+    def __init__(self, database):
+        self.database = database
+        self.last_insert_id = 0
+
+    def cursor(self, dictionary=False, **kwargs):
+        return StandInCursor(self.database, self, dictionary=dictionary, **kwargs)
+
+    def cached_cursor(self, key, dictionary=False, **kwargs):
+        return self.cursor(dictionary=dictionary)
+
+    def is_connected(self):
+        return True
+
+    # No transactions: every statement applies immediately
+    def start_transaction(self, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StandInDatabase:
+    """
+    In-memory stand-in for MySQL with generated crops, locations and transporters, usable as db_pool.
+    It understands only the statements issued on the USSD path and raises MySQLError for anything
+    else, so a new query on that path shows up as errors in the load test until it is added here.
+    Every statement sleeps `latency` seconds to imitate a network round trip.
+    """
+
+    def __init__(self, crops=10, locations=30, transporters=200, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        now = datetime.now()
+        self.crops = [{'id': i, 'name': f"Zao {i}"} for i in range(1, crops + 1)]
+        self.locations = [{'id': i, 'name': f"Eneo {i}", 'type': ('both', 'pickup', 'destination')[i % 3]}
+                          for i in range(1, locations + 1)]
+        self.transporters = {i: {'id': i, 'name': f"Msafirishaji {i}", 'phone': f"07{i:08d}",
+                                 'rating': f"{3 + (i % 21) / 10:.1f}/5", 'updated_at': now}
+                             for i in range(1, transporters + 1)}
+        self.orders = {}
+        self.order_stats = {}
+        self.status_events = []
+        self.next_sequence_value = 1
+        self.statements = [(re.compile(pattern, re.I | re.S), handler) for pattern, handler in (
+            (r"SELECT id, name FROM crops WHERE is_active", self._select_crops),
+            (r"SELECT id, name, type FROM locations WHERE is_active", self._select_locations),
+            (r"UPDATE sequences SET next_value = LAST_INSERT_ID", self._reserve_sequence),
+            (r"SELECT LAST_INSERT_ID\(\)", self._select_last_insert_id),
+            (r"SELECT id, name, phone, rating, updated_at FROM transporters", self._select_transporters),
+            (r"SELECT transporter_id, COUNT\(\*\) AS open_orders", self._count_open_orders),
+            (r"SELECT\s+\(SELECT name FROM crops", self._select_order_selection),
+            (r"INSERT INTO orders_daily_stats", self._add_order_stats),
+            (r"INSERT INTO order_status_events", self._add_status_events),
+            (r"INSERT INTO orders", self._insert_order),
+            (r"SELECT track_number FROM orders WHERE track_number IN", self._select_existing_orders),
+            (r"SELECT id FROM crops WHERE id IN", lambda conn, params: self._select_existing_ids(self.crops, params)),
+            (r"SELECT id FROM locations WHERE id IN", lambda conn, params: self._select_existing_ids(self.locations, params)),
+            (r"SELECT id FROM transporters WHERE id IN", lambda conn, params: self._select_existing_ids(self.transporters.values(), params)),
+            (r"SELECT\s+o\.track_number, o\.phone_number.*WHERE o\.phone_number = %s", self._select_orders_for_phone),
+            (r"SELECT\s+o\.track_number, o\.phone_number", self._select_order),
+        )]
+
+    def get_connection(self):
+        return StandInConnection(self)
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def execute(self, conn, sql, params, delay=True):
+        sql = sql.strip()
+        for pattern, handler in self.statements:
+            if pattern.match(sql):
+                if delay:
+                    self.delay()
+                with self.lock:
+                    return handler(conn, params)
+        raise MySQLError(f"Statement not supported by the stand-in database: {' '.join(sql.split())[:80]}")
+
+    def _select_crops(self, conn, params):
+        return [dict(crop) for crop in self.crops]
+
+    def _select_locations(self, conn, params):
+        return [dict(location) for location in self.locations]
+
+    def _reserve_sequence(self, conn, params):
+        self.next_sequence_value += params[0]
+        conn.last_insert_id = self.next_sequence_value
+        return []
+
+    def _select_last_insert_id(self, conn, params):
+        return [{'block_end': conn.last_insert_id}]
+
+    def _select_transporters(self, conn, params):
+        since = params[0] if params else None
+        return [dict(t) for t in self.transporters.values() if since is None or t['updated_at'] >= since]
+
+    def _count_open_orders(self, conn, params):
+        open_orders = {}
+        for order in self.orders.values():
+            if order['transporter_id'] is not None and order['status'] not in params:
+                open_orders[order['transporter_id']] = open_orders.get(order['transporter_id'], 0) + 1
+        return [{'transporter_id': t, 'open_orders': n} for t, n in open_orders.items()]
+
+    def _select_order_selection(self, conn, params):
+        crop_id, pickup_id, destination_id, transporter_id = params
+        crops = {crop['id']: crop['name'] for crop in self.crops}
+        locations = {location['id']: location for location in self.locations}
+        pickup = locations.get(pickup_id)
+        destination = locations.get(destination_id)
+        return [{
+            'crop_name': crops.get(crop_id),
+            'pickup_location_name': pickup['name'] if pickup and pickup['type'] in ('pickup', 'both') else None,
+            'destination_location_name': destination['name'] if destination and destination['type'] in ('destination', 'both') else None,
+            'transporter_id': transporter_id if transporter_id in self.transporters else None,
+        }]
+
+    def _insert_order(self, conn, params):
+        (track_number, phone_number, crop_id, crop, quantity, pickup_location_id, pickup_location,
+         destination_location_id, destination_location, transporter_id, transporter_name,
+         transporter_phone, transporter_rating, status, created_at, status_updated_at) = params
+        if track_number in self.orders:
+            raise MySQLError(f"Duplicate entry '{track_number}' for key 'PRIMARY'")
+        self.orders[track_number] = {
+            'track_number': track_number, 'phone_number': phone_number, 'quantity': quantity,
+            'status': status, 'created_at': created_at, 'status_updated_at': status_updated_at,
+            'crop': crop, 'pickup_location': pickup_location, 'destination_location': destination_location,
+            'transporter_name': transporter_name, 'transporter_phone': transporter_phone,
+            'transporter_rating': transporter_rating, 'crop_id': crop_id, 'pickup_location_id': pickup_location_id,
+            'destination_location_id': destination_location_id, 'transporter_id': transporter_id,
+        }
+        return []
+
+    def _add_order_stats(self, conn, params):
+        key, (count, quantity) = params[:5], params[5:]
+        total_count, total_quantity = self.order_stats.get(key, (0, 0))
+        self.order_stats[key] = (total_count + count, total_quantity + quantity)
+        return []
+
+    def _add_status_events(self, conn, params):
+        self.status_events.append(tuple(params))
+        return []
+
+    def _select_existing_orders(self, conn, params):
+        return [{'track_number': t} for t in params if t in self.orders]
+
+    def _select_existing_ids(self, rows, params):
+        ids = {row['id'] for row in rows}
+        return [{'id': i} for i in params if i in ids]
+
+    def _select_order(self, conn, params):
+        order = self.orders.get(params[0])
+        return [self._order_row(order)] if order else []
+
+    def _select_orders_for_phone(self, conn, params):
+        phone_number, limit = params
+        orders = sorted((order for order in self.orders.values() if order['phone_number'] == phone_number),
+                        key=lambda order: (order['created_at'], order['track_number']), reverse=True)
+        return [self._order_row(order) for order in orders[:limit]]
+
+    def _order_row(self, order):
+        transporter = self.transporters.get(order['transporter_id']) or {}
+        return {
+            'track_number': order['track_number'], 'phone_number': order['phone_number'],
+            'quantity': order['quantity'], 'status': order['status'],
+            'created_at': order['created_at'], 'status_updated_at': order['status_updated_at'],
+            'crop_name': order['crop'], 'pickup_location_name': order['pickup_location'],
+            'destination_location_name': order['destination_location'],
+            'transporter_name': transporter.get('name', order['transporter_name']),
+            'transporter_phone': transporter.get('phone', order['transporter_phone']),
+            'transporter_rating': transporter.get('rating', order['transporter_rating']),
+            'crop_id': order['crop_id'], 'pickup_location_id': order['pickup_location_id'],
+            'destination_location_id': order['destination_location_id'], 'transporter_id': order['transporter_id'],
+        }
+
+
+def menu_options(response):
+    """Maps the numbered (non-zero) options on a CON screen to their labels."""
+    options = {}
+    for line in response.split('\n'):
+        match = re.match(r"([1-9]\d*)\. (.*)", line)
+        if match:
+            options[match.group(1)] = match.group(2)
+    return options
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, min(len(sorted_values) - 1, math.ceil(pct / 100 * len(sorted_values)) - 1))]
+
+
+class UssdLoadTest:
+    """Runs simulated gateway sessions from `concurrency` threads and collects per-step results."""
+
+    SCENARIOS = ('order', 'track', 'contact', 'history')
+
+    def __init__(self, send, sessions, concurrency, mix, think_time):
+        self.send = send # send(session_id, phone_number, text) -> (response, queries or None)
+        self.sessions = sessions
+        self.concurrency = concurrency
+        self.scenarios = [name for name in mix]
+        self.weights = [mix[name] for name in self.scenarios]
+        self.think_time = think_time
+        self.results = {} # step -> [(seconds, queries, ok), ...]
+        self.track_numbers = []
+        self.customers = [] # Phone numbers that have placed an order
+        self._lock = threading.Lock()
+        self._started = 0
+
+    def run(self):
+        threads = [threading.Thread(target=self._worker, args=(n,), daemon=True) for n in range(self.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    def _worker(self, worker):
+        while True:
+            with self._lock:
+                if self._started >= self.sessions:
+                    return
+                self._started += 1
+                number = self._started
+            scenario = random.choices(self.scenarios, self.weights)[0]
+            getattr(self, f"_{scenario}_session")(f"loadtest-{worker}-{number}", generate_phone_number())
+
+    def _step(self, step, session_id, phone_number, answers, expect=('CON', 'END'), check=None):
+        """Sends one step and records it; it fails unless the response starts with `expect` and passes `check`."""
+        if self.think_time and answers:
+            time.sleep(random.uniform(0, 2 * self.think_time))
+        started = time.perf_counter()
+        try:
+            response, queries = self.send(session_id, phone_number, '*'.join(answers))
+            ok = (response.startswith(expect) and 'tatizo la kimfumo' not in response
+                  and (check is None or check(response)))
+        except Exception as e:
+            logger.warning(f"Load test step '{step}' failed: {e}")
+            response, queries, ok = '', None, False
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.results.setdefault(step, []).append((elapsed, queries, ok))
+        return response if ok else None
+
+    def _order_session(self, session_id, phone_number):
+        answers = []
+        pickup = None
+        response = None # Screen returned by the previous step; 'menu' answers pick from its options
+        for step, answer in (('main_menu', None), ('crops_menu', '1'), ('quantity_prompt', 'menu'),
+                             ('pickup_menu', str(random.randint(Config.MIN_QUANTITY, 50))),
+                             ('destination_menu', 'menu'), ('confirm', 'menu')):
+            if answer == 'menu': # Pick one of the options shown on the previous screen
+                options = menu_options(response)
+                if step == 'confirm': # Pickup and destination must differ
+                    options = {n: label for n, label in options.items() if label != pickup} or options
+                answer = random.choice(list(options)) if options else '1'
+                if step == 'destination_menu':
+                    pickup = options.get(answer)
+            if answer is not None:
+                answers.append(answer)
+            if step == 'confirm': # A confirmation without a tracking number is a rejected order
+                response = self._step(step, session_id, phone_number, answers, expect='END',
+                                      check=lambda body: re.search(rf"{TRACK_NUMBER_PREFIX}\d+", body))
+            else:
+                response = self._step(step, session_id, phone_number, answers, expect='CON')
+            if response is None:
+                return
+        with self._lock:
+            self.track_numbers.append(re.search(rf"{TRACK_NUMBER_PREFIX}\d+", response).group(0))
+            self.customers.append(phone_number)
+
+    def _track_session(self, session_id, phone_number):
+        if self._step('main_menu', session_id, phone_number, []) is None:
+            return
+        if self._step('track_prompt', session_id, phone_number, ['2'], expect='CON') is None:
+            return
+        with self._lock:
+            known = random.choice(self.track_numbers) if self.track_numbers else None
+        self._step('track_result', session_id, phone_number, ['2', known or format_track_number(random.randint(1, 10**6))], expect='END')
+
+    def _history_session(self, session_id, phone_number):
+        with self._lock:
+            phone_number = random.choice(self.customers) if self.customers else phone_number
+        if self._step('main_menu', session_id, phone_number, []) is None:
+            return
+        response = self._step('my_orders', session_id, phone_number, ['4'])
+        if response and response.startswith('CON'): # END when the number has no orders yet
+            self._step('my_order_result', session_id, phone_number, ['4', random.choice(list(menu_options(response)) or ['1'])], expect='END')
+
+    def _contact_session(self, session_id, phone_number):
+        if self._step('main_menu', session_id, phone_number, []) is not None:
+            self._step('contact', session_id, phone_number, ['3'], expect='END')
+
+    def report(self, elapsed):
+        requests_made = sum(len(results) for results in self.results.values())
+        errors = sum(1 for results in self.results.values() for r in results if not r[2])
+        lines = [
+            f"{self._started} sessions, {requests_made} requests in {elapsed:.1f}s: "
+            f"{self._started / elapsed:.1f} sessions/s, {requests_made / elapsed:.1f} requests/s, {errors} errors",
+            f"{'step':<18} {'count':>7} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}",
+        ]
+        step_order = ('main_menu', 'crops_menu', 'quantity_prompt', 'pickup_menu', 'destination_menu',
+                      'confirm', 'track_prompt', 'track_result', 'my_orders', 'my_order_result', 'contact')
+        for step in sorted(self.results, key=lambda s: step_order.index(s) if s in step_order else len(step_order)):
+            results = self.results[step]
+            latencies = sorted(r[0] * 1000 for r in results)
+            queries = [r[1] for r in results if r[1] is not None]
+            mean_queries = f"{sum(queries) / len(queries):.2f}" if queries else '-'
+            lines.append(f"{step:<18} {len(results):>7} {sum(1 for r in results if not r[2]):>7} "
+                         f"{percentile(latencies, 50):>8.1f} {percentile(latencies, 95):>8.1f} "
+                         f"{percentile(latencies, 99):>8.1f} {mean_queries:>8}")
+        return '\n'.join(lines)
+
+
+def parse_session_mix(mix):
+    """Parses 'order=60,track=30,contact=10,history=5' into {'order': 60, ...}."""
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in UssdLoadTest.SCENARIOS:
+            raise click.BadParameter(f"unknown session type '{name}', expected one of {', '.join(UssdLoadTest.SCENARIOS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+@app.cli.command('loadtest-ussd')
+@click.option('--sessions', default=500, type=int, help='Total gateway sessions to run.')
+@click.option('--concurrency', default=20, type=int, help='Sessions in flight at the same time.')
+@click.option('--mix', default='order=60,track=30,contact=10', help='Relative weights of order, track, contact and history sessions.')
+@click.option('--think-time', default=0.0, type=float, help='Mean pause between the steps of a session, in ms.')
+@click.option('--db', 'database', type=click.Choice(['standin', 'mysql']), default='standin',
+              help="'standin' (in-memory, no server needed) or 'mysql' (the configured database; orders are really created).")
+@click.option('--db-latency', default=0.0, type=float, help='Stand-in only: simulated round trip per statement, in ms.')
+@click.option('--crops', default=10, type=int, help='Stand-in only: number of crops.')
+@click.option('--locations', default=30, type=int, help='Stand-in only: number of locations.')
+@click.option('--transporters', default=200, type=int, help='Stand-in only: number of transporters.')
+@click.option('--url', default=None, help='Send requests over HTTP to this USSD callback URL instead of running in-process.')
+@click.option('--seed', default=None, type=int, help='Random seed, for repeatable session choices.')
+def loadtest_ussd_command(sessions, concurrency, mix, think_time, database, db_latency, crops, locations, transporters, url, seed):
+    """Simulates concurrent USSD gateway sessions and reports latency percentiles and DB queries per step."""
+    global db_pool
+    if seed is not None:
+        random.seed(seed)
+    logger.setLevel(logging.WARNING) # Per-request logging would dominate the timings
+
+    if url:
+        def send(session_id, phone_number, text):
+            body = urllib.parse.urlencode({'sessionId': session_id, 'serviceCode': '*150*00#',
+                                           'phoneNumber': phone_number, 'text': text}).encode()
+            with urllib.request.urlopen(url, data=body, timeout=30) as response:
+                return response.read().decode('utf-8'), None # Queries can't be counted remotely
+    else:
+        if database == 'standin':
+            db_pool = StandInDatabase(crops, locations, transporters, db_latency / 1000)
+        else:
+            init_db_pool()
+            if not db_pool:
+                raise click.ClickException("Database pool could not be initialized.")
+        db_pool = CountingConnectionPool(db_pool)
+        clients = threading.local()
+
+        def send(session_id, phone_number, text):
+            client = getattr(clients, 'client', None)
+            if client is None:
+                client = clients.client = app.test_client()
+            before = query_counter.count
+            response = client.post('/', data={'sessionId': session_id, 'serviceCode': '*150*00#',
+                                              'phoneNumber': phone_number, 'text': text})
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+            return response.get_data(as_text=True), query_counter.count - before
+
+    load_test = UssdLoadTest(send, sessions, concurrency, parse_session_mix(mix), think_time / 1000)
+    elapsed = load_test.run()
+    click.echo(load_test.report(elapsed))
+
+
+@app.cli.command('rebuild-order-stats')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Only recompute days from this date (YYYY-MM-DD) on. Default: all days.')
+def rebuild_order_stats_command(since):
+    """Recomputes the orders_daily_stats rollup from the orders table (order writes wait while it runs)."""
+    init_db_pool()
+    if not db_pool:
+        raise click.ClickException("Database pool could not be initialized.")
+    started = time.perf_counter()
+    with db_transaction() as db:
+        rows = rebuild_order_stats(db, since.date() if since else None)
+    click.echo(f"Rebuilt orders_daily_stats{' from ' + since.strftime('%Y-%m-%d') if since else ''}: "
+               f"{rows} rows in {time.perf_counter() - started:.1f}s.")
+
+# --- Legacy order columns ---
+# `flask backfill-order-fks` fills crop_id, pickup_location_id, destination_location_id and
+# transporter_id of old orders from the names copied into them: crops by name, locations by name
+# and a type usable for that end of the trip, transporters by phone. It walks orders in primary
+# key order, --chunk-size orders per transaction, so each transaction locks only that chunk
+# briefly, and pauses --sleep seconds between chunks to leave room for live traffic. The daily
+# rollup is moved along in the same transaction. The last track number done is saved in
+# system_settings with every chunk, so an interrupted run continues where it stopped.
+# It then counts the orders that still have a name but no id. Once there are none (or losing
+# those names is accepted), `flask drop-legacy-order-columns` removes the columns.
+
+ORDER_FK_BACKFILLS = ( # (id column, legacy column, id for o's legacy value)
+    ('crop_id', 'crop', "(SELECT id FROM crops WHERE name = o.crop)"),
+    ('pickup_location_id', 'pickup_location',
+     "(SELECT MIN(id) FROM locations WHERE name = o.pickup_location AND type IN ('pickup', 'both'))"),
+    ('destination_location_id', 'destination_location',
+     "(SELECT MIN(id) FROM locations WHERE name = o.destination_location AND type IN ('destination', 'both'))"),
+    ('transporter_id', 'transporter_phone', "(SELECT id FROM transporters WHERE phone = o.transporter_phone)"),
+)
+ORDER_FK_BACKFILL_SETTING = 'orders_fk_backfill_position'
+
+def backfill_order_fks_chunk(db, backfills, after, chunk_size):
+    """
+    Fills the missing ids of up to `chunk_size` orders after track number `after`, in the caller's
+    transaction, for each of `backfills` (from ORDER_FK_BACKFILLS).
+    Returns (orders read, orders changed, last track number read).
+    """
+    matches = ",\n    ".join(f"CASE WHEN o.{id_column} IS NULL THEN {lookup} END AS {id_column}_match"
+                             for id_column, _, lookup in backfills)
+    orders = db.fetchall(f"""SELECT o.track_number, o.status, o.quantity, o.created_at,
+    o.crop_id, o.pickup_location_id, o.destination_location_id, o.transporter_id,
+    {matches}
+FROM orders o
+WHERE o.track_number > %s
+ORDER BY o.track_number
+LIMIT %s
+FOR UPDATE""", (after, chunk_size))
+    if not orders:
+        return 0, 0, after
+
+    fills = {}
+    stats = []
+    for order in orders:
+        filled = {id_column: order[f"{id_column}_match"] for id_column, _, _ in backfills
+                  if order[f"{id_column}_match"] is not None}
+        if filled:
+            fills[order['track_number']] = filled
+            stats.extend(moved_order_stats(order, **filled))
+    if fills:
+        assignments = []
+        params = []
+        for id_column, _, _ in backfills:
+            cases = [(track_number, filled[id_column]) for track_number, filled in fills.items() if id_column in filled]
+            if cases:
+                assignments.append(f"{id_column} = CASE track_number {' '.join(['WHEN %s THEN %s'] * len(cases))} ELSE {id_column} END")
+                params.extend(value for case in cases for value in case)
+        params.extend(fills)
+        # Setting status_updated_at to itself keeps ON UPDATE CURRENT_TIMESTAMP from touching it
+        db.execute(f"UPDATE orders SET {', '.join(assignments)}, status_updated_at = status_updated_at "
+                   f"WHERE track_number IN ({', '.join(['%s'] * len(fills))})", tuple(params))
+        add_order_stats(db, stats)
+
+    after = orders[-1]['track_number']
+    db.execute('settings.upsert', (ORDER_FK_BACKFILL_SETTING, after, "Last order processed by flask backfill-order-fks"))
+    return len(orders), len(fills), after
+
+def unresolved_order_fks(db, backfills):
+    """{legacy column: orders with a name there but no id} for each of `backfills`. Reads all of orders."""
+    counts = ",\n    ".join(
+        f"CAST(COALESCE(SUM(o.{id_column} IS NULL AND o.{legacy} IS NOT NULL AND o.{legacy} NOT IN ('', 'N/A')), 0) AS SIGNED) AS {legacy}"
+        for id_column, legacy, _ in backfills)
+    return db.fetchone(f"SELECT {counts}\nFROM orders o")
+
+def echo_unresolved_order_fks(backfills):
+    """Prints unresolved_order_fks() and returns the total."""
+    with db_session() as db:
+        unresolved = unresolved_order_fks(db, backfills)
+    total = sum(unresolved.values())
+    if total:
+        click.echo("Orders with a name but no matching row: "
+                   + ', '.join(f"{column}: {count}" for column, count in unresolved.items() if count))
+    else:
+        click.echo("Every legacy name has its id.")
+    return total
+
+@app.cli.command('backfill-order-fks')
+@click.option('--chunk-size', type=click.IntRange(1), default=500, show_default=True, help='Orders per transaction.')
+@click.option('--sleep', type=click.FloatRange(0), default=0.1, show_default=True, help='Seconds to pause between chunks.')
+@click.option('--restart', is_flag=True, help='Start from the first order instead of where the last run stopped.')
+@click.option('--verify-only', is_flag=True, help='Only count the orders whose names have no id yet.')
+def backfill_order_fks_command(chunk_size, sleep, restart, verify_only):
+    """Fills the *_id columns of old orders from their legacy name columns (resumable), then verifies them."""
+    init_db_pool()
+    if not db_pool:
+        raise click.ClickException("Database pool could not be initialized.")
+    with db_session() as db:
+        present = legacy_columns_in_table(db)
+        setting = db.fetchone('settings.get', (ORDER_FK_BACKFILL_SETTING,))
+    backfills = [backfill for backfill in ORDER_FK_BACKFILLS if backfill[1] in present]
+    if not backfills:
+        click.echo("orders has no legacy columns left, nothing to backfill.")
+        return
+
+    if not verify_only:
+        after = '' if restart or not setting else setting['setting_value'] or ''
+        if after:
+            click.echo(f"Resuming after order {after} (use --restart to start over).")
+        started = time.perf_counter()
+        read = changed = chunks = 0
+        while True:
+            with db_transaction() as db:
+                count, filled, after = backfill_order_fks_chunk(db, backfills, after, chunk_size)
+            read += count
+            changed += filled
+            chunks += 1
+            if count < chunk_size:
+                break
+            if chunks % 20 == 0:
+                click.echo(f"  {read} orders read, {changed} updated, at {after} ({time.perf_counter() - started:.0f}s)")
+            time.sleep(sleep)
+        click.echo(f"Backfill done: {read} orders read, {changed} updated in {time.perf_counter() - started:.1f}s.")
+
+    if echo_unresolved_order_fks(backfills):
+        click.echo("Create the missing crops, locations or transporters and run again with --restart, "
+                   "or drop the columns with --force to lose these names.")
+    else:
+        click.echo("Next: set ORDER_LEGACY_COLUMNS=ignore for every worker, restart them, "
+                   "then run `flask drop-legacy-order-columns`.")
+
+@app.cli.command('drop-legacy-order-columns')
+@click.option('--force', is_flag=True, help='Drop even if some orders have a name that has no id.')
+@click.confirmation_option(prompt='Drop the legacy name columns from orders? This cannot be undone.')
+def drop_legacy_order_columns_command(force):
+    """Drops the legacy name columns from orders once backfill-order-fks has given every name its id."""
+    init_db_pool()
+    if not db_pool:
+        raise click.ClickException("Database pool could not be initialized.")
+    with db_session() as db:
+        present = legacy_columns_in_table(db)
+    if not present:
+        click.echo("orders has no legacy columns left.")
+        return
+    backfills = [backfill for backfill in ORDER_FK_BACKFILLS if backfill[1] in present]
+    if backfills and echo_unresolved_order_fks(backfills) and not force:
+        raise click.ClickException("Run `flask backfill-order-fks` first, or pass --force to drop these names.")
+
+    columns = [column for column in LEGACY_ORDER_COLUMNS if column in present]
+    with db_session() as db: # DDL commits by itself
+        db.execute("ALTER TABLE orders " + ", ".join(f"DROP COLUMN {column}" for column in columns))
+    use_order_columns(())
+    click.echo(f"Dropped {', '.join(columns)} from orders. Workers still running with "
+               "ORDER_LEGACY_COLUMNS=auto must be restarted now.")
 
 
 @app.errorhandler(404)
@@ -1937,6 +4872,10 @@ if __name__ == '__main__':
     else:
         logger.error("Database pool not initialized. Skipping table creation. Application might not work correctly.")
 
+    # Flush orders left in the write-behind journal by a previous run
+    if order_journal_flusher is not None:
+        order_journal_flusher.ensure_running()
+
     # For cPanel hosting, use the environment port or default to 5000
     port = int(os.environ.get('PORT', 5000))
     
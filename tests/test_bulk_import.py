@@ -0,0 +1,125 @@
+import io
+from contextlib import contextmanager
+
+import pytest
+
+import app
+
+
+def read(text, import_format):
+    return list(app.read_import_records(io.StringIO(text, newline=''), import_format))
+
+
+def test_csv_records_carry_their_line_numbers():
+    records = read('name,phone\nJuma,0754000001\n"Asha\nMbwana",0754000002\nNeema,\n', 'csv')
+
+    assert records == [
+        (2, {'name': 'Juma', 'phone': '0754000001'}, None),
+        (4, {'name': 'Asha\nMbwana', 'phone': '0754000002'}, None), # A quoted newline: the line the record ends on
+        (5, {'name': 'Neema', 'phone': ''}, None),
+    ]
+
+
+def test_ndjson_skips_blank_lines_and_reports_bad_ones():
+    records = read('{"name": "Mahindi"}\n\n{"name": \n["Maharage"]\n{"name": "Mpunga"}\n', 'ndjson')
+
+    assert [(line, record) for line, record, _ in records] == [
+        (1, {'name': 'Mahindi'}), (3, None), (4, None), (5, {'name': 'Mpunga'})]
+    assert records[1][2].startswith('Invalid JSON')
+    assert records[2][2] == 'Each line must be a JSON object'
+
+
+@pytest.mark.parametrize('value, text', [(None, None), ('', None), ('   ', None), (' Mbeya ', 'Mbeya'), (4.5, '4.5')])
+def test_import_text(value, text):
+    assert app.import_text(value) == text
+
+
+@pytest.mark.parametrize('value, result', [
+    (True, True), (False, False), ('yes', True), (' TRUE ', True), ('1', True), (1, True),
+    ('no', False), ('0', False), ('False', False), ('', None), (None, None),
+])
+def test_import_bool(value, result):
+    assert app.import_bool(value) is result
+
+
+def test_import_bool_rejects_other_text():
+    with pytest.raises(ValueError, match='Invalid boolean: maybe'):
+        app.import_bool('maybe')
+
+
+def test_transporter_values_require_name_and_phone():
+    assert app.transporter_import_values({'name': ' Juma ', 'phone': '0754000001', 'rating': ''}) == {
+        'name': 'Juma', 'phone': '0754000001', 'rating': None, 'vehicle_details': None, 'notes': None}
+    with pytest.raises(ValueError, match='name and phone'):
+        app.transporter_import_values({'name': 'Juma'})
+
+
+def test_location_values_default_to_both_and_check_the_type():
+    assert app.location_import_values({'name': 'Mbalali'}) == {
+        'name': 'Mbalali', 'type': 'both', 'region': None, 'is_active': None}
+    with pytest.raises(ValueError, match='Invalid type'):
+        app.location_import_values({'name': 'Mbalali', 'type': 'warehouse'})
+    with pytest.raises(ValueError, match='Missing required field: name'):
+        app.location_import_values({'type': 'pickup'})
+
+
+def test_crop_values():
+    assert app.crop_import_values({'name': 'Mahindi', 'is_active': 'no'}) == {
+        'name': 'Mahindi', 'description': None, 'is_active': False}
+    with pytest.raises(ValueError, match='Missing required field: name'):
+        app.crop_import_values({'description': 'Nafaka'})
+
+
+class FakeCropsTable:
+    """Answers the existing-key SELECT and records the upserted rows."""
+
+    def __init__(self, names):
+        self.names = names
+        self.upserts = []
+
+    def fetchall(self, query, params=(), mapper=None):
+        return [{'name': name} for name in self.names if name.lower() in params]
+
+    def executemany(self, query, seq_params):
+        rows = list(seq_params)
+        self.upserts.append(rows)
+        self.names += [row[0] for row in rows]
+
+
+@pytest.fixture
+def crops_table(monkeypatch):
+    table = FakeCropsTable(['Mahindi'])
+
+    @contextmanager
+    def fake_transaction():
+        yield table
+
+    monkeypatch.setattr(app, 'db_transaction', fake_transaction)
+    monkeypatch.setitem(app.IMPORT_ENTITIES['crops'], 'imported', lambda: None)
+    return table
+
+
+def test_import_endpoint_reports_each_row(crops_table):
+    body = 'name,description,is_active\nmahindi,Nafaka,\nMpunga,,no\n,Bila jina,\nMtama,,sijui\nMpunga,Mchele,\n'
+
+    response = app.app.test_client().post('/api/import/crops?batch_size=2', data=body, content_type='text/csv')
+
+    assert response.status_code == 200
+    assert response.get_json() == {'created': 1, 'updated': 2, 'invalid': 2, 'failed': 0, 'results': [
+        {'line': 2, 'result': 'updated'},
+        {'line': 3, 'result': 'created'},
+        {'line': 4, 'result': 'invalid', 'error': 'Missing required field: name'},
+        {'line': 5, 'result': 'invalid', 'error': 'Invalid boolean: sijui'},
+        {'line': 6, 'result': 'updated'}, # Created earlier in the same import
+    ]}
+    assert crops_table.upserts == [
+        [('mahindi', 'Nafaka', None), ('Mpunga', None, False)], # Updates leave empty fields as None (unchanged)
+        [('Mpunga', 'Mchele', None)],
+    ]
+
+
+def test_import_endpoint_rejects_unknown_entity_and_format(crops_table):
+    client = app.app.test_client()
+
+    assert client.post('/api/import/farmers', data='').status_code == 404
+    assert client.post('/api/import/crops?format=xml', data='').status_code == 400
@@ -0,0 +1,54 @@
+from contextlib import contextmanager
+
+import pytest
+
+import app
+
+
+class RecordingSession:
+    """A DbSession that records statements; DELETEs of catalog rows find one row."""
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, params=()):
+        self.statements.append((' '.join(app.QUERIES.get(query, query).split()), params))
+        return type('Cursor', (), {'rowcount': 1})()
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = RecordingSession()
+
+    @contextmanager
+    def fake_transaction():
+        yield session
+
+    monkeypatch.setattr(app, 'db_transaction', fake_transaction)
+    return session
+
+
+def test_deleting_a_crop_moves_its_rollup_rows_to_id_0(session):
+    response = app.app.test_client().delete('/api/crops/7')
+
+    assert response.status_code == 200
+    (delete, _), (move, move_params), (drop, drop_params) = session.statements
+    assert delete == "DELETE FROM crops WHERE id = %s"
+    assert "SELECT stat_date, status, IF(crop_id = %s, 0, crop_id), pickup_location_id, destination_location_id" in move
+    assert move.endswith("WHERE crop_id = %s ON DUPLICATE KEY UPDATE order_count = order_count + VALUES(order_count), "
+                         "quantity_total = quantity_total + VALUES(quantity_total)")
+    assert move_params == (7, 7)
+    assert (drop, drop_params) == ("DELETE FROM orders_daily_stats WHERE crop_id = %s", (7,))
+
+
+def test_deleting_a_location_moves_pickup_and_destination_rollup_rows(session):
+    response = app.app.test_client().delete('/api/locations/3')
+
+    assert response.status_code == 200
+    (_, _), (move, move_params), (drop, drop_params) = session.statements
+    assert ("SELECT stat_date, status, crop_id, IF(pickup_location_id = %s, 0, pickup_location_id), "
+            "IF(destination_location_id = %s, 0, destination_location_id)") in move
+    assert "WHERE pickup_location_id = %s OR destination_location_id = %s ON DUPLICATE KEY" in move
+    assert move_params == (3, 3, 3, 3)
+    assert drop == "DELETE FROM orders_daily_stats WHERE pickup_location_id = %s OR destination_location_id = %s"
+    assert drop_params == (3, 3)
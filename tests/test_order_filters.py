@@ -0,0 +1,93 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+import app
+
+
+def conditions_for(**args):
+    return app.order_filter_conditions(MultiDict(args))
+
+
+def test_no_filters():
+    assert conditions_for() == ([], [])
+
+
+def test_repeated_status_becomes_in_list():
+    args = MultiDict([('status', 'Imefika'), ('status', ''), ('status', 'Mizigo iko njiani')])
+
+    assert app.order_filter_conditions(args) == (["o.status IN (%s, %s)"], ['Imefika', 'Mizigo iko njiani'])
+
+
+def test_filters_are_converted():
+    conditions, params = conditions_for(crop_id='3', transporter_id='12', phone='0754000000', pickup_location_id='')
+
+    assert conditions == ["o.phone_number = %s", "o.crop_id = %s", "o.transporter_id = %s"]
+    assert params == ['0754000000', 3, 12]
+
+
+@pytest.mark.parametrize('created_to, end', [
+    ('2026-05-12', datetime(2026, 5, 13)),               # A date alone includes the whole day
+    ('2026-05-12T08:30:00', datetime(2026, 5, 12, 8, 30)), # A datetime is used as given
+])
+def test_created_to_is_exclusive(created_to, end):
+    assert conditions_for(created_from='2026-05-01', created_to=created_to) == (
+        ["o.created_at >= %s", "o.created_at < %s"], [datetime(2026, 5, 1), end])
+
+
+@pytest.mark.parametrize('name, value', [
+    ('crop_id', 'mahindi'),
+    ('destination_location_id', '2.5'),
+    ('created_from', 'jana'),
+    ('created_to', '2026-13-01'),
+])
+def test_bad_values_raise_value_error(name, value):
+    with pytest.raises(ValueError, match=f"Invalid value for {name}: {value}"):
+        conditions_for(**{name: value})
+
+
+class RecordingSession:
+    def __init__(self):
+        self.queries = []
+
+    def fetchall(self, query, params=(), mapper=None):
+        self.queries.append((query, params))
+        return []
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = RecordingSession()
+
+    @contextmanager
+    def fake_session():
+        yield session
+
+    monkeypatch.setattr(app, 'db_session', fake_session)
+    return session
+
+
+def test_filters_reach_the_page_query(session):
+    response = app.app.test_client().get('/api/orders', query_string={'status': 'Imefika', 'crop_id': '3', 'limit': 5})
+
+    assert response.status_code == 200
+    query, params = session.queries[0]
+    assert "WHERE o.status IN (%s)\n  AND o.crop_id = %s\n" in query
+    assert params == ('Imefika', 3, 6) # One extra row tells whether there is a next page
+
+
+def test_customer_orders_are_filtered_by_phone_first(session):
+    response = app.app.test_client().get('/api/customers/0754000000/orders', query_string={'status': 'Imefika'})
+
+    assert response.status_code == 200
+    assert session.queries[0][1][:2] == ('0754000000', 'Imefika')
+
+
+def test_bad_filter_is_a_400(session):
+    response = app.app.test_client().get('/api/orders', query_string={'transporter_id': 'x'})
+
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'Invalid value for transporter_id: x'}
+    assert session.queries == []
@@ -0,0 +1,108 @@
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+import app
+
+
+def test_cursor_round_trip():
+    cursor = app.encode_order_cursor({'created_at': '2026-05-12T10:00:00', 'track_number': 'TRK000012344'})
+
+    assert app.decode_order_cursor(cursor) == (datetime(2026, 5, 12, 10), 'TRK000012344')
+
+
+def test_cursor_round_trip_without_created_at():
+    cursor = app.encode_order_cursor({'created_at': None, 'track_number': 'TRK2605121234'})
+
+    assert app.decode_order_cursor(cursor) == (None, 'TRK2605121234')
+
+
+@pytest.mark.parametrize('cursor', ['not-a-cursor', 'WzFd', 'WyJ4IiwgIlRSSyJd'])
+def test_malformed_cursor(cursor):
+    with pytest.raises(ValueError):
+        app.decode_order_cursor(cursor)
+
+
+# Orders as (track_number, created_at); SQLite, like MySQL, sorts NULL below every value
+ORDERS = [
+    ('TRK000000018', '2026-05-12 10:00:00'),
+    ('TRK000000026', '2026-05-12 10:00:00'), # Same second as the one above
+    ('TRK000000034', '2026-05-13 08:30:00'),
+    ('TRK000000042', '2026-05-11 17:45:00'),
+    ('TRK2401011111', None),
+    ('TRK2401012222', None),
+    ('TRK2401013333', None),
+]
+
+
+class SQLiteOrders:
+    """Runs the order page queries on an in-memory SQLite copy of the orders schema."""
+
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:')
+        self.db.row_factory = lambda cursor, row: {column[0]: value for column, value in zip(cursor.description, row)}
+        self.db.executescript("""
+            CREATE TABLE crops (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE locations (id INTEGER PRIMARY KEY, name TEXT);
+            CREATE TABLE transporters (id INTEGER PRIMARY KEY, name TEXT, phone TEXT, rating TEXT);
+            CREATE TABLE orders (
+                track_number TEXT PRIMARY KEY, phone_number TEXT, quantity INTEGER, status TEXT,
+                created_at TEXT, status_updated_at TEXT, crop_id INTEGER, crop TEXT,
+                pickup_location_id INTEGER, pickup_location TEXT, destination_location_id INTEGER,
+                destination_location TEXT, transporter_id INTEGER, transporter_name TEXT,
+                transporter_phone TEXT, transporter_rating TEXT);
+        """)
+        self.db.executemany("INSERT INTO orders (track_number, phone_number, quantity, status, created_at) "
+                            "VALUES (?, '0754000000', 1, 'Imefika', ?)", ORDERS)
+
+    def fetchall(self, query, params=(), mapper=None):
+        params = [param.isoformat(' ') if isinstance(param, datetime) else param for param in params]
+        rows = self.db.execute(query.replace('%s', '?'), params).fetchall()
+        return [mapper(row) for row in rows] if mapper else rows
+
+
+@pytest.fixture
+def client(monkeypatch):
+    orders = SQLiteOrders()
+
+    @contextmanager
+    def fake_session():
+        yield orders
+
+    monkeypatch.setattr(app, 'db_session', fake_session)
+    monkeypatch.setattr(app, 'ORDER_SELECT', app.order_select_sql(app.LEGACY_ORDER_COLUMNS))
+    return app.app.test_client()
+
+
+def all_pages(client, sort, limit):
+    track_numbers = []
+    cursor = None
+    while True:
+        query = {'sort': sort, 'limit': limit}
+        if cursor:
+            query['cursor'] = cursor
+        response = client.get('/api/orders', query_string=query)
+        assert response.status_code == 200, response.get_json()
+        page = response.get_json()
+        track_numbers += [order['track_number'] for order in page['orders']]
+        cursor = page['next_cursor']
+        if not cursor:
+            return track_numbers
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 10])
+def test_newest_first_pages_end_with_orders_without_created_at(client, limit):
+    assert all_pages(client, '-created_at', limit) == [
+        'TRK000000034', 'TRK000000026', 'TRK000000018', 'TRK000000042',
+        'TRK2401013333', 'TRK2401012222', 'TRK2401011111',
+    ]
+
+
+@pytest.mark.parametrize('limit', [1, 2, 3, 10])
+def test_oldest_first_pages_start_with_orders_without_created_at(client, limit):
+    assert all_pages(client, 'created_at', limit) == [
+        'TRK2401011111', 'TRK2401012222', 'TRK2401013333',
+        'TRK000000042', 'TRK000000018', 'TRK000000026', 'TRK000000034',
+    ]
@@ -0,0 +1,61 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+import app
+
+ORDER = {'track_number': 'TRK000012344', 'status': 'Ombi limepokelewa', 'quantity': 5,
+         'created_at': datetime(2026, 5, 12, 10), 'status_updated_at': datetime(2026, 5, 12, 10),
+         'crop_id': 1, 'pickup_location_id': 2, 'destination_location_id': 3, 'transporter_id': None}
+
+
+class FakeOrderSession:
+    """Just enough of a DbSession for PUT /api/orders/<track_number>/status on one stored order."""
+
+    def __init__(self, order):
+        self.order = dict(order)
+
+    def fetchone(self, query, params=(), mapper=None):
+        # MySQL compares track numbers case-insensitively
+        if params[0].upper() != self.order['track_number'].upper():
+            return None
+        return mapper(dict(self.order)) if mapper else dict(self.order)
+
+    def execute(self, query, params=()):
+        if query == 'orders.update_status':
+            self.order['status'] = params[0]
+
+    def executemany(self, query, seq_params):
+        pass
+
+
+@pytest.fixture
+def order_session(monkeypatch):
+    session = FakeOrderSession(ORDER)
+
+    @contextmanager
+    def fake_transaction():
+        yield session
+
+    monkeypatch.setattr(app, 'db_transaction', fake_transaction)
+    monkeypatch.setattr(app.status_events, 'add', lambda events: None)
+    monkeypatch.setattr(app, 'map_order', lambda row: {'track_number': row['track_number'], 'status': row['status']})
+    return session
+
+
+@pytest.mark.parametrize('spelling', ['TRK000012344', 'trk000012344'])
+def test_status_update_invalidates_tracking_cache(order_session, spelling):
+    app.tracking_cache.set(('TRK000012344', 'sw'), 'END HALI YA OMBI: Ombi limepokelewa')
+
+    response = app.app.test_client().put(f'/api/orders/{spelling}/status', json={'status': 'Mizigo iko njiani'})
+
+    assert response.status_code == 200
+    assert order_session.order['status'] == 'Mizigo iko njiani'
+    assert app.tracking_cache.get(('TRK000012344', 'sw')) is None
+
+
+def test_status_update_of_unknown_order(order_session):
+    response = app.app.test_client().put('/api/orders/TRK000099999/status', json={'status': 'Imefika'})
+
+    assert response.status_code == 404
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+from datetime import datetime
+
+import pytest
+
+import app
+
+
+class FakeOrdersTable:
+    """Just enough of a DbSession for the batch status update: a locked SELECT and the CASE UPDATE."""
+
+    def __init__(self, orders):
+        self.orders = orders # track_number -> order row, keyed as MySQL stores them
+        self.statements = []
+
+    def _find(self, track_number):
+        # The default collation compares track numbers case-insensitively
+        return next((order for key, order in self.orders.items() if key.upper() == track_number.upper()), None)
+
+    def fetchall(self, query, params=(), mapper=None):
+        self.statements.append((query, params))
+        rows = [dict(order) for order in map(self._find, params) if order]
+        return [mapper(row) for row in rows] if mapper else rows
+
+    def execute(self, query, params=()):
+        self.statements.append((query, params))
+        if query.startswith("UPDATE orders SET status"):
+            cases = len(params) // 3
+            for track_number, status in zip(params[:2 * cases:2], params[1:2 * cases:2]):
+                self._find(track_number)['status'] = status
+
+    def executemany(self, query, seq_params):
+        self.statements.append((query, list(seq_params)))
+
+
+@pytest.fixture
+def orders_table(monkeypatch):
+    table = FakeOrdersTable({
+        'TRK000012344': {'track_number': 'TRK000012344', 'status': 'Ombi limepokelewa', 'quantity': 5,
+                         'created_at': datetime(2026, 5, 12, 10), 'status_updated_at': datetime(2026, 5, 12, 10),
+                         'crop_id': 1, 'pickup_location_id': 2, 'destination_location_id': 3, 'transporter_id': None},
+    })
+
+    @contextmanager
+    def fake_transaction():
+        yield table
+
+    events = []
+    monkeypatch.setattr(app, 'db_transaction', fake_transaction)
+    monkeypatch.setattr(app.status_events, 'add', events.extend)
+    table.events = events
+    return table
+
+
+def test_lowercase_track_number_is_updated(orders_table):
+    response = app.app.test_client().post('/api/orders/status:batch', json={
+        'track_numbers': ['trk000012344'], 'status': 'Mizigo iko njiani'})
+
+    assert response.status_code == 200
+    assert response.get_json() == {'updated': 1, 'results': [
+        {'track_number': 'trk000012344', 'result': 'updated', 'status': 'Mizigo iko njiani'}]}
+    assert orders_table.orders['TRK000012344']['status'] == 'Mizigo iko njiani'
+    assert [event[:2] for event in orders_table.events] == [('TRK000012344', 'Mizigo iko njiani')]
+
+
+def test_track_numbers_differing_only_in_case_are_duplicates():
+    parsed = app.parse_status_batch({'track_numbers': ['TRK000012344', 'trk000012344'], 'status': 'Imefika'})
+
+    assert [error for _, _, error in parsed] == [None, 'Duplicate track_number in batch']
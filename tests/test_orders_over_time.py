@@ -0,0 +1,124 @@
+from contextlib import contextmanager
+from datetime import date, datetime
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('granularity, bucket', [
+    ('hour', datetime(2026, 5, 13, 14)),
+    ('day', datetime(2026, 5, 13)),
+    ('week', datetime(2026, 5, 11)), # Weeks start on Monday
+    ('month', datetime(2026, 5, 1)),
+])
+def test_report_bucket(granularity, bucket):
+    assert app.report_bucket(datetime(2026, 5, 13, 14, 25, 7), granularity) == bucket
+
+
+def test_next_month_bucket_rolls_over_the_year():
+    assert app.next_report_bucket(datetime(2026, 11, 1), 'month') == datetime(2026, 12, 1)
+    assert app.next_report_bucket(datetime(2026, 12, 1), 'month') == datetime(2027, 1, 1)
+
+
+def test_report_buckets_cover_partial_buckets_at_both_ends():
+    buckets, end = app.report_buckets(datetime(2026, 5, 13, 12), datetime(2026, 5, 26), 'week')
+
+    assert buckets == [datetime(2026, 5, 11), datetime(2026, 5, 18), datetime(2026, 5, 25)]
+    assert end == datetime(2026, 6, 1)
+
+
+def test_report_buckets_are_capped(monkeypatch):
+    monkeypatch.setattr(app.Config, 'REPORT_MAX_BUCKETS', 24)
+
+    buckets, _ = app.report_buckets(datetime(2026, 5, 13), datetime(2026, 5, 14), 'hour')
+    assert len(buckets) == 24
+    with pytest.raises(ValueError, match='more than 24 hour buckets'):
+        app.report_buckets(datetime(2026, 5, 13), datetime(2026, 5, 14, 1), 'hour')
+
+
+class FakeCounts:
+    """Returns canned bucket rows for whatever orders-over-time query it is given."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def fetchall(self, query, params=(), mapper=None):
+        self.queries.append((query, params))
+        return self.rows
+
+
+def test_missing_days_are_zero_filled():
+    db = FakeCounts([{'bucket_date': date(2026, 5, 12), 'bucket_hour': 0, 'count': 4},
+                     {'bucket_date': date(2026, 5, 14), 'bucket_hour': 0, 'count': 1}])
+    buckets, end = app.report_buckets(datetime(2026, 5, 11), datetime(2026, 5, 15), 'day')
+
+    assert app.orders_over_time(db, 'day', buckets, end, [], []) == [
+        {'order_date': '2026-05-11', 'count': 0},
+        {'order_date': '2026-05-12', 'count': 4},
+        {'order_date': '2026-05-13', 'count': 0},
+        {'order_date': '2026-05-14', 'count': 1},
+    ]
+    assert db.queries[0][1] == (date(2026, 5, 11), date(2026, 5, 15))
+
+
+def test_days_are_summed_into_months():
+    db = FakeCounts([{'bucket_date': date(2026, 4, 30), 'bucket_hour': 0, 'count': 2},
+                     {'bucket_date': date(2026, 6, 2), 'bucket_hour': 0, 'count': 3},
+                     {'bucket_date': date(2026, 6, 20), 'bucket_hour': 0, 'count': 5}])
+    buckets, end = app.report_buckets(datetime(2026, 4, 15), datetime(2026, 6, 21), 'month')
+
+    assert app.orders_over_time(db, 'month', buckets, end, ['crop_id = %s'], [7]) == [
+        {'order_date': '2026-04-01', 'count': 2},
+        {'order_date': '2026-05-01', 'count': 0},
+        {'order_date': '2026-06-01', 'count': 8},
+    ]
+    query, params = db.queries[0]
+    assert 'FROM orders_daily_stats' in query and 'AND crop_id = %s' in query
+    assert params == (date(2026, 4, 1), date(2026, 7, 1), 7)
+
+
+def test_hours_are_counted_from_orders():
+    db = FakeCounts([{'bucket_date': date(2026, 5, 13), 'bucket_hour': 1, 'count': 6}])
+    buckets, end = app.report_buckets(datetime(2026, 5, 13), datetime(2026, 5, 13, 3), 'hour')
+
+    assert app.orders_over_time(db, 'hour', buckets, end, [], []) == [
+        {'order_date': '2026-05-13T00:00:00', 'count': 0},
+        {'order_date': '2026-05-13T01:00:00', 'count': 6},
+        {'order_date': '2026-05-13T02:00:00', 'count': 0},
+    ]
+    assert 'FROM orders\n' in db.queries[0][0]
+
+
+@pytest.fixture
+def client(monkeypatch):
+    db = FakeCounts([])
+
+    @contextmanager
+    def fake_session():
+        yield db
+
+    monkeypatch.setattr(app, 'db_session', fake_session)
+    monkeypatch.setattr(app, 'report_cache', app.TTLCache(max_entries=10, ttl=60))
+    return app.app.test_client()
+
+
+def test_report_endpoint_includes_the_whole_end_day(client):
+    response = client.get('/api/reports/orders-over-time', query_string={'start': '2026-05-11', 'end': '2026-05-12'})
+
+    assert response.status_code == 200
+    assert response.get_json() == [{'order_date': '2026-05-11', 'count': 0}, {'order_date': '2026-05-12', 'count': 0}]
+
+
+@pytest.mark.parametrize('query, error', [
+    ({'granularity': 'year'}, 'Invalid granularity'),
+    ({'start': '2026-05-12', 'end': '2026-05-11'}, 'start must be before end'),
+    ({'start': '2020-01-01', 'end': '2026-01-01', 'granularity': 'hour'}, 'use a coarser granularity'),
+    ({'crop_id': 'mahindi'}, 'Invalid value for crop_id'),
+])
+def test_report_endpoint_rejects_bad_parameters(client, query, error):
+    response = client.get('/api/reports/orders-over-time', query_string=query)
+
+    assert response.status_code == 400
+    assert error in response.get_json()['error']
@@ -0,0 +1,96 @@
+"""
+EXPLAINs the production queries that read orders and fails if one reads a table in full or needs
+a filesort, e.g. after a query or index change. Runs against the database configured by the
+MYSQL_* variables and is skipped when MYSQL_HOST is not set or the server cannot be reached.
+Use a database with realistic data: on a near-empty table MySQL may prefer a scan whatever the indexes.
+"""
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+import app
+
+
+def query_plan_checks():
+    """(name, sql, params, full_scan_ok) for every checked query, with representative parameters."""
+    now = datetime.now()
+    track_number = 'TRK000000000'
+    page = app.Config.ORDERS_PAGE_SIZE + 1
+    queries = app.QUERIES
+    checks = [
+        ('orders.get', queries['orders.get'], (track_number,), False),
+        ('orders.lock_for_status', queries['orders.lock_for_status'], (track_number,), False),
+        ('orders.recent_for_phone', queries['orders.recent_for_phone'], ('+255700000000', app.Config.USSD_RECENT_ORDERS), False),
+        ('orders.page', *app.order_page_query([], [], 'DESC', None, page), False),
+        ('orders.page (after cursor)', *app.order_page_query([], [], 'DESC', (now, track_number), page), False),
+        ('orders.page (after undated cursor)', *app.order_page_query([], [], 'DESC', (None, track_number), page), False),
+        ('orders.page (oldest first)', *app.order_page_query([], [], 'ASC', (now, track_number), page), False),
+        ('orders.page (status)', *app.order_page_query(["o.status = %s"], ['Ombi limepokelewa'], 'DESC', (now, track_number), page), False),
+        ('orders.page (phone)', *app.order_page_query(["o.phone_number = %s"], ['+255700000000'], 'DESC', None, page), False),
+        ('orders.page (created range)', *app.order_page_query(["o.created_at >= %s", "o.created_at < %s"],
+                                                              [now - timedelta(days=30), now], 'DESC', None, page), False),
+        ('orders.export', queries['orders.export'], (), True), # Reads everything by design; must not sort
+        # The summary reads the small rollup table; a scan of it is fine, a sort is not
+        ('reports.total_orders', queries['reports.total_orders'], (), True),
+        ('reports.orders_by_status', queries['reports.orders_by_status'], (), True),
+        ('reports.orders_over_time (day)', *app.orders_over_time_query('day', now - timedelta(days=30), now, [], []), False),
+        ('reports.orders_over_time (day, route)', *app.orders_over_time_query('day', now - timedelta(days=30), now,
+                                                                              ["pickup_location_id = %s", "destination_location_id = %s"], [1, 2]), False),
+        ('reports.orders_over_time (hour)', *app.orders_over_time_query('hour', now - timedelta(days=1), now, [], []), False),
+        ('reports.orders_over_time (hour, status)', *app.orders_over_time_query('hour', now - timedelta(days=1), now,
+                                                                                ["status IN (%s)"], ['Ombi limepokelewa']), False),
+        ('reports.event_statuses', queries['reports.event_statuses'], (), False),
+        ('reports.time_in_status', queries['reports.time_in_status'],
+         (app.INITIAL_ORDER_STATUS, now - timedelta(days=30), now, 3600, app.INITIAL_ORDER_STATUS, now - timedelta(days=30), now), False),
+        ('orders.over_sla', queries['orders.over_sla'], (app.INITIAL_ORDER_STATUS, now - timedelta(hours=48), page), False),
+        ('status_events.for_order', queries['status_events.for_order'], (track_number,), False),
+    ]
+    if app.Config.CLOSED_ORDER_STATUSES:
+        checks.append(('transporters.open_orders',) + app.open_orders_query() + (False,))
+    return checks
+
+
+def plan_problems(plan, full_scan_ok):
+    """Reasons an EXPLAIN result (list of row dicts) is not acceptable."""
+    problems = []
+    for row in plan:
+        extra = row.get('Extra') or ''
+        if row['type'] == 'ALL' and not full_scan_ok:
+            problems.append(f"full table scan on {row['table']}")
+        if 'Using filesort' in extra:
+            problems.append(f"filesort on {row['table']}")
+    return problems
+
+
+def test_plan_problems():
+    scan = {'table': 'o', 'type': 'ALL', 'key': None, 'Extra': 'Using where; Using filesort'}
+    ref = {'table': 'c', 'type': 'eq_ref', 'key': 'PRIMARY', 'Extra': None}
+
+    assert plan_problems([ref], False) == []
+    assert plan_problems([scan, ref], False) == ["full table scan on o", "filesort on o"]
+    assert plan_problems([scan, ref], True) == ["filesort on o"]
+
+
+@pytest.fixture(scope='module')
+def mysql_db():
+    if not os.environ.get('MYSQL_HOST'):
+        pytest.skip("MYSQL_HOST is not set")
+    app.init_db_pool()
+    if not app.db_pool:
+        pytest.skip("MySQL is not reachable")
+    app.create_tables_if_not_exist() # Plans are checked against the schema (and indexes) the app creates
+    with app.db_session() as db:
+        yield db
+
+
+QUERY_PLAN_CHECKS = query_plan_checks()
+
+
+@pytest.mark.parametrize('name, sql, params, full_scan_ok', QUERY_PLAN_CHECKS, ids=[check[0] for check in QUERY_PLAN_CHECKS])
+def test_query_plan(mysql_db, name, sql, params, full_scan_ok):
+    plan = mysql_db.fetchall("EXPLAIN " + sql, params)
+    problems = plan_problems(plan, full_scan_ok)
+    assert not problems, f"{name}: {'; '.join(problems)}\n" + "\n".join(
+        f"  {row['table'] or '-':<10} {row['type'] or '-':<7} key={row['key'] or '-':<32} "
+        f"rows={row['rows'] or 0:<10} {row.get('Extra') or ''}" for row in plan)
@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+
+import pytest
+
+import app
+
+
+class FakeRollup:
+    """Answers the orders-summary queries and counts how often it was asked."""
+
+    def __init__(self):
+        self.total_orders = 3
+        self.queries = 0
+        self.fail = False
+
+    def fetchone(self, query, params=(), mapper=None):
+        self.queries += 1
+        if self.fail:
+            raise app.MySQLError("Lost connection to MySQL server")
+        return {'total_orders': self.total_orders}
+
+    def fetchall(self, query, params=(), mapper=None):
+        return [{'status': 'Ombi limepokelewa', 'count': self.total_orders}]
+
+
+@pytest.fixture
+def rollup(monkeypatch):
+    rollup = FakeRollup()
+
+    @contextmanager
+    def fake_session():
+        yield rollup
+
+    monkeypatch.setattr(app, 'db_session', fake_session)
+    monkeypatch.setattr(app, 'report_cache', app.TTLCache(max_entries=10, ttl=60))
+    return rollup
+
+
+@pytest.fixture
+def client(rollup):
+    return app.app.test_client()
+
+
+SUMMARY = '/api/reports/orders-summary'
+
+
+def test_report_is_served_from_cache_with_etag(client, rollup):
+    first = client.get(SUMMARY)
+    second = client.get(SUMMARY)
+
+    assert first.status_code == second.status_code == 200
+    assert first.get_json()['total_orders'] == 3
+    assert first.headers['ETag'] and first.headers['ETag'] == second.headers['ETag']
+    assert first.headers['Cache-Control'] == 'no-cache'
+    assert second.get_data() == first.get_data()
+    assert rollup.queries == 1
+
+
+def test_matching_etag_gets_bodyless_304(client, rollup):
+    etag = client.get(SUMMARY).headers['ETag']
+
+    response = client.get(SUMMARY, headers={'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == etag
+
+
+def test_stale_etag_gets_the_new_report(client, rollup):
+    etag = client.get(SUMMARY).headers['ETag']
+    rollup.total_orders = 4
+    app.invalidate_report_cache()
+
+    response = client.get(SUMMARY, headers={'If-None-Match': etag})
+
+    assert response.status_code == 200
+    assert response.get_json()['total_orders'] == 4
+    assert response.headers['ETag'] != etag
+    assert rollup.queries == 2
+
+
+def test_query_strings_are_cached_separately(client, rollup):
+    client.get(SUMMARY, query_string='a=1&b=2')
+    client.get(SUMMARY, query_string='b=2&a=1') # Same parameters, other order
+    client.get(SUMMARY, query_string='a=2&b=2')
+
+    assert rollup.queries == 2
+
+
+def test_errors_are_not_cached(client, rollup):
+    rollup.fail = True
+    assert client.get(SUMMARY).status_code == 500
+
+    rollup.fail = False
+    response = client.get(SUMMARY)
+
+    assert response.status_code == 200
+    assert 'ETag' in response.headers
+    assert rollup.queries == 2
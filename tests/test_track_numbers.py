@@ -0,0 +1,118 @@
+import os
+from contextlib import contextmanager
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('digits, check_digit', [
+    ('7992739871', '3'), # The usual Luhn worked example
+    ('00001234', '4'),
+    ('00000000', '0'),
+])
+def test_luhn_check_digit(digits, check_digit):
+    assert app.luhn_check_digit(digits) == check_digit
+
+
+def test_format_track_number():
+    assert app.format_track_number(1234) == 'TRK000012344'
+    assert app.format_track_number(123456789) == 'TRK1234567897' # Past 8 digits the number just grows
+
+
+@pytest.mark.parametrize('code', ['TRK000012344', 'TRK1234567897', 'TRK2605121234'])
+def test_plausible_track_numbers(code):
+    assert app.is_plausible_track_number(code)
+
+
+@pytest.mark.parametrize('code', [
+    'TRK000012345', # Wrong check digit
+    'TRK000021344', # Swapped adjacent digits
+    'TRK000013344', # One digit mistyped
+    'TRX000012344', # Wrong prefix
+    '000012344',
+    'TRK12345',     # Too short
+    'TRK0000I2344', # Letter for a digit
+    '',
+])
+def test_implausible_track_numbers(code):
+    assert not app.is_plausible_track_number(code)
+
+
+def test_every_single_digit_typo_is_rejected():
+    code = app.format_track_number(48151623)
+    for position in range(len(app.TRACK_NUMBER_PREFIX), len(code)):
+        for digit in '0123456789':
+            if digit != code[position]:
+                assert not app.is_plausible_track_number(code[:position] + digit + code[position + 1:])
+
+
+class FakeSequences:
+    """Stands in for the sequences table; execute() and fetchone() understand the named queries."""
+
+    def __init__(self):
+        self.next_values = {}
+        self.last_insert_id = None
+
+    def execute(self, name, params=()):
+        rowcount = 0
+        if name == 'sequences.reserve':
+            size, sequence = params
+            if sequence in self.next_values:
+                self.next_values[sequence] += size
+                self.last_insert_id = self.next_values[sequence]
+                rowcount = 1
+        elif name == 'sequences.create':
+            self.next_values.setdefault(params[0], 1)
+            rowcount = 1
+        return type('Cursor', (), {'rowcount': rowcount})()
+
+    def fetchone(self, name, params=(), mapper=None):
+        assert name == 'sequences.reserved_end'
+        return {'block_end': self.last_insert_id}
+
+
+@pytest.fixture
+def sequences(monkeypatch):
+    table = FakeSequences()
+
+    @contextmanager
+    def fake_transaction():
+        yield table
+
+    monkeypatch.setattr(app, 'db_transaction', fake_transaction)
+    return table
+
+
+def test_reserve_sequence_block_creates_missing_sequence(sequences):
+    assert app.reserve_sequence_block('track_number', 10) == 1
+    assert app.reserve_sequence_block('track_number', 10) == 11
+    assert sequences.next_values == {'track_number': 21}
+
+
+def test_allocator_hands_out_a_block_before_reserving_the_next(sequences, monkeypatch):
+    reserved = []
+    reserve = app.reserve_sequence_block
+    monkeypatch.setattr(app, 'reserve_sequence_block', lambda name, size: reserved.append(size) or reserve(name, size))
+    allocator = app.TrackNumberAllocator(block_size=3)
+
+    codes = [allocator.allocate() for _ in range(7)]
+
+    assert codes == [app.format_track_number(value) for value in range(1, 8)]
+    assert reserved == [3, 3, 3]
+
+
+def test_allocator_reserves_a_new_block_after_fork(sequences, monkeypatch):
+    allocator = app.TrackNumberAllocator(block_size=100)
+    assert allocator.allocate() == app.format_track_number(1)
+
+    child_pid = os.getpid() + 1
+    monkeypatch.setattr(app.os, 'getpid', lambda: child_pid)
+
+    assert allocator.allocate() == app.format_track_number(101)
+
+
+def test_allocator_returns_none_without_a_block(monkeypatch):
+    monkeypatch.setattr(app, 'reserve_sequence_block', lambda name, size: None)
+
+    assert app.TrackNumberAllocator(block_size=10).allocate() is None
@@ -0,0 +1,132 @@
+import random
+from collections import Counter
+
+import pytest
+
+import app
+
+
+def transporter(tid, rating='4.0/5'):
+    return {'id': tid, 'name': f"Msafirishaji {tid}", 'phone': f"07{tid:08d}", 'rating': rating, 'updated_at': None}
+
+
+def index_for(strategy_name, rows, active_orders=None):
+    index = app.TransporterIndex(app.ASSIGNMENT_STRATEGIES[strategy_name]())
+    index.load(rows, active_orders or {})
+    return index
+
+
+def test_fenwick_tree_finds_slot_by_cumulative_weight():
+    tree = app.FenwickTree(5)
+    for slot, weight in enumerate([3, 0, 5, 1, 2]):
+        tree.set(slot, weight)
+
+    assert tree.total == 11
+    # Cumulative ranges: slot 0 [0, 3), slot 2 [3, 8), slot 3 [8, 9), slot 4 [9, 11)
+    assert [tree.find(target) for target in range(11)] == [0, 0, 0, 2, 2, 2, 2, 2, 3, 4, 4]
+
+
+def test_fenwick_tree_update_replaces_weight():
+    tree = app.FenwickTree(3)
+    tree.set(0, 4)
+    tree.set(1, 4)
+    tree.set(0, 0)
+
+    assert tree.total == 4
+    assert {tree.find(target) for target in range(4)} == {1}
+
+
+def test_fenwick_tree_matches_linear_scan():
+    rng = random.Random(7)
+    tree = app.FenwickTree(50)
+    weights = [0] * 50
+    for _ in range(500):
+        slot, weight = rng.randrange(50), rng.randrange(10)
+        tree.set(slot, weight)
+        weights[slot] = weight
+        if tree.total:
+            target = rng.randrange(tree.total)
+            cumulative = 0
+            for expected, w in enumerate(weights):
+                cumulative += w
+                if target < cumulative:
+                    break
+            assert tree.find(target) == expected
+
+
+@pytest.mark.parametrize('rating, weight', [('4.8/5', 480), ('3.5', 350), ('0', 1), (None, 100), ('N/A', 100)])
+def test_parse_rating(rating, weight):
+    assert app.parse_rating(rating) == weight
+
+
+def test_least_active_picks_fewest_open_orders():
+    index = index_for('least_active', [transporter(1), transporter(2), transporter(3)], {1: 2, 2: 0, 3: 1})
+
+    picks = [index.pick()['id'] for _ in range(4)]
+
+    # 2 (0 -> 1), then 2 and 3 tie at 1 and the lowest id wins, then 3, then all have 2
+    assert picks == [2, 2, 3, 1]
+    assert index.active_orders == {1: 3, 2: 2, 3: 2}
+
+
+def test_least_active_follows_closed_orders_and_removals():
+    index = index_for('least_active', [transporter(1), transporter(2)], {1: 3, 2: 1})
+
+    index.order_closed(1)
+    index.order_closed(1)
+    index.order_closed(1)
+    assert index.pick()['id'] == 1
+
+    index.remove(1)
+    assert index.pick()['id'] == 2
+
+
+def test_round_robin_rotates_per_pickup_location():
+    index = index_for('round_robin', [transporter(1), transporter(2), transporter(3)])
+
+    assert [index.pick(pickup_location_id=0)['id'] for _ in range(4)] == [1, 2, 3, 1]
+    assert [index.pick(pickup_location_id=1)['id'] for _ in range(3)] == [2, 3, 1]
+
+
+def test_round_robin_includes_added_and_skips_removed_transporters():
+    index = index_for('round_robin', [transporter(1), transporter(3)])
+    index.apply_changes([transporter(2)])
+    index.remove(3)
+
+    assert [index.pick(pickup_location_id=0)['id'] for _ in range(4)] == [1, 2, 1, 2]
+
+
+def test_rating_weighted_follows_ratings(monkeypatch):
+    index = index_for('rating_weighted', [transporter(1, '1.0/5'), transporter(2, '3.0/5')])
+    rng = random.Random(3)
+    monkeypatch.setattr(app.random, 'randrange', rng.randrange)
+
+    counts = Counter(index.pick()['id'] for _ in range(4000))
+
+    assert 0.7 < counts[2] / 4000 < 0.8 # Expected 300 / 400
+
+
+def test_rating_weighted_grows_and_skips_removed_transporters():
+    index = index_for('rating_weighted', [transporter(1)])
+    index.apply_changes([transporter(tid) for tid in range(2, 40)]) # Beyond the initial capacity
+    for tid in range(1, 39):
+        index.remove(tid)
+
+    assert {index.pick()['id'] for _ in range(50)} == {39}
+
+
+@pytest.mark.parametrize('strategy_name', sorted(app.ASSIGNMENT_STRATEGIES))
+def test_empty_index_picks_nobody(strategy_name):
+    index = index_for(strategy_name, [])
+
+    assert index.pick() is None
+
+
+@pytest.mark.parametrize('strategy_name', sorted(app.ASSIGNMENT_STRATEGIES))
+def test_pick_counts_the_new_order(strategy_name):
+    index = index_for(strategy_name, [transporter(1)])
+
+    picked = index.pick()
+
+    assert picked == {'id': 1, 'name': "Msafirishaji 1", 'phone': "0700000001", 'rating': '4.0/5'}
+    assert index.active_orders[1] == 1
@@ -0,0 +1,118 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_get_returns_what_was_set(clock):
+    cache = app.TTLCache(max_entries=10, ttl=60)
+    cache.set('a', 1)
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('b', 'default') == 'default'
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = app.TTLCache(max_entries=10, ttl=60)
+    cache.set('a', 1)
+
+    clock[0] += 59.9
+    assert cache.get('a') == 1 # Reading does not extend the TTL
+    clock[0] += 0.1
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_set_restarts_the_ttl(clock):
+    cache = app.TTLCache(max_entries=10, ttl=60)
+    cache.set('a', 1)
+    clock[0] += 50
+    cache.set('a', 2)
+    clock[0] += 50
+
+    assert cache.get('a') == 2
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = app.TTLCache(max_entries=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a') # 'b' is now the least recently used
+    cache.set('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_delete_and_clear(clock):
+    cache = app.TTLCache(max_entries=10, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    cache.delete('a')
+    cache.delete('missing')
+    assert cache.get('a') is None
+    assert len(cache) == 1
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_stats_count_hits_misses_and_evictions(clock):
+    cache = app.TTLCache(max_entries=1, ttl=60)
+    assert cache.stats()['hit_ratio'] is None
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.get('b')
+    cache.get('b')
+    clock[0] += 60
+    cache.get('b')
+
+    assert cache.stats() == {'entries': 0, 'max_entries': 1, 'ttl_seconds': 60,
+                             'hits': 2, 'misses': 2, 'evictions': 1, 'hit_ratio': 0.5}
+
+
+@pytest.fixture
+def orders(monkeypatch):
+    orders = {'TRK000012344': {'status': 'Ombi limepokelewa', 'crop': 'Mahindi', 'quantity': 5}}
+    lookups = []
+
+    def get_order_status(track_number):
+        lookups.append(track_number)
+        return orders.get(track_number)
+
+    monkeypatch.setattr(app, 'get_order_status', get_order_status)
+    monkeypatch.setattr(app, 'order_journal', None)
+    monkeypatch.setattr(app, 'tracking_cache', app.TTLCache(max_entries=10, ttl=60))
+    return orders, lookups
+
+
+def test_tracking_response_is_cached_until_invalidated(orders):
+    orders, lookups = orders
+
+    first = app.get_tracking_response('TRK000012344', 'sw')
+    orders['TRK000012344']['status'] = 'Mizigo iko njiani'
+    assert app.get_tracking_response('TRK000012344', 'sw') == first
+    assert lookups == ['TRK000012344']
+
+    app.invalidate_tracking_cache('TRK000012344')
+    assert 'Hali: Mizigo iko njiani' in app.get_tracking_response('TRK000012344', 'sw')
+    assert lookups == ['TRK000012344', 'TRK000012344']
+
+
+def test_not_found_tracking_response_is_not_cached(orders):
+    orders, lookups = orders
+
+    assert app.get_tracking_response('TRK000000018', 'sw').startswith('END NAMBA HAIJAPATIKANA')
+    orders['TRK000000018'] = {'status': 'Ombi limepokelewa'}
+    assert app.get_tracking_response('TRK000000018', 'sw').startswith('END HALI YA OMBI')
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize('text, path', [
+    ('', []),
+    ('1', ['1']),
+    ('1*2*5', ['1', '2', '5']),
+    ('1*2*0', ['1']), # Rudi Nyuma cancels the answer before it
+    ('1*0*0', ['0']), # Back to the main menu, then Toka
+    ('0', ['0']),
+])
+def test_parse_ussd_path(text, path):
+    assert app.parse_ussd_path(text)[0] == path
+
+
+def test_rejected_answers_are_skipped():
+    assert app.parse_ussd_path('1*9*2', ignored={1}) == (['1', '2'], [0, 2])
+
+
+def test_zero_after_re_prompt_goes_back_a_step():
+    # The re-prompted menu is the same screen, so its Rudi Nyuma cancels the answer before it
+    assert app.parse_ussd_path('1*9*0', ignored={1})[0] == []
+
+
+def test_zero_after_error_screen_only_dismisses_it():
+    assert app.parse_ussd_path('5*0', ignored={0}, error_screens={0})[0] == []
+    assert app.parse_ussd_path('5*0*3', ignored={0}, error_screens={0})[0] == ['3']
+    assert app.parse_ussd_path('5*0*0', ignored={0}, error_screens={0})[0] == ['0']
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'catalog_snapshot', {
+        'version': 1, 'loaded_at': time.monotonic() + 1e9, 'locations': (),
+        'crops': ({'id': 10, 'name': 'Mahindi'},),
+        'pickup': ({'id': 1, 'name': 'Mbalali', 'type': 'both'},),
+        'destination': ({'id': 1, 'name': 'Mbalali', 'type': 'both'},),
+    })
+    monkeypatch.setattr(app, 'session_store', app.MemorySessionStore(max_entries=100, ttl=60))
+    return app.app.test_client()
+
+
+def ussd(client, session_id, text):
+    return client.post('/', data={'sessionId': session_id, 'phoneNumber': '0754000000', 'text': text}).get_data(as_text=True)
+
+
+def test_back_from_invalid_main_menu_choice(client):
+    assert ussd(client, 's1', '').startswith('CON Karibu')
+    assert ussd(client, 's1', '5').startswith('CON CHAGUO HALIPO')
+    assert ussd(client, 's1', '5*0').startswith('CON Karibu')
+    assert ussd(client, 's1', '5*0*3').startswith('END MAWASILIANO')
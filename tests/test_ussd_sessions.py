@@ -0,0 +1,86 @@
+import pytest
+
+import app
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.time, 'monotonic', clock)
+    monkeypatch.setattr(app.time, 'time', clock)
+    return clock
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path, clock):
+    if request.param == 'memory':
+        return app.MemorySessionStore(max_entries=100, ttl=60)
+    return app.SQLiteSessionStore(str(tmp_path / 'sessions.sqlite3'), ttl=60)
+
+
+def test_saved_session_is_returned(store):
+    store.save('s1', {'menus': {'crops': [{'id': 10, 'name': 'Mahindi'}]}})
+
+    assert store.get('s1') == {'menus': {'crops': [{'id': 10, 'name': 'Mahindi'}]}}
+    assert store.get('s2') is None
+
+
+def test_session_expires_after_ttl(store, clock):
+    store.save('s1', {'ignored': [1]})
+    clock.now += 59
+    assert store.get('s1') == {'ignored': [1]}
+
+    clock.now += 1
+    assert store.get('s1') is None
+
+
+def test_saving_again_restarts_the_ttl(store, clock):
+    store.save('s1', {'step': 1})
+    clock.now += 50
+    store.save('s1', {'step': 2})
+    clock.now += 50
+
+    assert store.get('s1') == {'step': 2}
+
+
+def test_deleted_session_is_gone(store):
+    store.save('s1', {})
+    store.delete('s1')
+
+    assert store.get('s1') is None
+
+
+def test_memory_store_evicts_least_recently_used(clock):
+    store = app.MemorySessionStore(max_entries=2, ttl=60)
+    store.save('s1', {'n': 1})
+    store.save('s2', {'n': 2})
+    store.get('s1') # s2 is now the least recently used
+    store.save('s3', {'n': 3})
+
+    assert store.get('s1') == {'n': 1}
+    assert store.get('s2') is None
+    assert store.get('s3') == {'n': 3}
+
+
+def test_menu_choice_comes_from_the_session_snapshot(monkeypatch):
+    monkeypatch.setattr(app, 'get_active_crops_for_ussd', lambda: pytest.fail("catalog read despite a snapshot"))
+    session = {'menus': {'crops': [{'id': 10, 'name': 'Mahindi'}, {'id': 11, 'name': 'Viazi'}]}}
+
+    assert app.resolve_menu_choice(session, 'crops', '2') == {'id': 11, 'name': 'Viazi'}
+    assert app.resolve_menu_choice(session, 'crops', '3') is None
+    with pytest.raises(ValueError):
+        app.resolve_menu_choice(session, 'crops', 'x')
+
+
+def test_menu_choice_without_snapshot_uses_the_catalog(monkeypatch):
+    monkeypatch.setattr(app, 'get_active_locations_for_ussd', lambda location_type_filter: [{'id': 1, 'name': 'Mbalali'}])
+
+    assert app.resolve_menu_choice({}, 'pickup', '1') == {'id': 1, 'name': 'Mbalali'}